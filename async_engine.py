@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from connection_manager import ConnectionManager
+from heartbeat import SOFT_RESET
+from globals import mac_dict
+from transport import TransportError
+
+logger = logging.getLogger(__name__)
+
+
+# drives every Beetle from a single asyncio event loop instead of a thread per Beetle
+# notifications are read in the loop as soon as a Beetle's transport becomes readable. only the blocking steps of
+# connecting (BLE connection, GATT discovery) are handed to a small executor, whose size doesn't grow with the
+# number of Beetles, and are scheduled by a ConnectionManager
+class AsyncBeetleEngine:
+
+    CONNECT_WORKERS = 2
+
+    # how often a Beetle's timeout is checked while no notifications come in
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, beetles, connect_workers=CONNECT_WORKERS, connection_manager=None):
+        self.beetles = beetles
+        self.executor = ThreadPoolExecutor(max_workers=connect_workers)
+        self.connection_manager = connection_manager if connection_manager is not None else ConnectionManager()
+
+    def run(self):
+        try:
+            asyncio.run(self.runBeetles())
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def runBeetles(self):
+        await asyncio.gather(*(self.runBeetle(beetle) for beetle in self.beetles))
+
+    async def runBeetle(self, beetle):
+        loop = asyncio.get_running_loop()
+        connection = self.connection_manager.register(beetle)
+
+        logger.info('Connecting to Beetle - %s', mac_dict[beetle.mac_address])
+        while True:
+            # the backoff is waited out here rather than in the executor, which only ever runs the attempts
+            await asyncio.sleep(self.connection_manager.backoffDelay(connection))
+            try:
+                await loop.run_in_executor(self.executor, self.connection_manager.attemptConnect, connection)
+            except TransportError:
+                logger.warning('Failed to connect - %s, retrying', mac_dict[beetle.mac_address])
+                continue
+
+            try:
+                await self.streamBeetle(beetle)
+            except TransportError:
+                logger.warning('Beetle disconnected - %s', mac_dict[beetle.mac_address])
+                try:
+                    await loop.run_in_executor(self.executor, beetle.disconnect)
+                except TransportError:
+                    pass
+
+    async def streamBeetle(self, beetle):
+        loop = asyncio.get_running_loop()
+        is_readable = asyncio.Event()
+
+        fd = beetle.transport.fileno()
+        if fd is not None:
+            loop.add_reader(fd, is_readable.set)
+
+        try:
+            while True:
+                await self.checkHeartbeat(beetle)
+                beetle.setCanEnqueue()
+                beetle.sendDueNacks()
+
+                if fd is None:
+                    # transports without a file descriptor say when their next notification is due instead
+                    delay = beetle.transport.timeUntilNotification()
+                    if delay is None or delay > AsyncBeetleEngine.POLL_INTERVAL:
+                        delay = AsyncBeetleEngine.POLL_INTERVAL
+                    await asyncio.sleep(delay)
+                else:
+                    try:
+                        await asyncio.wait_for(is_readable.wait(), AsyncBeetleEngine.POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        continue
+                    is_readable.clear()
+
+                # handle everything that has arrived without blocking the loop. a transport doesn't block without a
+                # timeout, and this also empties whatever it has already read past the file descriptor
+                while beetle.waitForNotifications(0):
+                    pass
+        finally:
+            if fd is not None:
+                loop.remove_reader(fd)
+
+    # Beetle.checkHeartbeat, except that a soft reset waits for the decode stage to hand the reassembler back without
+    # blocking the loop. disconnecting waits for it too, but already runs in the executor
+    async def checkHeartbeat(self, beetle):
+        if beetle.heartbeat is None:
+            beetle.checkHeartbeat()
+            return
+
+        action = beetle.heartbeat.takeAction()
+        if action == SOFT_RESET and beetle.decode_buffer is not None:
+            beetle.handshake_done = False
+            await beetle.decode_buffer.drained()
+        beetle.actOnHeartbeat(action)
@@ -1,19 +1,46 @@
-from bluepy.btle import DefaultDelegate, Peripheral, BTLEException
+import logging
 import struct
 import time
 from constants import TPacketType
 import packetize
 import csv
-from globals import p1_connected_beetles, p2_connected_beetles, TOTAL_BEETLES, EMITTER, RECEIVER, mac_dict, PLAYER_ONE, PLAYER_TWO, NUM_BEETLES_PER_PLAYER
-
-
-class BeetleDelegate(DefaultDelegate):
-    def __init__(self, beetle):
-        DefaultDelegate.__init__(self)
+import link_v2
+import metrics
+import startup
+import tracing
+from gatt_cache import gatt_cache
+from connection_manager import DISCONNECTED, STREAMING
+from heartbeat import SOFT_RESET, DISCONNECT
+from reassembler import PacketReassembler
+from transport import BluepyTransport, TransportError
+from globals import connected_beetles, TOTAL_BEETLES, BEETLE_ADDRESSES, EMITTER, RECEIVER, IMU, mac_dict, device_dict, \
+    BEETLE_PROTOCOL_VERSION
+
+
+logger = logging.getLogger(__name__)
+
+class BeetleDelegate:
+    # capture is a CaptureWriter every notification is recorded to, see capture.py
+    def __init__(self, beetle, capture=None):
         self.beetle = beetle
+        self.capture = capture
 
     def handleNotification(self, cHandle, data):
-        self.beetle.checkBuffer(data)
+        # every packet in the notification counts as received now, which is what the Ultra96 client puts the packets
+        # of a player's Beetles in order by, see stream_merge.py
+        receive_time = time.perf_counter()
+        beetle = self.beetle
+        # once its handshake is done, a Beetle with a decode stage only hands its notifications over, see
+        # decode_stage.py
+        is_handed_over = beetle.decode_buffer is not None and beetle.handshake_done
+        if beetle.trace_every and not is_handed_over:
+            beetle.startTrace(receive_time)
+        if self.capture is not None:
+            self.capture.write(beetle.player_id, beetle.device_id, data)
+        if is_handed_over:
+            beetle.handOver(data, receive_time)
+        else:
+            beetle.checkBuffer(data, receive_time)
 
 
 class Beetle:
@@ -28,25 +55,51 @@ class Beetle:
     # timeout value of 2 seconds
     TIMEOUT = 2
 
-    def __init__(self, mac_address, player_id, device_id, player_queue):
+    # longest time to block waiting for notifications
+    WAIT_TIMEOUT = 1.5
+    # shorter for a Beetle watched by a HeartbeatMonitor, so it acts on a stall soon after it is detected
+    HEARTBEAT_WAIT_TIMEOUT = 0.05
+
+    # adapter is the n of the hcin adapter the Beetle is connected through
+    def __init__(self, mac_address, player_id, device_id, player_queue, transport=None, adapter=0):
         # attributes to identify each beetle uniquely
         self.mac_address = mac_address
         self.player_id = player_id
         self.device_id = device_id
+        self.adapter = adapter
 
         # attributes needed for Beetle connection
         self.char_handle = None
         self.delegate = None
-        self.peripheral = None
+        self.transport = transport if transport is not None else BluepyTransport(mac_address, adapter)
+        # set by the ConnectionManager and HeartbeatMonitor the Beetle is registered with
+        self.connection = None
+        self.heartbeat = None
+        self.heartbeat_monitor = None
+        self.gatt_cache = gatt_cache
+        self.used_cached_handles = False
+        self.connect_start_time = 0
 
         self.ack_seqnum = 0
         self.handshake_done = False
 
-        # attribute for handling fragmentation
-        self.buffer = bytes(0)
+        # the highest version of the Beetle protocol offered in the handshake, and the one the Beetle answered with.
+        # version 2 packets are checked for losses and duplicates, and missed shots asked for again, see link_v2.py
+        self.max_protocol_version = BEETLE_PROTOCOL_VERSION
+        self.protocol_version = 1
+        self.sequence_checker = link_v2.SequenceChecker(player_id, device_id)
+
+        # attribute for handling fragmentation and corruption
+        self.reassembler = PacketReassembler(player_id=player_id, device_id=device_id)
 
         # attribute for timeout
         self.receive_time = 0
+        # when the notification being decoded was received, which lags behind receive_time with a decode stage
+        self.notification_time = 0
+
+        # the NotificationBuffer notifications are handed over to a DecodeWorker through, or None to decode them on
+        # the thread they are received on, see decode_stage.py
+        self.decode_buffer = None
 
         # for measuring throughput
         self.start_time = None
@@ -60,136 +113,289 @@ class Beetle:
         self.queue = player_queue
         self.can_enqueue_data = False
         self.packet_attr = None
+        self.packet = None
+
+        # with trace_every set, every trace_every-th packet enqueued carries the time it reached each stage, see
+        # tracing.py. trace holds the stamps of the notification being handled, if it is traced
+        self.trace_every = 0
+        self.trace_countdown = 0
+        self.trace = None
+
+        # for telemetry, kept across reconnections unlike the throughput counters. the hot path only counts, rates
+        # come from the difference between snapshots
+        self.total_notifications = 0
+        self.total_packets_received = 0
+        self.total_bytes_received = 0
+        self.num_handshakes = 0
+        self.num_connects = 0
+        self.last_packet_time = 0
+        self.registerMetrics()
+
+    def registerMetrics(self):
+        prefix = f'p{self.player_id + 1}.{device_dict[self.device_id].lower()}'
+        reassembler = self.reassembler
+        metrics.registry.gauge(f'{prefix}.notifications', lambda: self.total_notifications)
+        metrics.registry.gauge(f'{prefix}.packets_received', lambda: self.total_packets_received)
+        metrics.registry.gauge(f'{prefix}.bytes_received', lambda: self.total_bytes_received)
+        # times the reassembler lost packet alignment and slid forward to find it again, see reassembler.py
+        metrics.registry.gauge(f'{prefix}.resyncs', lambda: reassembler.num_resyncs)
+        metrics.registry.gauge(f'{prefix}.bytes_skipped', lambda: reassembler.num_bytes_skipped)
+        metrics.registry.gauge(f'{prefix}.fragments', lambda: reassembler.num_fragments)
+        metrics.registry.gauge(f'{prefix}.handshakes', lambda: self.num_handshakes)
+        metrics.registry.gauge(f'{prefix}.reconnects', lambda: max(0, self.num_connects - 1))
+        metrics.registry.gauge(f'{prefix}.since_last_notification_s', self.timeSinceLastNotification)
+        packets = self.sequence_checker.packets
+        metrics.registry.gauge(f'{prefix}.packets_lost', lambda: packets.num_lost)
+        metrics.registry.gauge(f'{prefix}.packets_duplicated', lambda: packets.num_duplicates)
+        metrics.registry.gauge(f'{prefix}.packets_out_of_window', lambda: packets.num_out_of_window)
+        metrics.registry.gauge(f'{prefix}.packets_rejected', lambda: packets.num_rejected)
+        if self.device_id != IMU:
+            shots = self.sequence_checker.shots
+            metrics.registry.gauge(f'{prefix}.shots_missed', lambda: shots.num_missed)
+            metrics.registry.gauge(f'{prefix}.shots_recovered', lambda: shots.num_recovered)
+            metrics.registry.gauge(f'{prefix}.shots_lost', lambda: shots.num_given_up)
+            metrics.registry.gauge(f'{prefix}.nacks_sent', lambda: shots.num_nacks_sent)
+        self.connect_to_first_data = metrics.registry.histogram(f'{prefix}.connect_to_first_data')
+
+    def timeSinceLastNotification(self):
+        if not self.receive_time:
+            return None
+        return time.perf_counter() - self.receive_time
 
     def setDelegate(self, delegate):
         self.delegate = delegate
 
-    def waitForNotifications(self):
-        self.peripheral.waitForNotifications(1.5)
+    def waitForNotifications(self, timeout=WAIT_TIMEOUT):
+        return self.transport.waitForNotifications(timeout)
 
     def setCanEnqueue(self):
-        total_num_beetles = p1_connected_beetles.value + p2_connected_beetles.value
+        total_num_beetles = sum(connected_beetles)
         self.can_enqueue_data = (total_num_beetles >= TOTAL_BEETLES)
 
     def connect(self):
+        self.connect_start_time = time.perf_counter()
+
         # initiate a connection to Beetle
-        self.peripheral = Peripheral(self.mac_address)
+        self.transport.connect()
+        self.num_connects += 1
 
         # the above line running indicates a successful connection to the Beetle
-        print(f"Connected successfully to Beetle - {mac_dict[self.mac_address]}")
-
-        # obtain GATT service and characteristic handle for Serial characteristic
-        serial_service = self.peripheral.getServiceByUUID(Beetle.SERIAL_SERVICE_UUID)
-        serial_char = serial_service.getCharacteristics(Beetle.SERIAL_CHAR_UUID)[0]
-        serial_char_handle = serial_char.getHandle()
-        self.char_handle = serial_char_handle
-
-        # enable notifications for Serial characteristic
-        self.peripheral.writeCharacteristic(serial_char_handle, Beetle.NOTIFICATIONS_ON, True)
-        self.peripheral.setDelegate(self.delegate)
+        logger.info('Connected successfully to Beetle - %s', mac_dict[self.mac_address])
+        startup.markPhase('first_beetle_connected')
+
+        # enable notifications for Serial characteristic, with the handles from an earlier connection if there
+        # are any, or else obtain GATT service and characteristic handles for Serial characteristic
+        if not self.enableNotificationsFromCache():
+            self.char_handle, cccd_handle = self.transport.discoverHandles(Beetle.SERIAL_SERVICE_UUID,
+                                                                           Beetle.SERIAL_CHAR_UUID)
+            self.enableNotifications(cccd_handle)
+            self.gatt_cache.put(self.mac_address, Beetle.SERIAL_SERVICE_UUID, Beetle.SERIAL_CHAR_UUID,
+                                self.char_handle, cccd_handle)
+        self.transport.setDelegate(self.delegate)
 
         # start Three-way handshake
         self.initiateHandshake()
         self.incrementPlayerBeetleCount()
+        if sum(connected_beetles) == TOTAL_BEETLES:
+            startup.markPhase('all_beetles_connected')
+        if self.heartbeat is not None:
+            self.heartbeat_monitor.arm(self.heartbeat)
         
         # if all beetles for the player have been connected/reconnected, enqueue a connected packet
         if self.allPlayerBeetlesConnected():
             connected_tuple = (TPacketType.PACKET_TYPE_CONNECTED.value, 0, self.player_id, self.device_id, 0, 0, 0, 0, 0, 0.0, 0.0, 0.0, b'\x00')
-            print("Enqueue connected packet: ", connected_tuple)
-            self.queue.put(connected_tuple)
+            logger.debug('Enqueue connected packet: %s', connected_tuple)
+            self.queue.put(self.device_id, connected_tuple, None, time.perf_counter())
+
+    def enableNotificationsFromCache(self):
+        self.used_cached_handles = False
+        handles = self.gatt_cache.get(self.mac_address, Beetle.SERIAL_SERVICE_UUID, Beetle.SERIAL_CHAR_UUID)
+        if handles is None:
+            return False
+
+        self.char_handle, cccd_handle = handles
+        try:
+            self.enableNotifications(cccd_handle)
+        except TransportError:
+            self.gatt_cache.invalidate(self.mac_address)
+            return False
+
+        self.used_cached_handles = True
+        return True
+
+    # notifications are switched on through the CCCD, or the characteristic itself for a Beetle without one
+    def enableNotifications(self, cccd_handle):
+        self.transport.write(cccd_handle if cccd_handle is not None else self.char_handle, Beetle.NOTIFICATIONS_ON,
+                             True)
 
     def resetAttributes(self):
+        self.handshake_done = False
+        self.waitForDecodeStage()
+
         self.ack_seqnum = 0
 
         self.num_packets_received = 0
         self.start_time = 0
         self.end_time = 0
 
-        self.buffer = bytes(0)
+        self.reassembler.reset()
 
         self.receive_time = 0
-        self.handshake_done = False
+        self.notification_time = 0
+        self.last_packet_time = 0
 
     def disconnect(self):
+        if self.connection is not None:
+            self.connection.setState(DISCONNECTED)
+        if self.heartbeat is not None:
+            self.heartbeat_monitor.disarm(self.heartbeat)
         self.resetAttributes()
 
         disconnect_tuple = (TPacketType.PACKET_TYPE_DISCONNECTED.value, 0, self.player_id, self.device_id, 0, 0, 0, 0, 0, 0.0, 0.0, 0.0, b'\x00')
-        print("Enqueued disconnect packet: ", disconnect_tuple)
-        self.queue.put(disconnect_tuple)
+        logger.debug('Enqueued disconnect packet: %s', disconnect_tuple)
+        self.queue.put(self.device_id, disconnect_tuple, None, time.perf_counter())
 
-        self.peripheral.disconnect()
+        self.transport.disconnect()
         self.decrementPlayerBeetleCount()
 
-    def reconnect(self):
-        print(f"Attempting to reconnect to Beetle - {mac_dict[self.mac_address]}")
-        while True:
-            try:
-                self.connect()
-                break
-            except BTLEException as e:
-                print(f"Failed to reconnect, retrying - {mac_dict[self.mac_address]}")
-                continue
-
     def initiateHandshake(self):
         # print(f"Sending Handshake to Beetle - {mac_dict[self.mac_address]}")
-        self.peripheral.writeCharacteristic(self.char_handle, val=bytes('H', 'utf-8'))
+        self.transport.write(self.char_handle, link_v2.handshakeRequest(self.max_protocol_version))
 
     def run(self):
+        if self.heartbeat is None:
+            self.checkTimeout()
+            self.setCanEnqueue()
+            self.waitForNotifications()
+        else:
+            self.checkHeartbeat()
+            self.setCanEnqueue()
+            self.waitForNotifications(Beetle.HEARTBEAT_WAIT_TIMEOUT)
+        self.sendDueNacks()
+
+    # acts on a stall the HeartbeatMonitor has found, first by re-sending the handshake on the existing link, which
+    # is much quicker than reconnecting, and if that doesn't help by disconnecting
+    def checkHeartbeat(self):
+        if self.heartbeat is None:
+            self.checkTimeout()
+            return
+        if self.heartbeat.action is None:
+            return
+        self.actOnHeartbeat(self.heartbeat.takeAction())
+
+    def actOnHeartbeat(self, action):
+        if action == SOFT_RESET:
+            logger.warning('Stalled, re-sending handshake - %s', mac_dict[self.mac_address])
+            self.handshake_done = False
+            self.waitForDecodeStage()
+            self.reassembler.reset()
+            self.initiateHandshake()
+        elif action == DISCONNECT:
+            # cached handles that didn't even get the handshake through are likely stale
+            if self.used_cached_handles and not self.handshake_done:
+                self.gatt_cache.invalidate(self.mac_address)
+            logger.warning('Still stalled after re-sending handshake - %s', mac_dict[self.mac_address])
+            raise TransportError("Stalled")
+
+    def checkTimeout(self):
         # this is to make sure no double handshake is sent upon turning off and on the Beetle
         if self.receive_time == 0:
             self.receive_time = time.perf_counter()
 
         # if laptop hasn't received data from Beetle in a while, try reset the Beetle
         if time.perf_counter() - self.receive_time > Beetle.TIMEOUT:
+            # cached handles that didn't even get the handshake through are likely stale
+            if self.used_cached_handles and not self.handshake_done:
+                self.gatt_cache.invalidate(self.mac_address)
             self.handshake_done = False
-            # self.buffer = bytes(0)
-
-            print(f"Timeout encountered - {mac_dict[self.mac_address]}")
-            raise BTLEException("Timeout")
+            # the reassembler is reset with the rest of the attributes once the Beetle is disconnected
 
-        self.setCanEnqueue()
-        self.waitForNotifications()
+            logger.warning('Timeout encountered - %s', mac_dict[self.mac_address])
+            raise TransportError("Timeout")
 
-    def checkBuffer(self, data):
+    def checkBuffer(self, data, receive_time=None):
         # received data at this time
-        self.receive_time = time.perf_counter()
-
-        self.buffer += data
-        if len(self.buffer) >= self.PACKET_SIZE:
-            self.handleData(self.buffer[:self.PACKET_SIZE])
-            self.buffer = self.buffer[self.PACKET_SIZE:]
+        now = time.perf_counter() if receive_time is None else receive_time
+        self.countNotification(now, data)
+        self.decodeNotification(data, now)
+
+    def countNotification(self, now, data):
+        self.receive_time = now
+        self.total_notifications += 1
+        self.total_bytes_received += len(data)
+
+    def decodeNotification(self, data, receive_time):
+        self.notification_time = receive_time
+
+        # handle every complete packet in the notification, skipping over corrupted bytes
+        packets = self.reassembler.feed(data)
+        if self.trace is not None:
+            self.trace[tracing.CHECK_BUFFER] = time.perf_counter()
+        for packet in packets:
+            self.handleData(packet)
+
+    # I/O tier of a decode stage: the notification is only timestamped and handed over to the DecodeWorker
+    def handOver(self, data, receive_time):
+        trace = tracing.startTrace(receive_time) if self.trace_every and self.trace_countdown <= 0 else None
+        self.countNotification(receive_time, data)
+        self.decode_buffer.append(receive_time, data, trace)
+
+    # decode tier of a decode stage, on the DecodeWorker's thread. a notification traced while an earlier traced one
+    # was still waiting to be decoded isn't traced after all, since the countdown has started over since
+    def decodeHandedOver(self, data, receive_time, trace):
+        self.trace = trace if self.trace_countdown <= 0 else None
+        self.decodeNotification(data, receive_time)
+
+    # takes the reassembler back from a decode stage, once the DecodeWorker has decoded every notification handed
+    # over to it. handshake_done has to have been cleared, so no more are
+    def waitForDecodeStage(self):
+        if self.decode_buffer is not None:
+            self.decode_buffer.waitUntilDrained()
 
     def handleData(self, data):
         # for debugging
         # print(f'Raw bytes received from {mac_dict[self.mac_address]}:', data)
 
-        # drop corrupted packets
-        if packetize.isInvalidPacket(data):
-            print(f'Invalid packet - {mac_dict[self.mac_address]}')
-            return
+        # corrupted packets have already been dropped by the reassembler. only the details byte is interpreted here,
+        # the samples are passed on raw and only decoded by the Ultra96 client when it sends them on
+        packet_attr = packetize.DETAILS_TABLE[data[0]]
+        if self.trace is not None:
+            self.trace[tracing.DESERIALIZE] = time.perf_counter()
 
-        packet_attr = packetize.deserialize(data)
-            
         packet_type = packet_attr[0]
 
         if packet_type == TPacketType.PACKET_TYPE_DATA.value:
+            # lost packets are counted and missed shots asked for again, and duplicates dropped
+            if self.protocol_version >= 2 and not self.sequence_checker.accept(data, self.notification_time):
+                return
+
             if not self.start_time:
                 self.start_time = time.perf_counter()
+                self.connect_to_first_data.record(self.start_time - self.connect_start_time)
+                startup.markPhase('first_data')
 
-            self.processData(packet_attr)
+            self.processData(packet_attr, data)
         elif packet_type == TPacketType.PACKET_TYPE_ACK.value and not self.handshake_done:
             # print(f"Received Ack from Beetle - {mac_dict[self.mac_address]}")
+            self.protocol_version = min(self.max_protocol_version, link_v2.ackVersion(data))
+            self.sequence_checker.reset()
             self.sendHandshakeAck()
+            self.num_handshakes += 1
             # print(f"Three-way Handshake complete! Ready to receive data - {mac_dict[self.mac_address]}")
             self.handshake_done = True
+            if self.connection is not None:
+                self.connection.setState(STREAMING)
 
-    def processData(self, packet_attr):
+    def processData(self, packet_attr, packet):
         # for throughput calculation
         self.num_packets_received += 1
+        self.total_packets_received += 1
+        self.last_packet_time = self.notification_time
         # self.showThroughput()
 
         self.ack_seqnum = packet_attr[1]
         self.packet_attr = packet_attr
+        self.packet = packet
 
         self.enqueueData()
 
@@ -202,40 +408,59 @@ class Beetle:
         if self.device_id == RECEIVER and not self.packet_attr[5]:
             return
 
-        self.queue.put(self.packet_attr)
+        # the raw packet is passed along for queues that carry packets rather than tuples
+        trace = self.trace
+        if trace is not None:
+            trace[tracing.ENQUEUE] = time.perf_counter()
+        self.queue.put(self.device_id, self.packet_attr, self.packet, self.notification_time, trace)
+        if self.trace_every:
+            self.countTracedPacket()
         # print(f"Enqueued data: {self.packet_attr} - {mac_dict[self.mac_address]}")
 
+    # the trace is started at the notification, before it is known whether any of its packets will be enqueued, so
+    # once the countdown has run out every notification starts a trace until one of them is
+    def startTrace(self, now=None):
+        self.trace = tracing.startTrace(now) if self.trace_countdown <= 0 else None
+
+    def countTracedPacket(self):
+        if self.trace is not None:
+            # only the first packet of a notification is traced
+            self.trace = None
+            self.trace_countdown = self.trace_every
+        else:
+            self.trace_countdown -= 1
+
     def sendHandshakeAck(self):
-        self.peripheral.writeCharacteristic(self.char_handle, val=bytes('A', 'utf-8'))
+        self.transport.write(self.char_handle, bytes('A', 'utf-8'))
+
+    def sendNack(self, shot_seq):
+        self.transport.write(self.char_handle, link_v2.nackRequest(shot_seq))
 
-    def sendNack(self):
-        self.peripheral.writeCharacteristic(self.char_handle, val=bytes('N', 'utf-8'))
+    # missed shots are noticed by whichever thread decodes the packets, but the NACKs are written by the Beetle's own
+    # thread, like everything else
+    def sendDueNacks(self):
+        if self.protocol_version < 2 or not self.handshake_done:
+            return
+        for shot_seq in self.sequence_checker.dueNacks(time.perf_counter()):
+            logger.debug('Sending NACK for shot %d - %s', shot_seq, mac_dict[self.mac_address])
+            self.sendNack(shot_seq)
 
     def incrementPlayerBeetleCount(self):
-        if self.player_id == PLAYER_ONE:
-            p1_connected_beetles.value += 1
-        elif self.player_id == PLAYER_TWO:
-            p2_connected_beetles.value += 1
+        with connected_beetles.get_lock():
+            connected_beetles[self.player_id] += 1
 
     def decrementPlayerBeetleCount(self):
-        if self.player_id == PLAYER_ONE:
-            p1_connected_beetles.value -= 1
-        elif self.player_id == PLAYER_TWO:
-            p2_connected_beetles.value -= 1
+        with connected_beetles.get_lock():
+            connected_beetles[self.player_id] -= 1
 
     def allPlayerBeetlesConnected(self):
-        if self.player_id == PLAYER_ONE:
-            return p1_connected_beetles.value == NUM_BEETLES_PER_PLAYER
-        elif self.player_id == PLAYER_TWO:
-            return p2_connected_beetles.value == NUM_BEETLES_PER_PLAYER
+        return connected_beetles[self.player_id] == len(BEETLE_ADDRESSES[self.player_id])
 
     def showThroughput(self):
         self.end_time = time.perf_counter()
         total_time = self.end_time - self.start_time
         throughput = self.num_packets_received / total_time
 
-        print(f"Time elapsed:", "{:.2f},".format(total_time))
-        # print(f"Received {self.num_packets_received} packets - {mac_dict[self.mac_address]}")
-        # print(f"Dropped {self.num_packets_dropped} packets - {mac_dict[self.mac_address]}")
-        # print(f"{self.num_packets_fragmented} packets fragmented - {mac_dict[self.mac_address]}")
-        print(f"Throughput of Beetle - {mac_dict[self.mac_address]} =", "{:.3f}".format(throughput), "packets/s")
+        # dropped and fragmented packets are counted by the reassembler and published with the metrics
+        logger.info('Throughput of Beetle - %s = %.3f packets/s over %.2f s', mac_dict[self.mac_address], throughput,
+                    total_time)
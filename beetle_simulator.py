@@ -0,0 +1,465 @@
+import argparse
+import math
+import os
+import random
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import Queue, RawValue
+from queue import Empty
+
+import link_v2
+import packetize
+from constants import TPacketType
+from globals import BEETLE_ADDRESSES, IMU, EMITTER, RECEIVER, BLE_ENGINE, BLE_ENGINE_THREADS, BLE_ENGINE_ASYNCIO, QUEUE_BACKEND
+from relay_packet import RelayPacket
+from features import FEATURE_FRAME_SIZE, isFeatureFrame
+from wire_v2 import WIRE_VERSION, EventRecord, ShotRecord, decodeRecords, offerVersion
+from gatt_cache import gatt_cache
+from transport import SimulatedTransport
+
+# packets per second sent by each kind of Beetle once the handshake is done
+DEVICE_RATES = {IMU: 40.0, EMITTER: 10.0, RECEIVER: 10.0}
+
+# chance of a data packet from the emitter/receiver carrying a shot
+SHOT_PROBABILITY = 0.05
+
+# chance of an IMU sample starting a movement, and how many samples a movement lasts
+MOVEMENT_PROBABILITY = 0.02
+MOVEMENT_SAMPLES = 30
+
+PACKET_STRUCT = struct.Struct('<B3h3fB')
+
+# the serial characteristic echoes everything back to the Arduino, so the relay's commands arrive as plain bytes
+HANDSHAKE = b'H'
+HANDSHAKE_ACK = b'A'
+
+
+# what can go wrong on a simulated link. each probability applies to every data packet sent, except
+# connect_failure_probability which applies to every connection attempt
+class SimulatedFaults:
+
+    def __init__(self, fragment_probability=0.0, corrupt_probability=0.0, drop_probability=0.0,
+                 stall_probability=0.0, stall_duration=1.0, disconnect_probability=0.0,
+                 connect_failure_probability=0.0):
+        # the packet is split across two notifications
+        self.fragment_probability = fragment_probability
+        # a bit of the packet is flipped
+        self.corrupt_probability = corrupt_probability
+        # the notification is lost, leaving the relay with a misaligned stream if the packet was fragmented
+        self.drop_probability = drop_probability
+        # the Beetle goes quiet for stall_duration seconds
+        self.stall_probability = stall_probability
+        self.stall_duration = stall_duration
+        # the link drops and the relay has to reconnect
+        self.disconnect_probability = disconnect_probability
+        self.connect_failure_probability = connect_failure_probability
+
+
+# a Beetle as the relay sees it over BLE: it answers the 'H' handshake with an ACK packet, waits for the 'A' and
+# then streams data packets at a fixed rate. one speaking version 2 of the protocol numbers its packets and shots,
+# and sends a shot again when the relay NACKs it, see link_v2.py
+class SimulatedBeetle:
+
+    # most packets caught up on in one poll if the reader falls behind, the rest are skipped like a full BLE buffer
+    MAX_BACKLOG = 16
+    # latest shots that can be sent again
+    SHOT_HISTORY = 64
+
+    # shot_log is a queue that (player_id, device_id, send time) of every shot is put on, and packet_counter and
+    # shot_counter shared values counting the data packets and shots sent, for measuring the relay from another
+    # process. protocol_version is the highest version of the protocol the Beetle speaks
+    def __init__(self, player_id, device_id, rate=None, faults=None, seed=None, shot_log=None, packet_counter=None,
+                 shot_counter=None, protocol_version=link_v2.PROTOCOL_VERSION):
+        self.player_id = player_id
+        self.device_id = device_id
+        self.rate = rate if rate is not None else DEVICE_RATES[device_id]
+        self.faults = faults if faults is not None else SimulatedFaults()
+        self.rng = random.Random(seed)
+        self.shot_log = shot_log
+        self.packet_counter = packet_counter
+        self.shot_counter = shot_counter
+
+        self.outbox = deque()
+        self.is_streaming = False
+        self.is_link_lost = False
+        self.next_packet_time = None
+        self.seqnum = 0
+        self.movement_samples_left = 0
+
+        # the version negotiated in the last handshake, and what version 2 numbers the packets and shots with
+        self.protocol_version = protocol_version
+        self.link_version = 1
+        self.packet_seq = 0
+        self.shot_seq = 0
+        # shot number -> the packet that carried it
+        self.shot_history = {}
+
+        # for checking what the relay received against what was sent
+        self.num_packets_sent = 0
+        self.num_retransmissions = 0
+
+    def acceptConnection(self):
+        return self.rng.random() >= self.faults.connect_failure_probability
+
+    def onConnect(self, now):
+        self.outbox.clear()
+        self.is_streaming = False
+        self.is_link_lost = False
+        self.next_packet_time = None
+
+    def onDisconnect(self):
+        self.onConnect(None)
+
+    # the firmware reads its commands a byte at a time, so a version 1 Beetle takes the version after the 'H' for a
+    # command it doesn't know and ignores it
+    def onWrite(self, data, now):
+        if data[:1] == HANDSHAKE:
+            self.is_streaming = False
+            self.link_version = min(self.protocol_version, link_v2.offeredVersion(data))
+            self.packet_seq = 0
+            self.shot_seq = 0
+            self.shot_history.clear()
+            self.outbox.append((now, self.makePacket(TPacketType.PACKET_TYPE_ACK, now)))
+        elif data == HANDSHAKE_ACK and not self.is_streaming:
+            self.is_streaming = True
+            self.next_packet_time = now + 1 / self.rate
+        elif data[:1] == link_v2.NACK and self.link_version >= 2 and self.is_streaming:
+            self.resendShot(link_v2.NACK_STRUCT.unpack(data)[1], now)
+
+    # the packet is sent again as it was, and may be lost again
+    def resendShot(self, shot_seq, now):
+        packet = self.shot_history.get(shot_seq)
+        if packet is None:
+            return
+        self.num_retransmissions += 1
+        if self.rng.random() >= self.faults.drop_probability:
+            self.outbox.append((now, packet))
+
+    def nextNotificationTime(self):
+        if self.outbox:
+            return self.outbox[0][0]
+        if self.is_streaming:
+            return self.next_packet_time
+        return None
+
+    # returns (send time, payload) of the notifications due by now
+    def poll(self, now):
+        if self.is_streaming and now >= self.next_packet_time:
+            num_due = int((now - self.next_packet_time) * self.rate) + 1
+            if num_due > SimulatedBeetle.MAX_BACKLOG:
+                self.next_packet_time += (num_due - SimulatedBeetle.MAX_BACKLOG) / self.rate
+                num_due = SimulatedBeetle.MAX_BACKLOG
+            for _ in range(num_due):
+                self.sendDataPacket()
+                if not self.is_streaming:
+                    break
+
+        notifications = []
+        while self.outbox and self.outbox[0][0] <= now:
+            notifications.append(self.outbox.popleft())
+        return notifications
+
+    def sendDataPacket(self):
+        send_time = self.next_packet_time
+        self.next_packet_time += 1 / self.rate
+        packet = self.makePacket(TPacketType.PACKET_TYPE_DATA, send_time)
+
+        faults = self.faults
+        if self.rng.random() < faults.corrupt_probability:
+            packet = bytearray(packet)
+            packet[self.rng.randrange(len(packet))] ^= 1 << self.rng.randrange(8)
+            packet = bytes(packet)
+
+        if self.rng.random() < faults.fragment_probability:
+            split = self.rng.randrange(1, len(packet))
+            fragments = [packet[:split], packet[split:]]
+        else:
+            fragments = [packet]
+
+        for fragment in fragments:
+            if self.rng.random() >= faults.drop_probability:
+                self.outbox.append((send_time, fragment))
+
+        if self.rng.random() < faults.stall_probability:
+            self.next_packet_time += faults.stall_duration
+        if self.rng.random() < faults.disconnect_probability:
+            self.is_streaming = False
+            self.is_link_lost = True
+
+    def makePacket(self, packet_type, send_time):
+        gyro = (0, 0, 0)
+        accel = (0.0, 0.0, 0.0)
+        # version 2 sends the lowest bit of the packet's sequence number in the sequence bit
+        seqnum = self.seqnum if self.link_version < 2 else self.packet_seq & 1
+        details = packetize.detailsAsBytes(packet_type.value, seqnum, self.player_id, self.device_id)[0]
+        is_shot = False
+
+        if packet_type == TPacketType.PACKET_TYPE_ACK:
+            # the version follows the details byte, which leaves a version 1 ACK all zeroes
+            if self.link_version >= 2:
+                gyro = (self.link_version, 0, 0)
+        elif packet_type == TPacketType.PACKET_TYPE_DATA:
+            self.seqnum ^= 1
+            self.num_packets_sent += 1
+            if self.packet_counter is not None:
+                self.packet_counter.value += 1
+
+            if self.device_id == IMU:
+                gyro, accel = self.makeImuSample()
+            elif self.device_id == EMITTER and self.rng.random() < SHOT_PROBABILITY:
+                details |= packetize.SEND_SHOT_MASK
+                is_shot = True
+                self.logShot(send_time)
+            elif self.device_id == RECEIVER and self.rng.random() < SHOT_PROBABILITY:
+                details |= packetize.RECEIVE_SHOT_MASK
+                is_shot = True
+                self.logShot(send_time)
+
+        packet = bytearray(PACKET_STRUCT.pack(details, *gyro, *accel, 0))
+        if packet_type == TPacketType.PACKET_TYPE_DATA and self.link_version >= 2:
+            self.numberPacket(packet, is_shot)
+        packet[packetize.CHECKSUM_POS] = packetize.getChecksum(packet[:packetize.CHECKSUM_POS])
+        packet = bytes(packet)
+
+        if is_shot and self.link_version >= 2:
+            self.shot_history[self.shot_seq] = packet
+            if len(self.shot_history) > SimulatedBeetle.SHOT_HISTORY:
+                del self.shot_history[next(iter(self.shot_history))]
+        return packet
+
+    # version 2 numbers every data packet, and the shots of an emitter or receiver, see link_v2.py
+    def numberPacket(self, packet, is_shot):
+        seq = self.packet_seq
+        self.packet_seq = (seq + 1) % link_v2.SEQ_MODULUS
+        if self.device_id == IMU:
+            packet[0] |= link_v2.imuSequenceBits(seq)
+            return
+
+        if is_shot:
+            self.shot_seq = (self.shot_seq + 1) % link_v2.SEQ_MODULUS
+        link_v2.SHOT_HEADER.pack_into(packet, 1, seq, self.shot_seq)
+
+    def logShot(self, send_time):
+        if self.shot_counter is not None:
+            self.shot_counter.value += 1
+        if self.shot_log is not None:
+            self.shot_log.put((self.player_id, self.device_id, send_time))
+
+    # a hand at rest with the odd movement thrown in, which is what the IMU window trigger looks for
+    def makeImuSample(self):
+        if not self.movement_samples_left and self.rng.random() < MOVEMENT_PROBABILITY:
+            self.movement_samples_left = MOVEMENT_SAMPLES
+
+        if self.movement_samples_left:
+            phase = math.pi * self.movement_samples_left / MOVEMENT_SAMPLES
+            self.movement_samples_left -= 1
+            accel = (2.5 * math.sin(phase), self.rng.gauss(0, 0.3), 1.0 + self.rng.gauss(0, 0.3))
+            gyro = tuple(self.rng.randint(-20000, 20000) for _ in range(3))
+        else:
+            accel = (self.rng.gauss(0, 0.05), self.rng.gauss(0, 0.05), 1.0 + self.rng.gauss(0, 0.05))
+            gyro = tuple(self.rng.randint(-300, 300) for _ in range(3))
+        return gyro, accel
+
+
+# stands in for the data_server, counting what the relay sends and timing every shot from the simulated Beetle
+# that fired it to its arrival here
+class LoadSink:
+
+    def __init__(self, shot_log, wire_version=1):
+        self.shot_log = shot_log
+        # the highest uplink format offered to the relay, see wire_v2.py
+        self.wire_version = wire_version
+        self.server = socket.create_server(('localhost', 0))
+        self.address = self.server.getsockname()
+
+        self.num_packets = 0
+        self.num_bytes = 0
+        self.num_shots_received = 0
+        # shots that version 3 placed in a window being cut
+        self.num_shots_in_window = 0
+        self.shot_latencies = []
+        self.pending_shots = {}
+
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        packet_size = struct.calcsize(RelayPacket.FMT)
+        while True:
+            conn, _ = self.server.accept()
+            with conn:
+                version = offerVersion(conn, self.wire_version)
+                buffer = bytearray()
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    arrival_time = time.perf_counter()
+                    buffer += data
+                    if version >= 2:
+                        self.handleRecords(buffer, arrival_time)
+                        continue
+                    # feature frames are counted as packets like the relay packets around them
+                    offset = 0
+                    while offset < len(buffer):
+                        record_size = FEATURE_FRAME_SIZE if isFeatureFrame(buffer[offset]) else packet_size
+                        if offset + record_size > len(buffer):
+                            break
+                        self.handlePacket(buffer[offset], arrival_time)
+                        offset += record_size
+                    self.num_bytes += offset
+                    del buffer[:offset]
+
+    # version 2 records are counted as packets too, windows and feature frames carrying no shots
+    def handleRecords(self, buffer, arrival_time):
+        records, consumed = decodeRecords(buffer)
+        for record in records:
+            if isinstance(record, (EventRecord, ShotRecord)):
+                self.handlePacket(record.details, arrival_time)
+                if isinstance(record, ShotRecord) and record.window_offset >= 0:
+                    self.num_shots_in_window += 1
+            else:
+                self.num_packets += 1
+        self.num_bytes += consumed
+        del buffer[:consumed]
+
+    def handlePacket(self, details, arrival_time):
+        self.num_packets += 1
+
+        if details & (1 << RelayPacket.SEND_SHOT_SHIFT):
+            device_id = EMITTER
+        elif details & (1 << RelayPacket.RECEIVE_SHOT_SHIFT):
+            device_id = RECEIVER
+        else:
+            return
+
+        self.num_shots_received += 1
+        player_id = details >> RelayPacket.PLAYER_ID_SHIFT
+        send_time = self.matchShot(player_id, device_id, arrival_time)
+        if send_time is not None:
+            self.shot_latencies.append(arrival_time - send_time)
+
+    # the latest shot sent before arrival_time, any earlier unmatched shots having been lost on the way
+    def matchShot(self, player_id, device_id, arrival_time):
+        pending = self.pending_shots.setdefault((player_id, device_id), deque())
+        # the shot can overtake its own log entry, which is still in the queue's feeder thread
+        timeout = 0.05 if not pending else 0
+        while True:
+            try:
+                shot = self.shot_log.get(timeout=timeout) if timeout else self.shot_log.get_nowait()
+            except Empty:
+                break
+            timeout = 0
+            self.pending_shots.setdefault(shot[:2], deque()).append(shot[2])
+
+        send_time = None
+        while pending and pending[0] <= arrival_time:
+            send_time = pending.popleft()
+        return send_time
+
+
+def runLoad(duration, faults, engine, queue_backend, seed, capture_dir=None, num_workers=None, wire_version=1,
+            trace_dir=None, decode_stage=False, beetle_protocol=link_v2.PROTOCOL_VERSION):
+    # imported here so the simulator itself can be used without starting up the whole relay
+    from ble_client import start_processes
+
+    shot_log = Queue()
+    sink = LoadSink(shot_log, wire_version)
+
+    # the simulated Beetles have the MAC addresses of the real ones, whose cached GATT handles are left alone
+    gatt_cache.path = None
+
+    # the counters have to exist before the Beetle processes are forked to be readable from here
+    packet_counters = {}
+    shot_counters = {}
+    for player_id, beetle_addresses in enumerate(BEETLE_ADDRESSES):
+        for device_id in range(IMU, IMU + len(beetle_addresses)):
+            packet_counters[(player_id, device_id)] = RawValue('q', 0)
+            shot_counters[(player_id, device_id)] = RawValue('q', 0)
+
+    def transportFactory(beetle_address, player_id, device_id):
+        peripheral = SimulatedBeetle(player_id, device_id, faults=faults, seed=seed + 4 * player_id + device_id,
+                                     shot_log=shot_log, packet_counter=packet_counters[(player_id, device_id)],
+                                     shot_counter=shot_counters[(player_id, device_id)],
+                                     protocol_version=beetle_protocol)
+        return SimulatedTransport(peripheral)
+
+    processes, player_queues = start_processes(transportFactory, sink.address, engine, queue_backend,
+                                               capture_dir, num_workers, trace_dir=trace_dir,
+                                               decode_stage=decode_stage)
+    start = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - start
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    for player_queue in player_queues:
+        player_queue.close()
+        player_queue.unlink()
+
+    num_sent = sum(counter.value for counter in packet_counters.values())
+    sink.num_shots_sent = sum(counter.value for counter in shot_counters.values())
+    return num_sent / elapsed, sink, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run simulated Beetles through the whole relay pipeline')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run for')
+    parser.add_argument('--engine', choices=(BLE_ENGINE_THREADS, BLE_ENGINE_ASYNCIO), default=BLE_ENGINE)
+    parser.add_argument('--queue-backend', choices=('queue', 'shm'), default=QUEUE_BACKEND)
+    parser.add_argument('--fragment', type=float, default=0.0, help='probability of fragmenting a packet')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='probability of corrupting a packet')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability of losing a notification')
+    parser.add_argument('--stall', type=float, default=0.0, help='probability of a Beetle stalling')
+    parser.add_argument('--disconnect', type=float, default=0.0, help='probability of a Beetle disconnecting')
+    parser.add_argument('--connect-failure', type=float, default=0.0, help='probability of a connection attempt failing')
+    parser.add_argument('--seed', type=int, default=4002)
+    parser.add_argument('--workers', type=int, help='processes to shard the Beetles over, see topology.py')
+    parser.add_argument('--capture', metavar='DIR', help='record the notifications the relay receives to DIR')
+    parser.add_argument('--trace', metavar='DIR', help='trace a sample of the packets through the relay to DIR')
+    parser.add_argument('--wire-version', type=int, choices=range(1, WIRE_VERSION + 1), default=1,
+                        help='highest uplink format the stand-in data_server offers, see wire_v2.py')
+    parser.add_argument('--decode-stage', action='store_true',
+                        help='decode the notifications in a thread of their own, see decode_stage.py')
+    parser.add_argument('--beetle-protocol', type=int, choices=(1, link_v2.PROTOCOL_VERSION),
+                        default=link_v2.PROTOCOL_VERSION,
+                        help='highest protocol version the simulated Beetles speak, see link_v2.py')
+    parser.add_argument('--verbose', action='store_true', help="show the relay's own output")
+    args = parser.parse_args()
+
+    faults = SimulatedFaults(fragment_probability=args.fragment, corrupt_probability=args.corrupt,
+                             drop_probability=args.drop, stall_probability=args.stall,
+                             disconnect_probability=args.disconnect,
+                             connect_failure_probability=args.connect_failure)
+
+    # the relay logs to stderr
+    stdout, stderr = sys.stdout, sys.stderr
+    if not args.verbose:
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        sent_rate, sink, elapsed = runLoad(args.duration, faults, args.engine, args.queue_backend, args.seed,
+                                           args.capture, args.workers, args.wire_version, args.trace,
+                                           args.decode_stage, args.beetle_protocol)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    print(f'Beetle packets sent     : {sent_rate:.1f} packets/s')
+    print(f'Relay packets received  : {sink.num_packets / elapsed:.1f} packets/s ({sink.num_bytes / elapsed:.0f} B/s)')
+    print(f'Shots received          : {sink.num_shots_received} of {sink.num_shots_sent} sent')
+    if args.wire_version >= 3:
+        print(f'Shots in a motion window: {sink.num_shots_in_window}')
+    if sink.shot_latencies:
+        latencies = sorted(sink.shot_latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f'Shot latency            : p50 {statistics.median(latencies) * 1e3:.2f} ms, p99 {p99 * 1e3:.2f} ms')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# runs simulated Beetles through the thread-per-Beetle engine with each one decoding its own notifications, and with
+# a decode stage the I/O threads hand their notifications over to, and compares how long the I/O threads are busy
+# with a notification, how long it waits to be picked up, how long a packet takes to be enqueued, and the highest
+# rate every device keeps up with. run from the repository root: python -m benchmarks.bench_decode
+# the simulated transport sleeps until each notification is due, so the time a notification waits includes the
+# sleep overshooting, tens of microseconds, whichever way it is decoded
+import contextlib
+import io
+import statistics
+import threading
+import time
+
+from beetle import Beetle, BeetleDelegate
+from beetle_simulator import SimulatedBeetle, DEVICE_RATES
+from decode_stage import DecodeWorker
+from gatt_cache import GattCache
+from globals import IMU, EMITTER, RECEIVER, mac_dict, connected_beetles, device_dict
+from transport import SimulatedTransport
+
+DURATION = 3.0
+NUM_PLAYERS = 2
+# IMU rates the emitters and receivers are timed against, at their usual rate
+LATENCY_IMU_RATES = (DEVICE_RATES[IMU], 1000.0)
+# every device sends at each of these in turn to find the highest rate it keeps up with
+SWEEP_RATES = (4000.0, 8000.0, 16000.0, 32000.0, 64000.0)
+# a device keeps up if this much of what it sent was decoded
+KEPT_UP = 0.98
+
+
+# stands in for a player queue, timing each packet from when its notification was received
+class LatencyCollector:
+
+    def __init__(self):
+        self.latencies = {device_id: [] for device_id in device_dict}
+
+    def put(self, device_id, packet_attr, packet=None, receive_time=0.0, trace=None):
+        if packet is not None:
+            self.latencies[device_id].append(time.perf_counter() - receive_time)
+
+
+# times each notification from when the simulated Beetle sent it to when the I/O thread picks it up, and from then
+# to when the I/O thread is done with it
+class TimedDelegate:
+
+    def __init__(self, delegate, transport, wait_times, busy_times):
+        self.delegate = delegate
+        self.transport = transport
+        self.wait_times = wait_times
+        self.busy_times = busy_times
+
+    def handleNotification(self, cHandle, data):
+        start = time.perf_counter()
+        self.delegate.handleNotification(cHandle, data)
+        self.busy_times.append(time.perf_counter() - start)
+        self.wait_times.append(start - self.transport.notification_time)
+
+
+def makeBeetles(rates, collector, wait_times, busy_times, decode_worker):
+    connected_beetles[:] = [0] * len(connected_beetles)
+
+    beetles = []
+    for player_id in range(NUM_PLAYERS):
+        for device_id in (IMU, EMITTER, RECEIVER):
+            mac_address = f'00:00:00:00:0{player_id}:0{device_id}'
+            mac_dict.setdefault(mac_address, f'Simulated Beetle {player_id} {device_id}')
+
+            transport = SimulatedTransport(SimulatedBeetle(player_id, device_id, rates[device_id],
+                                                           seed=4 * player_id + device_id))
+            beetle = Beetle(mac_address, player_id, device_id, collector, transport)
+            # the handles of the simulated Beetles are kept out of the cache file
+            beetle.gatt_cache = GattCache(path=None)
+            beetle.setDelegate(TimedDelegate(BeetleDelegate(beetle), transport, wait_times[device_id],
+                                             busy_times[device_id]))
+            if decode_worker is not None:
+                decode_worker.attach(beetle)
+            beetles.append(beetle)
+    return beetles
+
+
+def run(rates, decode_stage):
+    collector = LatencyCollector()
+    wait_times = {device_id: [] for device_id in device_dict}
+    busy_times = {device_id: [] for device_id in device_dict}
+    decode_worker = DecodeWorker() if decode_stage else None
+    beetles = makeBeetles(rates, collector, wait_times, busy_times, decode_worker)
+    if decode_worker is not None:
+        decode_worker.start()
+
+    is_running = True
+
+    def beetleThread(beetle):
+        beetle.connect()
+        while is_running:
+            beetle.run()
+
+    threads = [threading.Thread(target=beetleThread, args=(beetle,)) for beetle in beetles]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        time.sleep(DURATION)
+        is_running = False
+        for thread in threads:
+            thread.join()
+    end = time.perf_counter()
+
+    # what was handed over still counts as kept up with once it is decoded
+    for beetle in beetles:
+        beetle.waitForDecodeStage()
+
+    kept_up = {device_id: True for device_id in device_dict}
+    for beetle in beetles:
+        expected = beetle.transport.peripheral.rate * (end - beetle.start_time) if beetle.start_time else 1
+        if beetle.num_packets_received < KEPT_UP * expected:
+            kept_up[beetle.device_id] = False
+    return wait_times, busy_times, collector.latencies, kept_up
+
+
+def percentiles(latencies):
+    if not latencies:
+        return float('nan'), float('nan')
+    latencies = sorted(latencies)
+    return statistics.median(latencies) * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6
+
+
+def main():
+    modes = (('inline', False), ('decode', True))
+
+    print('latency per device, with the emitters and receivers at their usual rate')
+    print('  wait: from being sent to the I/O thread picking it up, busy: the I/O thread handling it, enqueue: from '
+          'being picked up to being put in the player queue, all p50/p99 in us')
+    print(f'{"mode":<8}{"IMU Hz":>8}{"device":>10}{"wait":>16}{"busy":>16}{"enqueue":>16}')
+    for imu_rate in LATENCY_IMU_RATES:
+        for name, decode_stage in modes:
+            wait_times, busy_times, enqueue_times, _ = run({**DEVICE_RATES, IMU: imu_rate}, decode_stage)
+            for device_id in (IMU, EMITTER, RECEIVER):
+                columns = ''.join('%8.1f%8.1f' % percentiles(times[device_id])
+                                  for times in (wait_times, busy_times, enqueue_times))
+                print(f'{name:<8}{imu_rate:>8.0f}{device_dict[device_id]:>10}{columns}')
+
+    print()
+    print(f'highest rate every device of a kind kept up with, all {3 * NUM_PLAYERS} Beetles at the same rate')
+    print(f'{"mode":<8}' + ''.join(f'{device_dict[device_id]:>10}' for device_id in (IMU, EMITTER, RECEIVER)))
+    for name, decode_stage in modes:
+        # a kind of device that fell behind at a lower rate doesn't count as keeping up at a higher one
+        is_keeping_up = {device_id: True for device_id in device_dict}
+        highest = {device_id: 0.0 for device_id in device_dict}
+        for rate in SWEEP_RATES:
+            _, _, _, kept_up = run({device_id: rate for device_id in device_dict}, decode_stage)
+            for device_id in device_dict:
+                is_keeping_up[device_id] = is_keeping_up[device_id] and kept_up[device_id]
+                if is_keeping_up[device_id]:
+                    highest[device_id] = rate
+        print(f'{name:<8}' + ''.join(f'{highest[device_id]:>10.0f}' for device_id in (IMU, EMITTER, RECEIVER)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# measures the CPU the Ultra96 client burns while idle and the latency from a Beetle enqueueing a packet to the
+# client dequeueing it, for the busy-polling loop the client used to run and the blocking PacketQueueSelector
+# run from the repository root: python -m benchmarks.bench_dispatch
+import statistics
+import time
+from multiprocessing import Array, Process
+
+import packetize
+from constants import TPacketType
+from globals import IMU, PLAYER_ONE, PLAYER_TWO
+from packet_queue import PacketQueueSelector, createPacketQueue, QUEUE_BACKEND_PIPE, QUEUE_BACKEND_SHM
+
+IDLE_SECONDS = 2.0
+NUM_PACKETS = 500
+PACKET_INTERVAL = 0.004
+
+
+def producer(player_queue, player_id, send_times):
+    time.sleep(IDLE_SECONDS + 0.5)
+    for seqnum in range(NUM_PACKETS):
+        # the sequence number travels in the first gyro value so the consumer can look up when it was sent
+        packet_attr = (TPacketType.PACKET_TYPE_DATA.value, 0, player_id, IMU, 0, 0, seqnum, 0, 0, 0.0, 0.0, 0.0, b'\x00')
+        packet = packetize.serialize(packetize.detailsAsBytes(TPacketType.PACKET_TYPE_DATA.value, 0, player_id, IMU))
+        packet = bytearray(packet)
+        packet[1:3] = seqnum.to_bytes(2, 'little')
+        packet[packetize.CHECKSUM_POS] = 0
+        packet[packetize.CHECKSUM_POS] = packetize.getChecksum(packet)
+        send_times[seqnum] = time.perf_counter()
+        player_queue.put(IMU, packet_attr, packet, send_times[seqnum])
+        time.sleep(PACKET_INTERVAL)
+
+
+def busyPollWait(player_queues, selector):
+    while True:
+        for player_id, player_queue in player_queues.items():
+            if not player_queue.empty():
+                return [player_id]
+
+
+def selectorWait(player_queues, selector):
+    while True:
+        ready = selector.select()
+        if ready:
+            return ready
+
+
+def run(backend, wait):
+    player_queues = {PLAYER_ONE: createPacketQueue(backend), PLAYER_TWO: createPacketQueue(backend)}
+    selector = PacketQueueSelector(player_queues)
+    send_times = Array('d', NUM_PACKETS, lock=False)
+    process = Process(target=producer, args=(player_queues[PLAYER_ONE], PLAYER_ONE, send_times))
+    process.start()
+
+    # the producer stays quiet for IDLE_SECONDS, so the CPU time used until the first packet is pure overhead
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    latencies = []
+    idle_cpu = None
+    while len(latencies) < NUM_PACKETS:
+        for player_id in wait(player_queues, selector):
+            if idle_cpu is None:
+                idle_cpu = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+            player_queue = player_queues[player_id]
+            while not player_queue.empty():
+                packet = player_queue.get()[0]
+                latencies.append(time.perf_counter() - send_times[int.from_bytes(packet[1:3], 'little')])
+
+    process.join()
+    selector.close()
+    for player_queue in player_queues.values():
+        player_queue.close()
+        player_queue.unlink()
+
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1e6
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+    return idle_cpu * 100, p50, p99
+
+
+def main():
+    print(f'{"backend":<8}{"wait":<10}{"idle cpu %":>12}{"p50 us":>10}{"p99 us":>10}')
+    for backend in (QUEUE_BACKEND_PIPE, QUEUE_BACKEND_SHM):
+        for name, wait in (('poll', busyPollWait), ('select', selectorWait)):
+            idle_cpu, p50, p99 = run(backend, wait)
+            print(f'{backend:<8}{name:<10}{idle_cpu:>12.1f}{p50:>10.1f}{p99:>10.1f}')
+
+
+if __name__ == "__main__":
+    main()
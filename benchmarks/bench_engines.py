@@ -0,0 +1,122 @@
+# runs simulated Beetles through the thread-per-Beetle engine and the asyncio engine and compares throughput,
+# notification-to-enqueue latency and context switches. run from the repository root:
+# python -m benchmarks.bench_engines
+# the simulated transport has no file descriptor, so the asyncio engine sleeps until each notification is due and
+# epoll rounds those sleeps up to whole milliseconds. that rounding dominates its latency here, whereas bluepy
+# transports wake the loop through their helper process' pipe
+import asyncio
+import contextlib
+import io
+import resource
+import statistics
+import threading
+import time
+
+from async_engine import AsyncBeetleEngine
+from beetle import Beetle, BeetleDelegate
+from beetle_simulator import SimulatedBeetle
+from gatt_cache import GattCache
+from globals import mac_dict, connected_beetles
+from transport import SimulatedTransport
+
+DURATION = 5.0
+DEVICE_COUNTS = (6, 12, 24)
+
+
+# stands in for a player queue, timing each packet from when the simulated Beetle sent it
+class LatencyCollector:
+
+    def __init__(self):
+        self.transports = {}
+        self.latencies = []
+
+    def put(self, device_id, packet_attr, packet=None, receive_time=0.0, trace=None):
+        transport = self.transports.get((packet_attr[2], device_id, threading.get_ident()))
+        if transport is None or packet is None:
+            return
+        self.latencies.append(time.perf_counter() - transport.notification_time)
+
+
+def makeBeetles(num_devices, collector):
+    connected_beetles[:] = [0] * len(connected_beetles)
+
+    beetles = []
+    for i in range(num_devices):
+        player_id = (i // 3) % 2
+        device_id = i % 3 + 1
+        mac_address = f'00:00:00:00:00:{i:02x}'
+        mac_dict.setdefault(mac_address, f'Simulated Beetle {i}')
+
+        transport = SimulatedTransport(SimulatedBeetle(player_id, device_id, seed=i))
+        beetle = Beetle(mac_address, player_id, device_id, collector, transport)
+        # the handles of the simulated Beetles are kept out of the cache file
+        beetle.gatt_cache = GattCache(path=None)
+        beetle.setDelegate(BeetleDelegate(beetle))
+        beetles.append(beetle)
+    return beetles
+
+
+def runThreads(beetles, collector):
+    is_running = True
+
+    def beetleThread(beetle):
+        collector.transports[(beetle.player_id, beetle.device_id, threading.get_ident())] = beetle.transport
+        beetle.connect()
+        while is_running:
+            beetle.run()
+
+    threads = [threading.Thread(target=beetleThread, args=(beetle,)) for beetle in beetles]
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    is_running = False
+    for thread in threads:
+        thread.join()
+
+
+def runAsyncio(beetles, collector):
+    # every Beetle is handled on the event loop thread, so packets are matched to transports by player and device
+    # which is ambiguous beyond six Beetles, so only the first Beetle of each kind is timed
+    engine = AsyncBeetleEngine(beetles)
+    for beetle in reversed(beetles):
+        collector.transports[(beetle.player_id, beetle.device_id, threading.get_ident())] = beetle.transport
+
+    async def runFor():
+        try:
+            await asyncio.wait_for(engine.runBeetles(), DURATION)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(runFor())
+    engine.executor.shutdown()
+
+
+def measure(run, num_devices):
+    collector = LatencyCollector()
+    beetles = makeBeetles(num_devices, collector)
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(beetles, collector)
+    cpu = time.process_time() - cpu_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    num_packets = sum(beetle.num_packets_received for beetle in beetles)
+    switches = (usage_end.ru_nvcsw - usage_start.ru_nvcsw) + (usage_end.ru_nivcsw - usage_start.ru_nivcsw)
+    latencies = sorted(collector.latencies)
+    p50 = statistics.median(latencies) * 1e6 if latencies else float('nan')
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6 if latencies else float('nan')
+    return num_packets / DURATION, cpu / DURATION * 100, switches / DURATION, p50, p99
+
+
+def main():
+    print(f'{"engine":<10}{"beetles":>8}{"packets/s":>11}{"cpu %":>8}{"ctx sw/s":>10}{"p50 us":>9}{"p99 us":>9}')
+    for num_devices in DEVICE_COUNTS:
+        for name, run in (('threads', runThreads), ('asyncio', runAsyncio)):
+            rate, cpu, switches, p50, p99 = measure(run, num_devices)
+            print(f'{name:<10}{num_devices:>8}{rate:>11.0f}{cpu:>8.1f}{switches:>10.0f}{p50:>9.0f}{p99:>9.0f}')
+
+
+if __name__ == "__main__":
+    main()
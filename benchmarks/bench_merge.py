@@ -0,0 +1,145 @@
+# feeds a player's records to the Ultra96 client in the order they would come out of the player queue, with and
+# without putting them back in the order they were received, and compares where in the IMU windows each shot is
+# placed with where it would be if every record had come out in order, along with the time the client spends on a
+# record. run from the repository root: python -m benchmarks.bench_merge
+import random
+import time
+
+import packetize
+from beetle_simulator import SimulatedBeetle
+from constants import TPacketType
+from globals import IMU, EMITTER, RECEIVER, PLAYER_ONE
+from packet_queue import createPacketQueue, QUEUE_BACKEND_PIPE
+from ultra96_client import Ultra96Client
+from wire_v2 import SHOT_RECORD, RECORD_SHOT
+
+DURATION = 20.0
+# the IMU at the full rate the relay is meant to keep up with
+IMU_RATE = 1000.0
+SHOTS_PER_SECOND = 2.0
+# from a notification being received to its record being in the player queue, plus an exponential tail
+MIN_TRANSIT = 0.0002
+MEAN_EXTRA_TRANSIT = 0.001
+# how often the client wakes up to the records that arrived since, handling the control lane first
+WAKEUP_INTERVAL = 0.004
+REORDER_DELAYS = (None, 0.002, 0.005, 0.01)
+
+
+# keeps the records written to it, standing in for the uplink
+class RecordingUplink:
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, data, urgent=False):
+        self.records.append(data)
+
+    def addTrace(self, trace):
+        pass
+
+    def timeUntilDeadline(self):
+        return None
+
+    def flushIfDue(self):
+        pass
+
+    # (window sequence number, offset) of every shot, in the order they were sent
+    def shotPlacements(self):
+        return [tuple(SHOT_RECORD.unpack(record)[2:]) for record in self.records if record[0] == RECORD_SHOT]
+
+
+def shotPacket(device_id):
+    details = packetize.detailsAsBytes(TPacketType.PACKET_TYPE_DATA.value, 0, PLAYER_ONE, device_id)[0]
+    details |= packetize.SEND_SHOT_MASK if device_id == EMITTER else packetize.RECEIVE_SHOT_MASK
+    return packetize.serialize(bytes((details,)))
+
+
+# (receive time, arrival time, device id, record) of every record of the player, by arrival time
+def makeRecords(rng):
+    imu = SimulatedBeetle(PLAYER_ONE, IMU, IMU_RATE, seed=4002)
+    received = [(i / IMU_RATE, IMU, imu.makePacket(TPacketType.PACKET_TYPE_DATA, 0.0))
+                for i in range(int(DURATION * IMU_RATE))]
+    for device_id in (EMITTER, RECEIVER):
+        packet = shotPacket(device_id)
+        received += [(rng.uniform(0, DURATION), device_id, packet)
+                     for _ in range(int(DURATION * SHOTS_PER_SECOND))]
+    received.sort(key=lambda received_record: received_record[0])
+
+    # each Beetle's records arrive in the order they were received
+    records = []
+    last_arrival = {device_id: 0.0 for device_id in (IMU, EMITTER, RECEIVER)}
+    for receive_time, device_id, packet in received:
+        arrival_time = max(last_arrival[device_id],
+                           receive_time + MIN_TRANSIT + rng.expovariate(1 / MEAN_EXTRA_TRANSIT))
+        last_arrival[device_id] = arrival_time
+        records.append((receive_time, arrival_time, device_id, (packet, 0, device_id, receive_time, None)))
+    records.sort(key=lambda record: record[1])
+    return records
+
+
+# the records as the client gets them at each wakeup: those that arrived since the last one, control lane first
+def wakeups(records):
+    batch = []
+    wakeup_time = WAKEUP_INTERVAL
+    for record in records:
+        while record[1] > wakeup_time:
+            yield wakeup_time, sorted(batch, key=lambda queued: queued[2] == IMU)
+            batch = []
+            wakeup_time += WAKEUP_INTERVAL
+        batch.append(record)
+    yield wakeup_time, sorted(batch, key=lambda queued: queued[2] == IMU)
+    # a last wakeup once everything is due
+    yield float('inf'), []
+
+
+# the records are handed to the client directly, so its queue is never used and its shared memory can go straight away
+def makeClient(reorder_delay):
+    player_queue = createPacketQueue(QUEUE_BACKEND_PIPE)
+    player_queue.unlink()
+    client = Ultra96Client([player_queue], ('localhost', 0), reorder_delay=reorder_delay)
+    client.wire_version = 3
+    return client
+
+
+# returns the shots' placements and the seconds spent per record
+def run(records, reorder_delay, in_receive_order=False):
+    client = makeClient(reorder_delay)
+    uplink = RecordingUplink()
+    if in_receive_order:
+        batches = [(float('inf'), sorted(records))]
+    else:
+        batches = wakeups(records)
+
+    elapsed = 0.0
+    for wakeup_time, batch in batches:
+        start = time.perf_counter()
+        for _, _, _, record in batch:
+            client.handleRecord(uplink, PLAYER_ONE, record)
+        if client.mergers:
+            client.releaseRecords(uplink, wakeup_time)
+        client.sendWindows(uplink)
+        elapsed += time.perf_counter() - start
+    return uplink.shotPlacements(), elapsed / len(records)
+
+
+def main():
+    records = makeRecords(random.Random(4002))
+    expected, _ = run(records, None, in_receive_order=True)
+    num_in_window = sum(1 for _, offset in expected if offset >= 0)
+    print(f'{len(records)} records over {DURATION:.0f} s, IMU at {IMU_RATE:.0f} Hz, {len(expected)} shots, '
+          f'{num_in_window} of them in a motion window')
+    print(f'{"reorder delay":>14}{"placed right":>14}{"in window right":>17}{"us/record":>11}')
+    for reorder_delay in REORDER_DELAYS:
+        placements, per_record = run(records, reorder_delay)
+        # unmerged, shots go out in the order they are handled rather than received, so only compare where they land
+        wanted = expected
+        if reorder_delay is None:
+            placements, wanted = sorted(placements), sorted(expected)
+        right = [want for got, want in zip(placements, wanted) if got == want]
+        num_in_window_right = sum(1 for _, offset in right if offset >= 0)
+        name = 'off' if reorder_delay is None else f'{reorder_delay * 1e3:.0f} ms'
+        print(f'{name:>14}{len(right):>8} of {len(expected):<4}{num_in_window_right:>10} of {num_in_window:<5}'
+              f'{per_record * 1e6:>10.2f}')
+
+if __name__ == "__main__":
+    main()
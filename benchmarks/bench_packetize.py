@@ -0,0 +1,112 @@
+# compares the per-packet decode path used before decodeBatch existed with the current decoders
+# run from the repository root: python -m benchmarks.bench_packetize
+import contextlib
+import io
+import random
+import struct
+import timeit
+
+import packetize
+from constants import TPacketType
+
+NUM_PACKETS = 1000
+REPEATS = 5
+
+
+def legacyGetChecksum(byte_seq):
+    checksum = b'\x00'[0]
+    for b in byte_seq:
+        checksum ^= b
+    return checksum
+
+
+def legacyInterpretDetails(details):
+    packet_type = details >> packetize.PACKET_TYPE_SHIFT
+    seqnum = (details & packetize.SEQNUM_MASK) >> packetize.SEQNUM_SHIFT
+    player_id = (details & packetize.PLAYER_ID_MASK) >> packetize.PLAYER_ID_SHIFT
+    device_id = (details & packetize.DEVICE_ID_MASK) >> packetize.DEVICE_ID_SHIFT
+
+    sent_shot = (details & packetize.SEND_SHOT_MASK) >> packetize.SEND_SHOT_SHIFT
+    if sent_shot:
+        print("Fired a shot!\n")
+
+    received_shot = (details & packetize.RECEIVE_SHOT_MASK) >> packetize.RECEIVE_SHOT_SHIFT
+    if received_shot:
+        print("Received a shot!\n")
+
+    return packet_type, seqnum, player_id, device_id, sent_shot, received_shot
+
+
+def legacyDeserialize(packet):
+    packet_attr = struct.unpack('<c3h3fc', packet)
+    details = legacyInterpretDetails(packet_attr[0][0])
+    return details + packet_attr[1:]
+
+
+def legacyIsInvalidPacket(data):
+    packet_type = data[0] >> packetize.PACKET_TYPE_SHIFT
+    if packet_type not in [TPacketType.PACKET_TYPE_ACK.value, TPacketType.PACKET_TYPE_DATA.value]:
+        return True
+    return legacyGetChecksum(data) != 0
+
+
+def makePacket(device_id, rng):
+    details = packetize.detailsAsBytes(TPacketType.PACKET_TYPE_DATA.value, rng.randint(0, 1), 0, device_id)[0]
+    if device_id == 2:
+        details |= rng.randint(0, 1) << packetize.SEND_SHOT_SHIFT
+    elif device_id == 3:
+        details |= rng.randint(0, 1) << packetize.RECEIVE_SHOT_SHIFT
+
+    gyro = [rng.randint(-32768, 32767) for _ in range(3)] if device_id == 1 else [0] * 3
+    accel = [rng.uniform(-2.0, 2.0) for _ in range(3)] if device_id == 1 else [0.0] * 3
+    packet = bytearray(struct.pack('<B3h3fB', details, *gyro, *accel, 0))
+    packet[packetize.CHECKSUM_POS] = packetize.getChecksum(packet[:packetize.CHECKSUM_POS])
+    return bytes(packet)
+
+
+def makePackets(num_packets):
+    rng = random.Random(4002)
+    # the IMU dominates the traffic, the emitter and receiver only send the odd packet
+    return [makePacket(rng.choices((1, 2, 3), weights=(8, 1, 1))[0], rng) for _ in range(num_packets)]
+
+
+def legacyPath(packets):
+    for packet in packets:
+        if not legacyIsInvalidPacket(packet):
+            legacyDeserialize(packet)
+
+
+def singlePath(packets):
+    for packet in packets:
+        if not packetize.isInvalidPacket(packet):
+            packetize.deserialize(packet)
+
+
+def batchPath(buffer):
+    packetize.decodeBatch(buffer)
+
+
+def nsPerPacket(func, arg, num_packets):
+    best = min(timeit.repeat(lambda: func(arg), number=1, repeat=REPEATS))
+    return best / num_packets * 1e9
+
+
+def main():
+    packets = makePackets(NUM_PACKETS)
+    buffer = b''.join(packets)
+
+    # the legacy path prints on every shot bit, so its output is swallowed rather than timing the terminal
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy = nsPerPacket(legacyPath, packets, NUM_PACKETS)
+    single = nsPerPacket(singlePath, packets, NUM_PACKETS)
+
+    print(f'{"path":<28}{"ns/packet":>12}{"speedup":>10}')
+    print(f'{"legacy validate+deserialize":<28}{legacy:>12.1f}{1.0:>10.2f}')
+    print(f'{"validate+deserialize":<28}{single:>12.1f}{legacy / single:>10.2f}')
+    for batch_size in (1, 10, 100, NUM_PACKETS):
+        batch = nsPerPacket(batchPath, buffer[:batch_size * packetize.PACKET_SIZE], batch_size)
+        print(f'{f"decodeBatch x{batch_size}":<28}{batch:>12.1f}{legacy / batch:>10.2f}')
+
+
+if __name__ == "__main__":
+    main()
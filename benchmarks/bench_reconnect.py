@@ -0,0 +1,54 @@
+# compares the time from connecting to a Beetle to its first data packet with and without the GATT handle cache,
+# over a simulated link whose requests take a BLE round trip. run from the repository root:
+# python -m benchmarks.bench_reconnect
+import statistics
+
+from beetle import Beetle, BeetleDelegate
+from beetle_simulator import SimulatedBeetle
+from gatt_cache import GattCache
+from globals import BEETLE_ADDRESSES, IMU, PLAYER_ONE
+from transport import SimulatedTransport
+
+NUM_CONNECTS = 20
+# a 7.5 ms connection interval, with the response in the next one
+ROUND_TRIP = 0.015
+
+
+# puts nothing anywhere, only the time to the first packet is of interest
+class DiscardQueue:
+
+    def put(self, device_id, packet_attr, packet=None, receive_time=0.0, trace=None):
+        pass
+
+
+def run(use_cache):
+    transport = SimulatedTransport(SimulatedBeetle(PLAYER_ONE, IMU, seed=4002), ROUND_TRIP)
+    beetle = Beetle(BEETLE_ADDRESSES[PLAYER_ONE][0], PLAYER_ONE, IMU, DiscardQueue(), transport)
+    beetle.setDelegate(BeetleDelegate(beetle))
+    beetle.gatt_cache = GattCache(path=None)
+
+    times = []
+    for _ in range(NUM_CONNECTS):
+        if not use_cache:
+            beetle.gatt_cache.invalidate(beetle.mac_address)
+
+        beetle.connect()
+        while not beetle.start_time:
+            beetle.waitForNotifications()
+        times.append(beetle.start_time - beetle.connect_start_time)
+        beetle.disconnect()
+
+    # the very first connection has nothing cached either way
+    return times[1:]
+
+
+def main():
+    print(f'{"cache":<8}{"mean ms":>10}{"p50 ms":>10}{"max ms":>10}')
+    for use_cache in (False, True):
+        times = run(use_cache)
+        print(f'{"on" if use_cache else "off":<8}{statistics.mean(times) * 1e3:>10.1f}'
+              f'{statistics.median(times) * 1e3:>10.1f}{max(times) * 1e3:>10.1f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# compares sending every relay packet with its own sendall against batching them through an UplinkWriter
+# over a local TCP connection. run from the repository root: python -m benchmarks.bench_uplink
+import socket
+import threading
+import time
+
+import numpy as np
+
+from relay_packet import packWindow
+from uplink import UplinkReader, UplinkWriter
+
+NUM_PACKETS = 20000
+
+
+def makePacketBytes():
+    return packWindow(0, np.array([[0.5, -0.25, 1.0, 10.0, -2.0, 5.0]], dtype=np.float32))
+
+
+def drain(conn, framed, counts):
+    reader = UplinkReader(conn, framed)
+    while True:
+        packets = reader.readPackets()
+        if not packets:
+            return
+        counts[0] += len(packets)
+
+
+def run(send, framed):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(('localhost', 0))
+        server.listen(1)
+        client = socket.create_connection(server.getsockname())
+        conn, _ = server.accept()
+        counts = [0]
+        reader_thread = threading.Thread(target=drain, args=(conn, framed, counts))
+        reader_thread.start()
+
+        packet_bytes = makePacketBytes()
+        start = time.perf_counter()
+        syscalls = send(client, packet_bytes)
+        elapsed = time.perf_counter() - start
+
+        client.close()
+        reader_thread.join()
+        conn.close()
+
+    assert counts[0] == NUM_PACKETS
+    return NUM_PACKETS / elapsed, syscalls
+
+
+def sendEach(sock, packet_bytes):
+    for _ in range(NUM_PACKETS):
+        sock.sendall(packet_bytes)
+    return NUM_PACKETS
+
+
+def sendBatched(framed):
+    def send(sock, packet_bytes):
+        uplink = UplinkWriter(sock, framed=framed)
+        for _ in range(NUM_PACKETS):
+            uplink.write(packet_bytes)
+            uplink.flushIfDue()
+        uplink.flush()
+        return uplink.num_frames_sent
+    return send
+
+
+def main():
+    print(f'{"writer":<18}{"packets/s":>12}{"send calls":>12}')
+    for name, send, framed in (('sendall each', sendEach, False),
+                               ('batched', sendBatched(False), False),
+                               ('batched framed', sendBatched(True), True)):
+        rate, syscalls = run(send, framed)
+        print(f'{name:<18}{rate:>12.0f}{syscalls:>12}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+# times every per-packet stage of the relay and checks the results against benchmarks/baseline.json, exiting
+# with 1 if any stage got slower, allocates more or needs more memory than the baseline allows
+# run from the repository root: python -m benchmarks.suite [--update-baseline]
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from multiprocessing import Pipe, Process
+
+import link_v2
+import packetize
+from beetle import Beetle
+from benchmarks.bench_packetize import makePacket, makePackets
+from globals import IMU, PLAYER_ONE, MERGE_REORDER_DELAY
+from packet_queue import createPacketQueue, QUEUE_BACKEND_PIPE, QUEUE_BACKEND_SHM
+from motion_window import WINDOW_SIZE
+from relay_packet import decodeImuSamples, packWindow
+from ultra96_client import Ultra96Client
+from uplink import UplinkWriter
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+NUM_PACKETS = 20000
+# packets traced for allocations, tracemalloc being too slow to run over the whole batch
+NUM_TRACED_PACKETS = 500
+REPEATS = 5
+
+# a stage regresses if it is this much worse than the baseline
+TOLERANCE = 0.25
+# differences this small are noise whatever the tolerance says
+MIN_NS_DIFFERENCE = 50
+MIN_ALLOC_DIFFERENCE = 16
+
+
+# a player queue that keeps nothing, so the Beetle stages measure the Beetle alone
+class DiscardQueue:
+
+    def put(self, device_id, packet_attr, packet=None, receive_time=0.0, trace=None):
+        pass
+
+
+# the Beetle stages never write to the Beetle, so it only needs a transport to be constructed
+class IdleTransport:
+    pass
+
+
+def makeBeetle():
+    beetle = Beetle('00:00:00:00:00:00', PLAYER_ONE, IMU, DiscardQueue(), IdleTransport())
+    beetle.handshake_done = True
+    return beetle
+
+
+# every stage is set up by a function returning (function handling one item, the items to hand it), an item being a
+# packet or, for the stages working on a batch of them at a time, a batch the same size every time
+
+def setupGetChecksum(packets):
+    return packetize.getChecksum, packets
+
+
+def setupIsInvalidPacket(packets):
+    return packetize.isInvalidPacket, packets
+
+
+def setupDeserialize(packets):
+    return packetize.deserialize, packets
+
+
+def setupInterpretDetails(packets):
+    return packetize.interpretDetails, [packet[0] for packet in packets]
+
+
+# a Beetle's reassembler only takes its own packets, so it is handed as many of the IMU's
+def setupCheckBuffer(packets):
+    rng = random.Random(4002)
+    return makeBeetle().checkBuffer, [makePacket(IMU, rng) for _ in packets]
+
+
+def setupHandleData(packets):
+    return makeBeetle().handleData, packets
+
+
+# the packets numbered the way a version 2 IMU numbers them, so each one is checked against the one before
+def setupHandleDataV2(packets):
+    beetle = makeBeetle()
+    beetle.protocol_version = 2
+    numbered = []
+    for seq, packet in enumerate(packets):
+        packet = bytearray(packet)
+        packet[0] = packet[0] & ~(packetize.SEQNUM_MASK | link_v2.SHOT_MASK) | link_v2.imuSequenceBits(seq)
+        numbered.append(bytes(packet))
+    return beetle.handleData, numbered
+
+
+# the IMU packets as the Ultra96 client decodes them, a wakeup's worth at a time
+def setupDecodeImuSamples(packets):
+    return decodeImuSamples, [b''.join(packets[start:start + CLIENT_WAKEUP_PACKETS])
+                              for start in range(0, len(packets), CLIENT_WAKEUP_PACKETS)]
+
+
+def setupPackWindow(packets):
+    samples = decodeImuSamples(b''.join(packets))
+
+    def pack(window):
+        packWindow(PLAYER_ONE, window)
+    return pack, [samples[start:start + WINDOW_SIZE] for start in range(0, len(samples), WINDOW_SIZE)]
+
+
+# the records come straight from memory, so the stage measures the Ultra96 client rather than a queue hop. windows
+# are sent every CLIENT_WAKEUP_PACKETS records, as if the client had woken up to that many
+CLIENT_WAKEUP_PACKETS = 16
+
+
+def setupHandleRecordAndSend(packets, reorder_delay=None):
+    server = socket.create_server(('localhost', 0))
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    threading.Thread(target=drain, args=(conn,), daemon=True).start()
+
+    uplink = UplinkWriter(client)
+    # the queue is never read, so its shared memory can go straight away
+    player_queue = createPacketQueue(QUEUE_BACKEND_PIPE)
+    player_queue.unlink()
+    ultra96_client = Ultra96Client([player_queue], ('localhost', 0), reorder_delay=reorder_delay)
+    records = [(bytes(packet), 0, packetize.DETAILS_TABLE[packet[0]][3], 0.0, None) for packet in packets]
+    num_handled = [0]
+
+    def handleRecordAndSend(record):
+        ultra96_client.handleRecord(uplink, PLAYER_ONE, record)
+        num_handled[0] += 1
+        if num_handled[0] % CLIENT_WAKEUP_PACKETS == 0:
+            if ultra96_client.mergers:
+                ultra96_client.releaseRecords(uplink)
+            ultra96_client.sendWindows(uplink)
+            uplink.flushIfDue()
+    return handleRecordAndSend, records
+
+
+# the records all have the same receive time, long past, so every wakeup releases all of them and the stage measures
+# what the merge adds to the client rather than the reorder delay
+def setupHandleRecordAndSendMerged(packets):
+    return setupHandleRecordAndSend(packets, MERGE_REORDER_DELAY)
+
+
+def drain(conn):
+    while conn.recv(65536):
+        pass
+
+
+STAGES = {
+    'packetize.getChecksum': setupGetChecksum,
+    'packetize.isInvalidPacket': setupIsInvalidPacket,
+    'packetize.deserialize': setupDeserialize,
+    'packetize.interpretDetails': setupInterpretDetails,
+    'Beetle.checkBuffer': setupCheckBuffer,
+    'Beetle.handleData': setupHandleData,
+    'Beetle.handleData (protocol v2)': setupHandleDataV2,
+    'relay_packet.decodeImuSamples': setupDecodeImuSamples,
+    'relay_packet.packWindow': setupPackWindow,
+    'Ultra96Client.handleRecord+sendWindows': setupHandleRecordAndSend,
+    'Ultra96Client (records merged)': setupHandleRecordAndSendMerged,
+}
+
+
+def timeStage(handle, items):
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter_ns()
+        for item in items:
+            handle(item)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(items)
+
+
+# bytes allocated per packet, including those freed again before the next packet
+def traceStage(handle, items):
+    items = items[:NUM_TRACED_PACKETS]
+    total = 0
+    tracemalloc.start()
+    for item in items:
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        handle(item)
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / len(items)
+
+
+def runStage(name, num_packets):
+    packets = makePackets(num_packets)
+    handle, items = STAGES[name](packets)
+    # warm up, e.g. so the reassembler has grown its buffer before anything is measured
+    for item in items[:NUM_TRACED_PACKETS]:
+        handle(item)
+    items_per_packet = len(items) / len(packets)
+    return {'ns_per_packet': timeStage(handle, items) * items_per_packet,
+            'alloc_bytes_per_packet': traceStage(handle, items) * items_per_packet}
+
+
+# packets are put in bursts, each one only after the consumer has emptied the queue, since the IMU lanes shed
+# packets once full rather than block. the lanes are made to hold a whole burst
+QUEUE_BURST = 1024
+# the queue hop shares the CPUs with a second process, so it is the noisiest stage
+QUEUE_REPEATS = 3
+
+
+def queueProducer(player_queue, packets, packet_attrs):
+    for start in range(0, len(packets), QUEUE_BURST):
+        # depth also counts packets a multiprocessing.Queue hasn't flushed to its pipe yet, which empty doesn't. the
+        # wait yields so the Queue's feeder threads can do the flushing
+        while player_queue.depth():
+            time.sleep(0)
+        for packet_attr, packet in zip(packet_attrs[start:start + QUEUE_BURST], packets[start:start + QUEUE_BURST]):
+            player_queue.put(packet_attr[3], packet_attr, packet, 0.0)
+
+
+# time from the first put in the Beetle process to the last get in the Ultra96 client process, per packet
+def runQueueHop(backend, num_packets):
+    packets = makePackets(num_packets)
+    packet_attrs = [packetize.deserialize(packet) for packet in packets]
+    player_queue = createPacketQueue(backend, imu_lane_capacity=QUEUE_BURST)
+
+    best = None
+    for _ in range(QUEUE_REPEATS):
+        producer = Process(target=queueProducer, args=(player_queue, packets, packet_attrs))
+        start = time.perf_counter_ns()
+        producer.start()
+        num_received = 0
+        while num_received < num_packets:
+            if player_queue.empty():
+                continue
+            player_queue.get()
+            num_received += 1
+        elapsed = time.perf_counter_ns() - start
+        producer.join()
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    for packet_attr, packet in zip(packet_attrs[:NUM_TRACED_PACKETS], packets):
+        player_queue.put(packet_attr[3], packet_attr, packet, 0.0)
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    for _ in range(NUM_TRACED_PACKETS):
+        while player_queue.empty():
+            pass
+        player_queue.get()
+    alloc = (tracemalloc.get_traced_memory()[1] - before) / NUM_TRACED_PACKETS
+    tracemalloc.stop()
+
+    player_queue.close()
+    player_queue.unlink()
+    return {'ns_per_packet': best / num_packets, 'alloc_bytes_per_packet': alloc}
+
+
+QUEUE_STAGES = {
+    'queue hop (queue)': QUEUE_BACKEND_PIPE,
+    'queue hop (shm)': QUEUE_BACKEND_SHM,
+}
+
+
+def stageProcess(name, num_packets, conn):
+    if name in QUEUE_STAGES:
+        result = runQueueHop(QUEUE_STAGES[name], num_packets)
+    else:
+        result = runStage(name, num_packets)
+    # kilobytes on Linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send(result)
+    conn.close()
+
+
+# every stage runs in a process of its own, so one stage's garbage and peak memory don't count against the next
+def runSuite(names, num_packets):
+    results = {}
+    for name in names:
+        parent_conn, child_conn = Pipe(duplex=False)
+        process = Process(target=stageProcess, args=(name, num_packets, child_conn))
+        process.start()
+        results[name] = parent_conn.recv()
+        process.join()
+    return results
+
+
+def findRegressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+
+        limits = {
+            'ns_per_packet': max(expected['ns_per_packet'] * (1 + tolerance),
+                                 expected['ns_per_packet'] + MIN_NS_DIFFERENCE),
+            'alloc_bytes_per_packet': max(expected['alloc_bytes_per_packet'] * (1 + tolerance),
+                                          expected['alloc_bytes_per_packet'] + MIN_ALLOC_DIFFERENCE),
+            'peak_rss_kb': expected['peak_rss_kb'] * (1 + tolerance),
+        }
+        for metric, limit in limits.items():
+            if result[metric] > limit:
+                regressions.append((name, metric, expected[metric], result[metric]))
+    return regressions
+
+
+def printResults(results, baseline):
+    print(f'{"stage":<40}{"ns/packet":>12}{"baseline":>12}{"B/packet":>10}{"baseline":>10}{"peak RSS kB":>13}')
+    for name, result in results.items():
+        expected = baseline.get(name, {})
+        print(f'{name:<40}{result["ns_per_packet"]:>12.0f}{expected.get("ns_per_packet", float("nan")):>12.0f}'
+              f'{result["alloc_bytes_per_packet"]:>10.0f}{expected.get("alloc_bytes_per_packet", float("nan")):>10.0f}'
+              f'{result["peak_rss_kb"]:>13}')
+
+
+def main():
+    stage_names = list(STAGES) + list(QUEUE_STAGES)
+
+    parser = argparse.ArgumentParser(description='Benchmark every per-packet stage of the relay')
+    parser.add_argument('--stages', nargs='+', choices=stage_names, default=stage_names, metavar='STAGE')
+    parser.add_argument('--packets', type=int, default=NUM_PACKETS, help='packets run through every stage')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slowdown, e.g. 0.25 for 25%%')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    results = runSuite(args.stages, args.packets)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'num_packets': args.packets,
+        'stages': results,
+    }
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['stages']
+
+    printResults(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.update_baseline:
+        # stages left out of this run keep their old baseline
+        report['stages'] = {**baseline, **results}
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f'Baseline written to {args.baseline}')
+        return
+
+    regressions = findRegressions(results, baseline, args.tolerance)
+    for name, metric, expected, actual in regressions:
+        print(f'REGRESSION {name}: {metric} {actual:.0f} against a baseline of {expected:.0f}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,81 +1,180 @@
-from bluepy.btle import BTLEException
 from beetle import Beetle, BeetleDelegate
+from transport import TransportError
 from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import Queue, Process
+from multiprocessing import Process
+from packet_queue import createPacketQueue
+from async_engine import AsyncBeetleEngine
+from connection_manager import ConnectionManager
+from heartbeat import HeartbeatMonitor
+from capture import openCapture
+from decode_stage import startDecodeWorker
+import metrics
+import startup
+import logging
+from relay_log import setupLogging, dumpOnCrash
 from ultra96_client import Ultra96Client
-from globals import p1_connected_beetles, p2_connected_beetles, BEETLE_ADDRESSES, mac_dict, PLAYER_ONE, PLAYER_TWO, is_connected_to_u96
+from globals import connected_beetles, mac_dict, is_connected_to_u96, NUM_PLAYERS, QUEUE_BACKEND, BLE_ENGINE, BLE_ENGINE_ASYNCIO, BEETLE_WORKERS, CAPTURE_DIR, WARM_START, TRACE_DIR, TRACE_SAMPLE_EVERY, DECODE_STAGE
+from topology import beetleSpecs, shardBeetles, shardByPlayer
 import time
 
-PLAYER_ONE_BEETLES = BEETLE_ADDRESSES[0]
-PLAYER_TWO_BEETLES = BEETLE_ADDRESSES[1]
-
-
-def beetle_thread(beetle_address, player_id, device_id, player_queue):
-    beetle = Beetle(beetle_address, player_id, device_id, player_queue)
-    beetle.setDelegate(BeetleDelegate(beetle))
-
-    print(f"Connecting to Beetle - {mac_dict[beetle_address]}")
-    while True:
-        try:
-            beetle.connect()
-            break
-        except BTLEException as e:
-            print(f"Failed to connect - {mac_dict[beetle_address]}, retrying")
-            time.sleep(1)
-            continue
-
-    while True:
-        try:
-            while True:
-                beetle.run()
-                print(f'P1: {p1_connected_beetles.value} beetles , P2: {p2_connected_beetles.value} beetles')
-        except BTLEException as e:
-            print(f'Beetle disconnected - {mac_dict[beetle_address]}')
-            beetle.disconnect()
-            beetle.reconnect()
-        except KeyboardInterrupt as kbi:
-            print(f"Exiting - {mac_dict[beetle_address]}")
-            beetle.disconnect()
-            exit()           
-
+logger = logging.getLogger(__name__)
+
+
+# trace_every traces every trace_every-th packet the Beetle enqueues, see tracing.py, or none with 0
+# decode_worker is the DecodeWorker the Beetle hands its notifications over to, see decode_stage.py, if any
+def makeBeetle(spec, player_queues, transport_factory=None, capture=None, trace_every=0, decode_worker=None):
+    transport = transport_factory(spec.mac_address, spec.player_id, spec.device_id) if transport_factory else None
+    beetle = Beetle(spec.mac_address, spec.player_id, spec.device_id, player_queues[spec.player_id], transport,
+                    spec.adapter)
+    beetle.trace_every = trace_every
+    beetle.setDelegate(BeetleDelegate(beetle, capture))
+    if decode_worker is not None:
+        decode_worker.attach(beetle)
+    return beetle
+
+
+# transport_factory(beetle_address, player_id, device_id) returns the transport for a Beetle, e.g. a simulated one
+def beetle_thread(spec, player_queues, transport_factory=None, connection_manager=None, heartbeat_monitor=None,
+                  capture=None, trace_every=0, decode_worker=None):
+    with dumpOnCrash():
+        beetle = makeBeetle(spec, player_queues, transport_factory, capture, trace_every, decode_worker)
+        beetle_address = spec.mac_address
+
+        if connection_manager is None:
+            connection_manager = ConnectionManager()
+        connection = connection_manager.register(beetle)
+        if heartbeat_monitor is not None:
+            heartbeat_monitor.register(beetle)
+
+        logger.info('Connecting to Beetle on hci%d - %s', spec.adapter, mac_dict[beetle_address])
+        connection_manager.connect(connection)
+
+        while True:
+            try:
+                while True:
+                    beetle.run()
+                    logger.debug('Beetles connected per player: %s', list(connected_beetles), extra={'sample': 100})
+            except TransportError as e:
+                logger.warning('Beetle disconnected - %s', mac_dict[beetle_address])
+                try:
+                    beetle.disconnect()
+                except TransportError:
+                    pass
+                logger.info('Attempting to reconnect to Beetle - %s', mac_dict[beetle_address])
+                connection_manager.connect(connection)
+            except KeyboardInterrupt as kbi:
+                logger.info('Exiting - %s', mac_dict[beetle_address])
+                beetle.disconnect()
+                exit()
+
+
+# runs a shard of the Beetles with a thread per Beetle
+def beetles_process(process_name, specs, player_queues, transport_factory=None, capture_dir=None, trace_every=0,
+                    decode_stage=False):
+    setupLogging(process_name)
+    metrics.startPublisher(process_name)
+    connection_manager = ConnectionManager()
+    heartbeat_monitor = HeartbeatMonitor()
+    capture = openCapture(capture_dir, process_name)
+    decode_worker = startDecodeWorker(decode_stage)
+    with ThreadPoolExecutor(max_workers=len(specs)) as beetle_thread_executor:
+        for spec in specs:
+            beetle_thread_executor.submit(beetle_thread, spec, player_queues, transport_factory, connection_manager,
+                                          heartbeat_monitor, capture, trace_every, decode_worker)
+
+
+# runs a shard of the Beetles from one asyncio event loop, see async_engine.py
+def async_beetles_process(process_name, specs, player_queues, transport_factory=None, capture_dir=None,
+                          trace_every=0, decode_stage=False):
+    setupLogging(process_name)
+    metrics.startPublisher(process_name)
+    heartbeat_monitor = HeartbeatMonitor()
+    capture = openCapture(capture_dir, process_name)
+    decode_worker = startDecodeWorker(decode_stage)
+    beetles = []
+    for spec in specs:
+        beetle = makeBeetle(spec, player_queues, transport_factory, capture, trace_every, decode_worker)
+        heartbeat_monitor.register(beetle)
+        beetles.append(beetle)
+
+    with dumpOnCrash():
+        AsyncBeetleEngine(beetles).run()
+
+
+# the Beetle processes to start, each with its shard of the topology. with num_workers None, the thread per Beetle
+# engine gets a process per player and the asyncio engine a single process
+def makeBeetleProcesses(player_queues, transport_factory=None, engine=BLE_ENGINE, num_workers=BEETLE_WORKERS,
+                        capture_dir=CAPTURE_DIR, trace_every=0, decode_stage=DECODE_STAGE):
+    specs = beetleSpecs()
+    if num_workers is not None:
+        shards = shardBeetles(specs, num_workers)
+        process_names = [f'beetles{i + 1}' for i in range(len(shards))]
+    elif engine == BLE_ENGINE_ASYNCIO:
+        shards = [specs]
+        process_names = ['beetles']
+    else:
+        shards = shardByPlayer(specs)
+        process_names = [f'player{shard[0].player_id + 1}' for shard in shards]
+
+    target = async_beetles_process if engine == BLE_ENGINE_ASYNCIO else beetles_process
+    return [Process(target=target, args=(process_name, shard, player_queues, transport_factory, capture_dir,
+                                         trace_every, decode_stage))
+            for process_name, shard in zip(process_names, shards)]
+
+
+def client_process(player_queues, data_client_address=None, trace_dir=None):
+    setupLogging('ultra96_client')
+    metrics.startPublisher('ultra96_client')
+    with dumpOnCrash():
+        ultra96_client = Ultra96Client(player_queues, data_client_address, trace_dir)
+        if data_client_address is None:
+            ultra96_client.run()
+        else:
+            ultra96_client.runWithoutTunnel()
+
+
+# starts the Ultra96 client and the Beetles, returning the processes and the player queues. with warm_start the
+# Beetles connect while the tunnel comes up, and what they send is held in the player queues until the uplink is
+# ready, otherwise they aren't started until it is
+# data_client_address skips the SSH tunnel and connects the Ultra96 client straight to that address
+# capture_dir records the notifications of every Beetle to a capture per process, see capture.py
+# trace_dir traces a sample of the packets through every stage of the relay to a file, see tracing.py
+# decode_stage hands the notifications of every Beetle process over to a decode thread, see decode_stage.py
+def start_processes(transport_factory=None, data_client_address=None, engine=BLE_ENGINE, queue_backend=QUEUE_BACKEND,
+                    capture_dir=CAPTURE_DIR, num_workers=BEETLE_WORKERS, warm_start=WARM_START, trace_dir=TRACE_DIR,
+                    decode_stage=DECODE_STAGE):
+    startup.markStart()
+    player_queues = [createPacketQueue(queue_backend) for _ in range(NUM_PLAYERS)]
+    trace_every = TRACE_SAMPLE_EVERY if trace_dir is not None else 0
+    beetle_processes = makeBeetleProcesses(player_queues, transport_factory, engine, num_workers, capture_dir,
+                                           trace_every, decode_stage)
+    u96 = Process(target=client_process, args=(player_queues, data_client_address, trace_dir))
+
+    logger.info('Starting process for Ultra96 Client')
+    u96.start()
 
-def player_process(player_id, player_beetle_addresses, player_queue):
-    with ThreadPoolExecutor(max_workers=len(player_beetle_addresses)) as beetle_thread_executor:
-        for i, beetle_address in enumerate(player_beetle_addresses):
-            device_id = i + 1
-            beetle_thread_executor.submit(beetle_thread, beetle_address, player_id, device_id, player_queue)
+    # don't connect to the Beetles until connection to the Ultra96 server is successful
+    while not warm_start and not is_connected_to_u96.value:
+        time.sleep(0.5)
 
+    for i, beetle_process in enumerate(beetle_processes):
+        logger.info('Starting process for Beetles (%d/%d)', i + 1, len(beetle_processes))
+        beetle_process.start()
 
-def client_process(player_one_queue, player_two_queue):
-    ultra96_client = Ultra96Client(player_one_queue, player_two_queue)
-    ultra96_client.run()
+    return [u96] + beetle_processes, player_queues
 
 
 def main():
-    print("Starting game...")
-    p1_queue = Queue()
-    p2_queue = Queue()
-
-    p1 = Process(target=player_process, args=(PLAYER_ONE, PLAYER_ONE_BEETLES, p1_queue))
-    p2 = Process(target=player_process, args=(PLAYER_TWO, PLAYER_TWO_BEETLES, p2_queue))
-    u96 = Process(target=client_process, args=(p1_queue, p2_queue))
-
-    print("Starting process for Ultra96 Client")
-    u96.start()
-
-    # don't connect to the Beetles until connection to the Ultra96 server is successful
-    while not is_connected_to_u96.value:
-        time.sleep(0.5)
-
-    print("Starting process for Player 1")
-    p1.start()
+    setupLogging('main')
+    logger.info('Starting game...')
+    processes, player_queues = start_processes()
 
-    print("Starting process for Player 2")
-    p2.start()
+    for process in processes:
+        process.join()
 
-    u96.join()
-    p1.join()
-    p2.join()
+    for player_queue in player_queues:
+        player_queue.close()
+        player_queue.unlink()
 
 
 if __name__ == "__main__":
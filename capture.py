@@ -0,0 +1,271 @@
+import argparse
+import bisect
+import heapq
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# a capture is a header followed by back-to-back records, each a record header and the notification payload as
+# it came from the Beetle
+MAGIC = b'BLECAP\x00\x01'
+# magic, bytes of records written so far
+FILE_HEADER = struct.Struct('<8sQ')
+# perf_counter time the notification was handled, player id, device id, payload length
+RECORD_HEADER = struct.Struct('<dBBH')
+
+CaptureRecord = namedtuple('CaptureRecord', ['timestamp', 'player_id', 'device_id', 'payload'])
+
+
+# appends notifications to a capture file through a memory map, so recording one is a couple of copies into memory
+# and the kernel does the writing. the file is preallocated a chunk at a time and cut down to size when closed. the
+# header is kept up to date with every record, so the capture of a process that was killed still reads back
+class CaptureWriter:
+
+    CHUNK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.size = 0
+        self.map = None
+        self.grow()
+
+        self.write_pos = FILE_HEADER.size
+        FILE_HEADER.pack_into(self.map, 0, MAGIC, 0)
+
+        # every Beetle thread of a process shares the writer
+        self.lock = threading.Lock()
+
+    def grow(self):
+        if self.map is not None:
+            self.map.close()
+        self.size += self.chunk_size
+        os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def write(self, player_id, device_id, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        record_size = RECORD_HEADER.size + len(payload)
+
+        with self.lock:
+            if self.map is None:
+                return
+            if self.write_pos + record_size > self.size:
+                self.grow()
+
+            pos = self.write_pos
+            RECORD_HEADER.pack_into(self.map, pos, timestamp, player_id, device_id, len(payload))
+            self.map[pos + RECORD_HEADER.size:pos + record_size] = payload
+            self.write_pos = pos + record_size
+            # the records only count once the header says so, so a reader never sees half a record
+            FILE_HEADER.pack_into(self.map, 0, MAGIC, self.write_pos - FILE_HEADER.size)
+
+    def close(self):
+        with self.lock:
+            if self.map is None:
+                return
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            os.ftruncate(self.fd, self.write_pos)
+            os.close(self.fd)
+
+
+# reads the records of a capture, also one that is still being written or whose writer crashed
+class CaptureReader:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as capture_file:
+            self.map = mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, records_size = FILE_HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a capture')
+        self.end_pos = FILE_HEADER.size + records_size
+
+        # offset and timestamp of every record, for seeking
+        self.offsets = []
+        self.timestamps = []
+        pos = FILE_HEADER.size
+        while pos < self.end_pos:
+            timestamp, _, _, length = RECORD_HEADER.unpack_from(self.map, pos)
+            self.offsets.append(pos)
+            self.timestamps.append(timestamp)
+            pos += RECORD_HEADER.size + length
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return self.readRecord(self.offsets[index])
+
+    def __iter__(self):
+        return self.records()
+
+    def readRecord(self, pos):
+        timestamp, player_id, device_id, length = RECORD_HEADER.unpack_from(self.map, pos)
+        payload_pos = pos + RECORD_HEADER.size
+        return CaptureRecord(timestamp, player_id, device_id, self.map[payload_pos:payload_pos + length])
+
+    # index of the first record handled at or after timestamp
+    def seek(self, timestamp):
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+    def records(self, start_index=0):
+        for pos in self.offsets[start_index:]:
+            yield self.readRecord(pos)
+
+    def close(self):
+        self.map.close()
+
+
+# the writer for a Beetle process, or None if capture_dir is None. the capture is named after the process and the
+# time it started, so captures of different runs don't overwrite each other
+def openCapture(capture_dir, process_name):
+    if capture_dir is None:
+        return None
+    os.makedirs(capture_dir, exist_ok=True)
+    path = os.path.join(capture_dir, f'{process_name}-{time.strftime("%Y%m%d-%H%M%S")}.blecap')
+    logger.info('Capturing notifications to %s', path)
+    return CaptureWriter(path)
+
+
+# every process capturing notifications writes its own file, merged back into one stream by time
+def mergeCaptures(paths):
+    readers = [CaptureReader(path) for path in paths]
+    return heapq.merge(*readers, key=lambda record: record.timestamp)
+
+
+# never connected, the replayed Beetles only have their notifications handed to them
+class ReplayTransport:
+
+    def write(self, handle, data, with_response=False):
+        pass
+
+
+def drainSink(server, counts):
+    conn, _ = server.accept()
+    with conn:
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return
+            counts[0] += len(data)
+
+
+# feeds captured notifications through Beetle.checkBuffer, the player queues and an Ultra96Client, at the pace they
+# were captured (scaled by speed) or, with speed None, as fast as possible. returns the records replayed, the seconds
+# it took and the bytes the Ultra96Client sent
+def replayCaptures(paths, speed=None, data_client_address=None):
+    # imported here, since capturing only needs the classes above
+    from multiprocessing import Process
+    from beetle import Beetle
+    from ble_client import client_process
+    from globals import BEETLE_ADDRESSES, is_connected_to_u96
+    from packet_queue import createPacketQueue
+    from globals import QUEUE_BACKEND
+
+    server = None
+    counts = [0]
+    if data_client_address is None:
+        server = socket.create_server(('localhost', 0))
+        data_client_address = server.getsockname()
+        threading.Thread(target=drainSink, args=(server, counts), daemon=True).start()
+
+    player_queues = [createPacketQueue(QUEUE_BACKEND) for _ in BEETLE_ADDRESSES]
+    client = Process(target=client_process, args=(player_queues, data_client_address))
+    client.start()
+    while not is_connected_to_u96.value:
+        time.sleep(0.05)
+
+    beetles = {}
+    num_records = 0
+    start = time.perf_counter()
+    first_timestamp = None
+    for record in mergeCaptures(paths):
+        beetle = beetles.get((record.player_id, record.device_id))
+        if beetle is None:
+            beetle = Beetle(BEETLE_ADDRESSES[record.player_id][record.device_id - 1], record.player_id,
+                            record.device_id, player_queues[record.player_id], ReplayTransport())
+            beetle.handshake_done = True
+            beetles[(record.player_id, record.device_id)] = beetle
+
+        if speed is not None:
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+            delay = start + (record.timestamp - first_timestamp) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        beetle.checkBuffer(record.payload)
+        num_records += 1
+
+    # let the Ultra96Client catch up before stopping it
+    while not all(player_queue.empty() for player_queue in player_queues):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    time.sleep(0.1)
+
+    client.terminate()
+    client.join()
+    for player_queue in player_queues:
+        player_queue.close()
+        player_queue.unlink()
+    if server is not None:
+        server.close()
+    return num_records, elapsed, counts[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or replay captured Beetle notifications')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    show_parser = subparsers.add_parser('show', help='print the records of a capture')
+    show_parser.add_argument('path')
+    show_parser.add_argument('--start', type=float, help='seconds into the capture to start at')
+    show_parser.add_argument('--count', type=int, default=20, help='records to print')
+
+    replay_parser = subparsers.add_parser('replay', help='replay captures through the relay')
+    replay_parser.add_argument('paths', nargs='+')
+    replay_parser.add_argument('--speed', type=float, help='replay at this multiple of real time, '
+                                                           'as fast as possible if not given')
+    replay_parser.add_argument('--data-client', help='host:port to send the relay packets to, '
+                                                     'a local sink if not given')
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        reader = CaptureReader(args.path)
+        start_index = 0
+        if args.start is not None and len(reader):
+            start_index = reader.seek(reader.timestamps[0] + args.start)
+        print(f'{len(reader)} records')
+        for i, record in enumerate(reader.records(start_index)):
+            if i == args.count:
+                break
+            print(f'{record.timestamp:.6f} player {record.player_id} device {record.device_id} '
+                  f'{bytes(record.payload).hex()}')
+        return
+
+    data_client_address = None
+    if args.data_client is not None:
+        host, port = args.data_client.rsplit(':', 1)
+        data_client_address = (host, int(port))
+
+    num_records, elapsed, num_bytes = replayCaptures(args.paths, args.speed, data_client_address)
+    print(f'Replayed {num_records} notifications in {elapsed:.2f} s ({num_records / elapsed:.0f}/s)')
+    if data_client_address is None:
+        print(f'Relay sent {num_bytes} bytes')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import logging
+import os
+import random
+import time
+from multiprocessing import Array, Condition
+
+import metrics
+from globals import IMU, EMITTER, RECEIVER, NUM_ADAPTERS, device_dict, mac_dict
+from transport import TransportError
+
+logger = logging.getLogger(__name__)
+
+# states a Beetle's connection goes through
+DISCONNECTED = 'disconnected'
+CONNECTING = 'connecting'
+HANDSHAKING = 'handshaking'
+STREAMING = 'streaming'
+
+# lower goes first when Beetles are waiting to connect on the same adapter, the game can't go on without the IMU
+DEVICE_PRIORITIES = {IMU: 0, EMITTER: 1, RECEIVER: 1}
+NUM_PRIORITIES = 2
+
+# BlueZ handles a single connection attempt on an adapter at a time, more only queue up inside it and time out
+MAX_ATTEMPTS_PER_ADAPTER = 1
+
+
+# limits the connection attempts in progress on each HCI adapter, across every process connecting to Beetles. made
+# before the Beetle processes are forked, so they all share it
+#
+# each slot holds the pid of the process attempting a connection in it, or 0 if it is free. a process that dies
+# mid-attempt never releases its slot, so once an adapter's slots are all taken, those of processes that are gone are
+# taken back
+class AdapterSlots:
+
+    # longest wait before re-checking the slots, in case a process died holding one
+    WAIT_TIMEOUT = 1.0
+
+    def __init__(self, num_adapters=NUM_ADAPTERS, max_attempts=MAX_ATTEMPTS_PER_ADAPTER):
+        self.max_attempts = max_attempts
+        self.condition = Condition()
+        self.holders = Array('i', num_adapters * max_attempts, lock=False)
+        # Beetles waiting for a slot on each adapter, by priority
+        self.waiting = Array('i', num_adapters * NUM_PRIORITIES, lock=False)
+
+    def acquire(self, adapter, priority):
+        with self.condition:
+            self.waiting[adapter * NUM_PRIORITIES + priority] += 1
+            while not self.isFree(adapter, priority):
+                if not self.reclaimDeadHolders(adapter):
+                    self.condition.wait(AdapterSlots.WAIT_TIMEOUT)
+            self.waiting[adapter * NUM_PRIORITIES + priority] -= 1
+            self.holders[self.findSlot(adapter, 0)] = os.getpid()
+
+    def slots(self, adapter):
+        return range(adapter * self.max_attempts, (adapter + 1) * self.max_attempts)
+
+    # index of the first slot of the adapter held by pid, 0 for a free one, or None if there is none
+    def findSlot(self, adapter, pid):
+        for slot in self.slots(adapter):
+            if self.holders[slot] == pid:
+                return slot
+        return None
+
+    # a slot is only taken if no Beetle of a higher priority is waiting for one
+    def isFree(self, adapter, priority):
+        if self.findSlot(adapter, 0) is None:
+            return False
+        for higher_priority in range(priority):
+            if self.waiting[adapter * NUM_PRIORITIES + higher_priority]:
+                return False
+        return True
+
+    # frees the slots of the adapter held by processes that have died, returning whether there were any
+    def reclaimDeadHolders(self, adapter):
+        num_reclaimed = 0
+        for slot in self.slots(adapter):
+            pid = self.holders[slot]
+            if pid and not isAlive(pid):
+                logger.warning('Reclaimed the slot on hci%d of process %d, which died connecting', adapter, pid)
+                self.holders[slot] = 0
+                num_reclaimed += 1
+        return num_reclaimed > 0
+
+    def release(self, adapter):
+        with self.condition:
+            slot = self.findSlot(adapter, os.getpid())
+            if slot is not None:
+                self.holders[slot] = 0
+            self.condition.notify_all()
+
+
+# a process that has exited but not been waited for yet is still there as a zombie, which counts as dead
+def isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            # the state follows the command name, which is in parentheses and may itself contain spaces
+            return stat_file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
+
+
+adapter_slots = AdapterSlots()
+
+
+# the connection of one Beetle as seen by the ConnectionManager
+class DeviceConnection:
+
+    def __init__(self, beetle, adapter):
+        self.beetle = beetle
+        self.adapter = adapter
+        self.priority = DEVICE_PRIORITIES[beetle.device_id]
+        self.name = mac_dict.get(beetle.mac_address, beetle.mac_address)
+
+        self.state = DISCONNECTED
+        self.num_failures = 0
+        self.num_attempts = 0
+        # when the Beetle stopped streaming, to time how long it takes to get back
+        self.disconnect_time = None
+        self.last_time_to_reconnect = None
+
+        prefix = f'p{beetle.player_id + 1}.{device_dict[beetle.device_id].lower()}'
+        metrics.registry.gauge(f'{prefix}.state', lambda: self.state)
+        metrics.registry.gauge(f'{prefix}.connection_attempts', lambda: self.num_attempts)
+        metrics.registry.gauge(f'{prefix}.last_time_to_reconnect_s', lambda: self.last_time_to_reconnect)
+        self.time_to_reconnect = metrics.registry.histogram(f'{prefix}.time_to_reconnect')
+
+    def setState(self, state):
+        if state == self.state:
+            return
+
+        if state == STREAMING:
+            self.num_failures = 0
+            if self.disconnect_time is not None:
+                self.last_time_to_reconnect = time.perf_counter() - self.disconnect_time
+                self.time_to_reconnect.record(self.last_time_to_reconnect)
+                self.disconnect_time = None
+                logger.info('Streaming again after %.2f s - %s', self.last_time_to_reconnect, self.name)
+        elif state == DISCONNECTED and self.state != CONNECTING and self.disconnect_time is None:
+            self.disconnect_time = time.perf_counter()
+
+        self.state = state
+
+
+# schedules the connection attempts of the Beetles in a process: retries back off exponentially with jitter, and
+# attempts are spread over the adapters' slots with the IMU first in line
+class ConnectionManager:
+
+    BASE_DELAY = 0.25
+    MAX_DELAY = 8.0
+
+    def __init__(self, base_delay=BASE_DELAY, max_delay=MAX_DELAY, slots=None, seed=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.slots = slots if slots is not None else adapter_slots
+        self.rng = random.Random(seed)
+
+    def register(self, beetle):
+        connection = DeviceConnection(beetle, beetle.adapter)
+        beetle.connection = connection
+        return connection
+
+    # seconds to wait before the next attempt: nothing the first time, then doubling with every failure. the
+    # delay is drawn from its upper half, so Beetles that dropped together don't retry together
+    def backoffDelay(self, connection):
+        if not connection.num_failures:
+            return 0.0
+        delay = min(self.max_delay, self.base_delay * 2 ** (connection.num_failures - 1))
+        return delay / 2 + self.rng.uniform(0, delay / 2)
+
+    # a single attempt, blocking until the adapter has a slot free. raises TransportError if it fails
+    def attemptConnect(self, connection):
+        self.slots.acquire(connection.adapter, connection.priority)
+        try:
+            connection.num_attempts += 1
+            connection.setState(CONNECTING)
+            connection.beetle.connect()
+        except TransportError:
+            connection.num_failures += 1
+            connection.setState(DISCONNECTED)
+            # the connection may have got as far as GATT discovery before failing
+            try:
+                connection.beetle.transport.disconnect()
+            except TransportError:
+                pass
+            raise
+        finally:
+            self.slots.release(connection.adapter)
+
+        # the Beetle moves on to STREAMING once it has acknowledged the handshake
+        if connection.state == CONNECTING:
+            connection.setState(HANDSHAKING)
+
+    # retries until the Beetle is connected, for the thread per Beetle engine
+    def connect(self, connection):
+        while True:
+            time.sleep(self.backoffDelay(connection))
+            try:
+                self.attemptConnect(connection)
+                return
+            except TransportError:
+                logger.warning('Failed to connect, retrying - %s', connection.name)
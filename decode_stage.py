@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+import select
+import threading
+import time
+from collections import deque
+
+import metrics
+from relay_log import dumpOnCrash
+
+logger = logging.getLogger(__name__)
+
+# with a decode stage, a Beetle process works in two tiers. the I/O threads (or the asyncio engine's event loop)
+# only timestamp each notification and append it to their Beetle's NotificationBuffer, and a single DecodeWorker
+# thread reassembles, validates and interprets them in batches and puts the packets in the player queues
+#
+# only notifications that come in once a Beetle's handshake is done are handed over, so the handshake, like every
+# other write to the Beetle, stays with the thread that owns its transport. a Beetle hands the reassembler back by
+# clearing handshake_done and waiting for its buffer to be drained, see Beetle.waitForDecodeStage, so the reassembler
+# and the Beetle's lanes of the player queue only ever have one thread using them at a time
+
+
+# notifications of one Beetle waiting to be decoded. a deque's append and popleft are atomic, so the Beetle's I/O
+# thread and the DecodeWorker share it without taking a lock
+class NotificationBuffer:
+
+    def __init__(self, beetle, worker):
+        self.beetle = beetle
+        self.worker = worker
+        self.notifications = deque()
+
+        # each only ever bumped by one thread, so they tell the I/O thread when the worker has caught up
+        self.num_appended = 0
+        self.num_decoded = 0
+
+    # I/O thread
+    def append(self, receive_time, data, trace):
+        self.notifications.append((receive_time, data, trace))
+        self.num_appended += 1
+        if self.worker.is_waiting:
+            self.worker.wakeUp()
+
+    def isDrained(self):
+        return self.num_decoded == self.num_appended
+
+    # I/O thread, once it has stopped handing notifications over
+    def waitUntilDrained(self):
+        while not self.isDrained():
+            time.sleep(DecodeWorker.DRAIN_POLL)
+
+    # the same from the asyncio engine's event loop, which keeps driving the other Beetles in the meantime
+    async def drained(self):
+        while not self.isDrained():
+            await asyncio.sleep(DecodeWorker.DRAIN_POLL)
+
+
+class DecodeWorker:
+
+    # upper bound on a single wait, in case a wakeup races with the worker going to sleep
+    MAX_WAIT = 0.05
+    # how often an I/O thread taking its reassembler back checks whether the worker has caught up
+    DRAIN_POLL = 0.001
+    # most notifications of one Beetle decoded in a row, so a busy IMU can't hold up the emitter's and receiver's
+    MAX_BATCH = 64
+
+    def __init__(self):
+        self.buffers = []
+        self.thread = threading.Thread(target=self.run, name='decode', daemon=True)
+
+        # the deques have no file descriptor, so I/O threads signal an eventfd instead, but only while the worker has
+        # said it is about to block, to keep the syscall off the hot path
+        self.wakeup_fd = os.eventfd(0, os.EFD_NONBLOCK)
+        self.is_waiting = False
+
+        # for telemetry
+        self.num_batches = 0
+        self.num_notifications = 0
+        self.registerMetrics()
+
+    def registerMetrics(self):
+        metrics.registry.gauge('decode.batches', lambda: self.num_batches)
+        metrics.registry.gauge('decode.notifications', lambda: self.num_notifications)
+        metrics.registry.gauge('decode.backlog', lambda: sum(len(buffer.notifications) for buffer in self.buffers))
+        # from a notification being handed over to it being decoded
+        self.decode_lag = metrics.registry.histogram('decode.lag')
+
+    # gives the Beetle a buffer to hand its notifications over to this worker through. Beetles may be attached from
+    # their own threads while the worker is running
+    def attach(self, beetle):
+        buffer = NotificationBuffer(beetle, self)
+        self.buffers.append(buffer)
+        beetle.decode_buffer = buffer
+        return buffer
+
+    def start(self):
+        self.thread.start()
+
+    def wakeUp(self):
+        os.eventfd_write(self.wakeup_fd, 1)
+
+    def run(self):
+        with dumpOnCrash():
+            while True:
+                if not self.decodeBatches():
+                    self.wait()
+
+    def wait(self):
+        self.is_waiting = True
+        # a notification may have been handed over before its I/O thread saw that the worker is waiting
+        if not any(buffer.notifications for buffer in self.buffers):
+            select.select([self.wakeup_fd], [], [], DecodeWorker.MAX_WAIT)
+        self.is_waiting = False
+
+        try:
+            os.eventfd_read(self.wakeup_fd)
+        except BlockingIOError:
+            pass
+
+    # decodes a batch of every Beetle with notifications waiting, returning how many were decoded
+    def decodeBatches(self):
+        num_decoded = 0
+        for buffer in self.buffers:
+            if buffer.notifications:
+                num_decoded += self.decodeBatch(buffer)
+        return num_decoded
+
+    def decodeBatch(self, buffer):
+        beetle = buffer.beetle
+        notifications = buffer.notifications
+        # the first notification of the batch has waited the longest
+        self.decode_lag.record(time.perf_counter() - notifications[0][0])
+
+        num_decoded = 0
+        while notifications and num_decoded < DecodeWorker.MAX_BATCH:
+            receive_time, data, trace = notifications.popleft()
+            beetle.decodeHandedOver(data, receive_time, trace)
+            buffer.num_decoded += 1
+            num_decoded += 1
+
+        self.num_batches += 1
+        self.num_notifications += num_decoded
+        return num_decoded
+
+
+# the running decode worker of a Beetle process, or None without a decode stage
+def startDecodeWorker(decode_stage):
+    if not decode_stage:
+        return None
+
+    worker = DecodeWorker()
+    worker.start()
+    logger.info('Decoding notifications in a decode stage')
+    return worker
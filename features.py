@@ -0,0 +1,114 @@
+import json
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from motion_window import WINDOW_SIZE, NUM_CHANNELS
+from relay_packet import RelayPacket
+
+# instead of the WINDOW_SIZE relay packets of a window, the relay can send a single frame of features computed from
+# it, for each of the channels:
+#   mean, std, min, max   of the samples
+#   energy                mean of the squared samples
+#   zero_crossings        times the signal crosses its mean
+#   band_power_0..n       power of the signal around its mean in NUM_BANDS equal bands of the spectrum above DC,
+#                         lowest first
+#
+# a feature frame starts with the same details byte as a relay packet, with FEATURES_SHIFT set, followed by the
+# version, the number of channels and of features per channel, then the features as big-endian float32, channel by
+# channel in the order of CHANNEL_NAMES and FEATURE_NAMES. bump FEATURES_VERSION whenever any of that changes
+
+FEATURES_VERSION = 1
+FEATURES_SHIFT = 2
+
+NUM_BANDS = 4
+
+CHANNEL_NAMES = ('accel_x', 'accel_y', 'accel_z', 'gyro_x', 'gyro_y', 'gyro_z')
+FEATURE_NAMES = ('mean', 'std', 'min', 'max', 'energy', 'zero_crossings') + tuple(f'band_power_{band}'
+                                                                                 for band in range(NUM_BANDS))
+NUM_FEATURES = len(FEATURE_NAMES)
+
+FEATURE_HEADER = struct.Struct('!BBBB')
+FEATURE_DTYPE = np.dtype('>f4')
+FEATURE_FRAME_SIZE = FEATURE_HEADER.size + NUM_CHANNELS * NUM_FEATURES * FEATURE_DTYPE.itemsize
+
+# first bin of every band, the DC bin left out
+BAND_STARTS = np.array([1 + band * (WINDOW_SIZE // 2) // NUM_BANDS for band in range(NUM_BANDS)])
+
+FeatureFrame = namedtuple('FeatureFrame', ['player_id', 'version', 'features'])
+
+
+def isFeatureFrame(details):
+    return bool(details & (1 << FEATURES_SHIFT))
+
+
+# features of a window of samples, one row per sample, as an array of NUM_CHANNELS rows of NUM_FEATURES
+def computeFeatures(window):
+    window = np.asarray(window, dtype=np.float32)
+    features = np.empty((NUM_CHANNELS, NUM_FEATURES), dtype=np.float32)
+
+    mean = window.mean(axis=0)
+    centered = window - mean
+    features[:, 0] = mean
+    features[:, 1] = centered.std(axis=0)
+    features[:, 2] = window.min(axis=0)
+    features[:, 3] = window.max(axis=0)
+    features[:, 4] = np.einsum('ij,ij->j', window, window) / len(window)
+    features[:, 5] = np.count_nonzero(np.diff(np.signbit(centered), axis=0), axis=0)
+
+    power = np.abs(np.fft.rfft(centered, axis=0)) ** 2 / len(window)
+    features[:, 6:] = np.add.reduceat(power, BAND_STARTS, axis=0).T
+    return features
+
+
+def packFeatures(player_id, features):
+    details = (player_id << RelayPacket.PLAYER_ID_SHIFT) | (1 << FEATURES_SHIFT)
+    header = FEATURE_HEADER.pack(details, FEATURES_VERSION, NUM_CHANNELS, NUM_FEATURES)
+    return header + features.astype(FEATURE_DTYPE).tobytes()
+
+
+def decodeFeatureFrame(data):
+    details, version, num_channels, num_features = FEATURE_HEADER.unpack_from(data)
+    if version != FEATURES_VERSION:
+        raise ValueError(f'Feature frame version {version}, expected {FEATURES_VERSION}')
+    if (num_channels, num_features) != (NUM_CHANNELS, NUM_FEATURES):
+        raise ValueError(f'Feature frame of {num_channels}x{num_features} features, expected '
+                         f'{NUM_CHANNELS}x{NUM_FEATURES}')
+
+    features = np.frombuffer(data, dtype=FEATURE_DTYPE, count=num_channels * num_features,
+                             offset=FEATURE_HEADER.size)
+    return FeatureFrame(details >> RelayPacket.PLAYER_ID_SHIFT, version,
+                        features.astype(np.float32).reshape(num_channels, num_features))
+
+
+# the layout of a feature frame, for the receiving side
+def schema():
+    return {
+        'version': FEATURES_VERSION,
+        'header': {'format': FEATURE_HEADER.format, 'fields': ['details', 'version', 'num_channels', 'num_features']},
+        'details_bits': {'player_id': RelayPacket.PLAYER_ID_SHIFT, 'features': FEATURES_SHIFT},
+        'features_dtype': FEATURE_DTYPE.str,
+        'channels': list(CHANNEL_NAMES),
+        'features': list(FEATURE_NAMES),
+        'window_size': WINDOW_SIZE,
+        'band_starts': BAND_STARTS.tolist(),
+        'frame_size': FEATURE_FRAME_SIZE,
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(schema(), indent=2))
+
+    rng = np.random.default_rng(4002)
+    window = rng.normal(size=(WINDOW_SIZE, NUM_CHANNELS)).astype(np.float32)
+    features = computeFeatures(window)
+    frame = packFeatures(1, features)
+    decoded = decodeFeatureFrame(frame)
+    assert len(frame) == FEATURE_FRAME_SIZE
+    assert decoded.player_id == 1 and np.array_equal(decoded.features, features)
+    # the bands cover the whole spectrum above DC
+    power = np.abs(np.fft.rfft(window - window.mean(axis=0), axis=0)) ** 2 / WINDOW_SIZE
+    assert np.allclose(features[:, 6:].sum(axis=1), power[1:].sum(axis=0), rtol=1e-4)
+    print(f'{len(frame)} byte feature frame in place of {WINDOW_SIZE * struct.calcsize(RelayPacket.FMT)} bytes of '
+          f'relay packets')
@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import threading
+
+from globals import GATT_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+
+# remembers the GATT handles of each Beetle's serial characteristic, which only change with its firmware, so a
+# reconnect can skip service discovery and its BLE round trips. entries are keyed on the MAC address and hold the
+# UUIDs they were discovered for, so a Beetle looked up for a different characteristic misses instead of
+# getting the wrong handles
+class GattCache:
+
+    def __init__(self, path=GATT_CACHE_PATH):
+        self.path = path
+        self.entries = None
+        self.lock = threading.Lock()
+
+    # returns (characteristic handle, CCCD handle), or None if the Beetle has to be discovered
+    def get(self, mac_address, service_uuid, char_uuid):
+        with self.lock:
+            entry = self.load().get(mac_address)
+
+        if entry is None or entry['service_uuid'] != service_uuid or entry['char_uuid'] != char_uuid:
+            return None
+        return entry['char_handle'], entry['cccd_handle']
+
+    def put(self, mac_address, service_uuid, char_uuid, char_handle, cccd_handle):
+        entry = {
+            'service_uuid': service_uuid,
+            'char_uuid': char_uuid,
+            'char_handle': char_handle,
+            'cccd_handle': cccd_handle,
+        }
+        with self.lock:
+            entries = self.load()
+            if entries.get(mac_address) == entry:
+                return
+            entries[mac_address] = entry
+            self.save()
+
+    # for handles that turned out to be wrong, e.g. after the Beetle was flashed with different firmware
+    def invalidate(self, mac_address):
+        with self.lock:
+            if self.load().pop(mac_address, None) is not None:
+                logger.info('Invalidated cached GATT handles - %s', mac_address)
+                self.save()
+
+    def load(self):
+        if self.entries is None and self.path is None:
+            self.entries = {}
+        elif self.entries is None:
+            try:
+                with open(self.path) as cache_file:
+                    self.entries = json.load(cache_file)
+            except FileNotFoundError:
+                self.entries = {}
+            except (OSError, ValueError) as e:
+                logger.warning('Ignoring unreadable GATT cache %s: %s', self.path, e)
+                self.entries = {}
+        return self.entries
+
+    # the Beetle processes share the file, so it is replaced in one go rather than written in place
+    def save(self):
+        if self.path is None:
+            return
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self.entries, cache_file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+gatt_cache = GattCache()
@@ -1,26 +1,112 @@
-from multiprocessing import Value
+from multiprocessing import Array, Value
 
 PLAYER_ONE = 0
 PLAYER_TWO = 1
 
-# get the MAC addresses here and separate them into player 1 and player 2
-# in the order: Player1 -> Player 2, IMU -> Emitter -> Receiver
-BEETLE_ADDRESSES = [["d0:39:72:bf:c3:d1", "d0:39:72:bf:bf:f6", "d0:39:72:bf:c3:90"],
-                    ["f8:30:02:09:1c:83", "d0:39:72:bf:cd:1e", "d0:39:72:bf:bd:d4"]]
-
-mac_dict = {BEETLE_ADDRESSES[0][0]: 'Player 1 IMU',      BEETLE_ADDRESSES[0][1]: 'Player 1 Emitter',
-            BEETLE_ADDRESSES[0][2]: 'Player 1 Receiver', BEETLE_ADDRESSES[1][0]: 'Player 2 IMU',
-            BEETLE_ADDRESSES[1][1]: 'Player 2 Emitter',  BEETLE_ADDRESSES[1][2]: 'Player 2 Receiver'}
-
 IMU = 1
 EMITTER = 2
 RECEIVER = 3
 device_dict = {IMU: 'IMU', EMITTER: 'Emitter', RECEIVER: 'Receiver'}
 
-p1_connected_beetles = Value('i', 0)
-p2_connected_beetles = Value('i', 0)
+# the Beetles of every player, in the order IMU -> Emitter -> Receiver, as (MAC address, HCI adapter) where adapter
+# n is hcin. an adapter of None is picked by topology.py so the Beetles are spread evenly over the NUM_ADAPTERS
+BEETLE_TOPOLOGY = [[("d0:39:72:bf:c3:d1", None), ("d0:39:72:bf:bf:f6", None), ("d0:39:72:bf:c3:90", None)],
+                   [("f8:30:02:09:1c:83", None), ("d0:39:72:bf:cd:1e", None), ("d0:39:72:bf:bd:d4", None)]]
+NUM_ADAPTERS = 1
+
+# connect to the Beetles while the SSH tunnel and the data_server connection come up, instead of after
+WARM_START = True
+
+# split every Beetle process into I/O threads that only timestamp the notifications and hand them over, and a decode
+# thread that decodes them in batches and puts the packets in the player queues, see decode_stage.py
+DECODE_STAGE = False
+
+# highest version of the Beetle protocol offered in the handshake. version 2 Beetles number their packets and shots,
+# so the relay counts lost packets and asks for missed shots again, see link_v2.py. version 1 Beetles answer with 1
+BEETLE_PROTOCOL_VERSION = 2
+
+# processes the Beetles are sharded over, see topology.py. None runs a process per player with the thread per
+# Beetle engine, and a single process with the asyncio engine
+BEETLE_WORKERS = None
+
+NUM_PLAYERS = len(BEETLE_TOPOLOGY)
+BEETLE_ADDRESSES = [[mac_address for mac_address, _ in beetles] for beetles in BEETLE_TOPOLOGY]
+
+mac_dict = {mac_address: f'Player {player_id + 1} {device_dict[i + 1]}'
+            for player_id, beetle_addresses in enumerate(BEETLE_ADDRESSES)
+            for i, mac_address in enumerate(beetle_addresses)}
+
+# Beetles of each player that are connected, across every process
+connected_beetles = Array('i', NUM_PLAYERS)
 
 is_connected_to_u96 = Value('i', 0)
 
-TOTAL_BEETLES = 6
-NUM_BEETLES_PER_PLAYER = 3
+TOTAL_BEETLES = sum(len(beetle_addresses) for beetle_addresses in BEETLE_ADDRESSES)
+
+# how packets travel from the player processes to the Ultra96 client, see packet_queue.py
+# 'queue' pickles control records through a multiprocessing.Queue, 'shm' copies them through shared memory rings. IMU
+# samples go through a shared memory ring with either
+QUEUE_BACKEND = 'queue'
+
+# most IMU samples a player queue holds, a little over a MotionWindow. once it is full the oldest are shed so control
+# events and recent motion aren't held up behind stale samples when the uplink falls behind. the thread putting
+# them overwrites the oldest, so however long the uplink stalls, the lane holds the newest samples
+IMU_LANE_CAPACITY = 64
+
+# send relay packets to the Ultra96 in length-prefixed batch frames, see uplink.py
+# the data_server has to read them with an UplinkReader, so leave this off for servers expecting bare relay packets
+UPLINK_FRAMED = False
+
+# send each IMU window as a single frame of features computed on the relay, in place of its raw samples, see
+# features.py. the data_server has to decode them, so leave this off for servers expecting raw windows
+RELAY_FEATURES = False
+
+# highest uplink format to offer the data_server, see wire_v2.py. version 2 sends each IMU window as one record of
+# fixed-point samples and is only used if the data_server asks for it when the relay connects, otherwise version 1
+# is sent. version 3 also tells where in the IMU windows each shot was received. UPLINK_DELTA lets version 2 delta
+# encode smooth windows into half the bytes, at 8 bits of precision or more
+UPLINK_WIRE_VERSION = 3
+UPLINK_DELTA = True
+
+# the Ultra96 client puts the records of each player's Beetles in the order they were received, holding each back
+# for at most MERGE_REORDER_DELAY seconds in case one received before it is still on its way, see stream_merge.py.
+# longer puts more of the records in their place, at the cost of latency. None sends them on as they come instead
+MERGE_REORDER_DELAY = 0.01
+
+# how the Beetles are driven: a thread per Beetle in a process per player, or all of them from one asyncio event loop
+BLE_ENGINE_THREADS = 'threads'
+BLE_ENGINE_ASYNCIO = 'asyncio'
+BLE_ENGINE = BLE_ENGINE_THREADS
+
+# every process of the relay appends a JSON line of its metrics to this file every METRICS_INTERVAL seconds, see
+# metrics.py, e.g. 'relay_metrics.jsonl'. None turns publishing off. once the file reaches METRICS_MAX_BYTES it is
+# moved to the same path with .1 appended, replacing the one there, and a new file is started
+METRICS_PATH = None
+METRICS_INTERVAL = 1.0
+METRICS_MAX_BYTES = 16 * 1024 * 1024
+
+# lowest rate each kind of Beetle sends data packets at when nothing is wrong. the IMU streams its samples, while an
+# emitter or receiver with no shots to report sends far less, which the relay has always allowed Beetle.TIMEOUT (2 s)
+# between packets for. a Beetle counts as stalled once it has sent no data for the interval between two packets at
+# that rate, plus STALL_MARGIN_MS for the link's retries, see heartbeat.py
+MIN_SEND_RATES_HZ = {IMU: 20.0, EMITTER: 0.5, RECEIVER: 0.5}
+STALL_MARGIN_MS = 250
+
+# GATT handles of the Beetles, kept between runs so reconnecting can skip service discovery, see gatt_cache.py
+GATT_CACHE_PATH = 'gatt_cache.json'
+
+# logging, see relay_log.py. each kind of event is let through LOG_BURST times at once and LOG_RATE times a second
+# after that, and the last LOG_RING_SIZE events are dumped if a process crashes
+LOG_LEVEL = 'INFO'
+LOG_RATE = 5.0
+LOG_BURST = 20
+LOG_RING_SIZE = 1000
+
+# directory every Beetle process records the raw notifications it receives to, for replaying with capture.py.
+# None turns capturing off
+CAPTURE_DIR = None
+
+# directory the Ultra96 client writes a trace file per game to, of the time every TRACE_SAMPLE_EVERY-th packet of each
+# Beetle reached each stage of the relay, for reporting with tracing.py. None turns tracing off
+TRACE_DIR = None
+TRACE_SAMPLE_EVERY = 64
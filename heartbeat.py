@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import metrics
+from globals import MIN_SEND_RATES_HZ, STALL_MARGIN_MS, device_dict, mac_dict
+
+logger = logging.getLogger(__name__)
+
+# what a Beetle's own thread is asked to do about a stall. only that thread may touch its transport, so the
+# monitor never does anything itself
+SOFT_RESET = 'soft_reset'
+DISCONNECT = 'disconnect'
+
+# handshakes re-sent on the existing link before a stalled Beetle is disconnected
+SOFT_RESETS = 1
+
+# times a stalled Beetle is checked on within a threshold of being acted on
+RECHECKS = 10
+
+
+# how long each kind of Beetle may go without sending data before it counts as stalled, in ms
+def stallThresholdsMs(min_send_rates=MIN_SEND_RATES_HZ, margin_ms=STALL_MARGIN_MS):
+    return {device_id: 1000 / rate + margin_ms for device_id, rate in min_send_rates.items()}
+
+
+# one Beetle as watched by the HeartbeatMonitor
+class Heartbeat:
+
+    def __init__(self, beetle, threshold):
+        self.beetle = beetle
+        self.threshold = threshold
+        self.name = mac_dict.get(beetle.mac_address, beetle.mac_address)
+
+        self.is_armed = False
+        self.armed_time = 0
+        # bumped every time the Beetle is armed, so the monitor can tell checks left over from an older connection
+        self.generation = 0
+
+        # set by the monitor, taken by the Beetle's thread
+        self.action = None
+        self.stall_time = None
+        self.escalate_time = None
+        self.num_soft_resets = 0
+
+        self.num_stalls = 0
+        self.num_soft_recoveries = 0
+        self.num_escalations = 0
+
+        prefix = f'p{beetle.player_id + 1}.{device_dict[beetle.device_id].lower()}'
+        metrics.registry.gauge(f'{prefix}.stalls', lambda: self.num_stalls)
+        metrics.registry.gauge(f'{prefix}.soft_recoveries', lambda: self.num_soft_recoveries)
+        metrics.registry.gauge(f'{prefix}.stall_escalations', lambda: self.num_escalations)
+        self.stall_recovery = metrics.registry.histogram(f'{prefix}.stall_recovery')
+
+    # called by the Beetle's thread
+    def takeAction(self):
+        action = self.action
+        self.action = None
+        if action == DISCONNECT:
+            self.num_escalations += 1
+        return action
+
+    # time of the last data packet, or of connecting if there hasn't been one since
+    def lastSeen(self):
+        return max(self.beetle.last_packet_time, self.armed_time)
+
+
+# watches every Beetle of a process from one thread, which sleeps until the earliest time a Beetle could have
+# stalled. a Beetle stalls when no data packet has come in for its threshold: it is first asked to re-send the
+# handshake on the existing link, and only disconnected if that doesn't bring the data back
+class HeartbeatMonitor:
+
+    def __init__(self, thresholds_ms=None, soft_resets=SOFT_RESETS):
+        if thresholds_ms is None:
+            thresholds_ms = stallThresholdsMs()
+        self.thresholds = {device_id: threshold_ms / 1000 for device_id, threshold_ms in thresholds_ms.items()}
+        self.soft_resets = soft_resets
+
+        # (deadline, sequence number, heartbeat, generation)
+        self.deadlines = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def register(self, beetle):
+        heartbeat = Heartbeat(beetle, self.thresholds[beetle.device_id])
+        beetle.heartbeat = heartbeat
+        beetle.heartbeat_monitor = self
+        return heartbeat
+
+    # starts watching a Beetle that has just connected
+    def arm(self, heartbeat):
+        with self.condition:
+            heartbeat.is_armed = True
+            heartbeat.armed_time = time.perf_counter()
+            heartbeat.generation += 1
+            heartbeat.action = None
+            heartbeat.stall_time = None
+            heartbeat.num_soft_resets = 0
+            self.schedule(heartbeat, heartbeat.armed_time + heartbeat.threshold)
+
+    def disarm(self, heartbeat):
+        with self.condition:
+            heartbeat.is_armed = False
+            heartbeat.action = None
+
+    def schedule(self, heartbeat, deadline):
+        is_earliest = not self.deadlines or deadline < self.deadlines[0][0]
+        heapq.heappush(self.deadlines, (deadline, next(self.counter), heartbeat, heartbeat.generation))
+        if is_earliest:
+            self.condition.notify()
+
+    def run(self):
+        with self.condition:
+            while True:
+                if not self.deadlines:
+                    self.condition.wait()
+                    continue
+
+                deadline, _, heartbeat, generation = self.deadlines[0]
+                now = time.perf_counter()
+                if deadline > now:
+                    self.condition.wait(deadline - now)
+                    continue
+
+                heapq.heappop(self.deadlines)
+                if heartbeat.is_armed and generation == heartbeat.generation:
+                    self.check(heartbeat, now)
+
+    def check(self, heartbeat, now):
+        last_seen = heartbeat.lastSeen()
+        if heartbeat.stall_time is None and now - last_seen < heartbeat.threshold:
+            self.schedule(heartbeat, last_seen + heartbeat.threshold)
+            return
+
+        if heartbeat.stall_time is not None:
+            if last_seen > heartbeat.stall_time:
+                heartbeat.num_soft_recoveries += 1
+                heartbeat.stall_recovery.record(last_seen - heartbeat.stall_time)
+                logger.info('Recovered from stall after %.0f ms - %s', (last_seen - heartbeat.stall_time) * 1e3,
+                            heartbeat.name)
+                heartbeat.stall_time = None
+                heartbeat.num_soft_resets = 0
+                self.schedule(heartbeat, last_seen + heartbeat.threshold)
+                return
+
+            # checked every so often after acting on a stall, to time the recovery closely
+            if now < heartbeat.escalate_time:
+                self.schedule(heartbeat, min(heartbeat.escalate_time, now + heartbeat.threshold / RECHECKS))
+                return
+        else:
+            heartbeat.stall_time = now
+            heartbeat.num_stalls += 1
+
+        if heartbeat.num_soft_resets < self.soft_resets:
+            heartbeat.num_soft_resets += 1
+            heartbeat.action = SOFT_RESET
+        else:
+            heartbeat.action = DISCONNECT
+
+        # give the Beetle another threshold to come back before escalating
+        heartbeat.escalate_time = now + heartbeat.threshold
+        self.schedule(heartbeat, now + heartbeat.threshold / RECHECKS)
@@ -0,0 +1,272 @@
+import logging
+import struct
+
+import packetize
+from constants import TPacketType
+from globals import IMU
+
+logger = logging.getLogger(__name__)
+
+# version 2 of the protocol between the Beetles and the relay. version 1 only has the one sequence bit in the details
+# byte, which nothing checks, so lost and duplicated packets go unnoticed. version 2 numbers every data packet, so
+# the relay can count what it lost, and numbers the shots of the emitter and receiver, so the relay can ask for the
+# ones it missed again without holding up the IMU stream:
+#
+#   emitter, receiver   the payload, all zeroes in version 1, starts with the sequence number of the packet and the
+#                       number of shots the Beetle has sent so far, this one included, as little-endian uint16s
+#   IMU                 the payload is all samples, so the sequence number only has three bits: the sequence bit of
+#                       the details byte, then its two shot bits, which an IMU doesn't use otherwise
+#
+# either way the sequence bit of the details byte is the lowest bit of the sequence number, so it still alternates as
+# in version 1
+#
+# the version is negotiated in the handshake: the relay sends the highest version it speaks right after the 'H', and
+# a Beetle answers with the version it will send in the first byte of its ACK packet's payload, where a version 1
+# Beetle has a zero. the relay asks for a missed shot again with an 'N' followed by the shot's number as a
+# little-endian uint16, and the Beetle sends the packet that carried it again, as it was
+
+PROTOCOL_VERSION = 2
+
+HANDSHAKE = b'H'
+NACK = b'N'
+
+SHOT_HEADER = struct.Struct('<HH')
+NACK_STRUCT = struct.Struct('<cH')
+
+SEQ_MODULUS = 1 << 16
+IMU_SEQ_MODULUS = 1 << 3
+
+SHOT_MASK = packetize.SEND_SHOT_MASK | packetize.RECEIVE_SHOT_MASK
+
+# a missed shot is asked for again at most MAX_NACKS times, NACK_INTERVAL seconds apart, and given up on after that.
+# at most MAX_MISSING_SHOTS are asked for at once, the oldest being given up on first
+NACK_INTERVAL = 0.05
+MAX_NACKS = 3
+MAX_MISSING_SHOTS = 16
+
+# the checksum is a single XOR byte, so the odd misaligned packet the reassembler resyncs onto gets through with
+# nonsense sequence numbers. a packet numbered further than SEQ_WINDOW away from the one expected is dropped, unless
+# the packet after it carries on from it, so such a packet neither passes on a shot that was never fired nor sets off
+# a flood of NACKs
+SEQ_WINDOW = 256
+SHOT_WINDOW = MAX_MISSING_SHOTS
+
+
+def handshakeRequest(max_version):
+    if max_version < 2:
+        return HANDSHAKE
+    return HANDSHAKE + bytes((max_version,))
+
+
+# Beetle side: the highest version the relay offered with its handshake
+def offeredVersion(request):
+    return request[1] if len(request) > 1 else 1
+
+
+# relay side: the version the Beetle answered its ACK packet with
+def ackVersion(packet):
+    return max(1, packet[1])
+
+
+def nackRequest(shot_seq):
+    return NACK_STRUCT.pack(NACK, shot_seq)
+
+
+def imuSequence(details):
+    return ((details >> packetize.SEQNUM_SHIFT) & 1) | ((details & SHOT_MASK) << 1)
+
+
+# the bits of the details byte an IMU packet's sequence number is sent in
+def imuSequenceBits(seq):
+    return ((seq & 1) << packetize.SEQNUM_SHIFT) | ((seq >> 1) & SHOT_MASK)
+
+
+# counts the packets lost between those received, by their sequence numbers modulo modulus. a packet up to window
+# behind the next one expected is a duplicate, and one up to window ahead means the ones in between were lost. one
+# further away is dropped, unless the next packet follows on from it
+class SequenceTracker:
+
+    def __init__(self, modulus, window):
+        self.modulus = modulus
+        self.window = window
+        self.expected = None
+        # the number the packet after one out of the window would have to carry to resync onto it
+        self.resync_seq = None
+
+        self.num_received = 0
+        self.num_lost = 0
+        self.num_duplicates = 0
+        self.num_out_of_window = 0
+        # packets that aren't data packets of the Beetle, see SequenceChecker
+        self.num_rejected = 0
+
+    def reset(self):
+        self.expected = None
+        self.resync_seq = None
+
+    # returns whether the packet is new
+    def check(self, seq):
+        if self.expected is not None:
+            gap = (seq - self.expected) % self.modulus
+            if gap >= self.modulus - self.window:
+                self.num_duplicates += 1
+                return False
+            if gap <= self.window:
+                self.num_lost += gap
+            elif seq != self.resync_seq:
+                self.num_out_of_window += 1
+                self.resync_seq = (seq + 1) % self.modulus
+                return False
+
+        self.expected = (seq + 1) % self.modulus
+        self.resync_seq = None
+        self.num_received += 1
+        return True
+
+
+# counts the IMU's lost packets by its three-bit sequence numbers. with only eight of them a burst of losses can't be
+# told from a duplicate or a packet out of the window, and IMU packets are never sent again anyway, so every gap
+# counts as that many packets lost, modulo eight, and no sample is ever dropped
+class ImuSequenceTracker(SequenceTracker):
+
+    def __init__(self):
+        super().__init__(IMU_SEQ_MODULUS, IMU_SEQ_MODULUS - 1)
+
+    def check(self, seq):
+        if self.expected is not None:
+            self.num_lost += (seq - self.expected) % self.modulus
+        self.expected = (seq + 1) % self.modulus
+        self.num_received += 1
+        return True
+
+
+# keeps track of the shots of an emitter or receiver by their numbers, and of the missed ones still worth asking for.
+# check is called by whichever thread decodes the Beetle's packets and dueNacks by its I/O thread, so missing is only
+# ever changed an item at a time
+class ShotTracker:
+
+    def __init__(self):
+        self.last_shot = None
+        # shot number -> [NACKs sent, when the next one is due]
+        self.missing = {}
+
+        self.num_missed = 0
+        self.num_recovered = 0
+        self.num_given_up = 0
+        self.num_duplicates = 0
+        self.num_resyncs = 0
+        self.num_nacks_sent = 0
+
+    def reset(self):
+        self.last_shot = None
+        self.missing.clear()
+
+    # a new packet, carrying the number of shots sent so far. returns whether it should be passed on, i.e. it carries
+    # no shot or one not passed on before
+    def check(self, shot_seq, is_shot, now):
+        if self.last_shot is None:
+            self.last_shot = shot_seq
+            return True
+
+        ahead = (shot_seq - self.last_shot) % SEQ_MODULUS
+        if 0 < ahead <= SHOT_WINDOW:
+            # every shot since the last one seen was missed, and this one too unless the packet carries it
+            for missed in range(1, ahead if is_shot else ahead + 1):
+                self.missShot((self.last_shot + missed) % SEQ_MODULUS, now)
+            self.last_shot = shot_seq
+            return True
+
+        if ahead == 0 or ahead >= SEQ_MODULUS - SHOT_WINDOW:
+            if is_shot:
+                self.num_duplicates += 1
+                return False
+            return True
+
+        self.num_resyncs += 1
+        self.last_shot = shot_seq
+        return True
+
+    # returns whether the shot was missed and is still being asked for, so its retransmission should be passed on
+    def recover(self, shot_seq):
+        if self.missing.pop(shot_seq, None) is None:
+            return False
+        self.num_recovered += 1
+        return True
+
+    def missShot(self, shot_seq, now):
+        self.num_missed += 1
+        self.missing[shot_seq] = [0, now]
+        if len(self.missing) > MAX_MISSING_SHOTS:
+            self.giveUp(next(iter(self.missing)))
+
+    def giveUp(self, shot_seq):
+        if self.missing.pop(shot_seq, None) is not None:
+            self.num_given_up += 1
+            logger.warning('Gave up on missed shot %d', shot_seq)
+
+    # the shots to send a NACK for now
+    def dueNacks(self, now):
+        due = []
+        for shot_seq, nack in list(self.missing.items()):
+            num_nacks, due_time = nack
+            if due_time > now:
+                continue
+            if num_nacks >= MAX_NACKS:
+                self.giveUp(shot_seq)
+                continue
+            nack[0] = num_nacks + 1
+            nack[1] = now + NACK_INTERVAL
+            due.append(shot_seq)
+        self.num_nacks_sent += len(due)
+        return due
+
+
+# 1 for every details byte a data packet of the Beetle of player_id and device_id can start with
+def dataDetails(player_id, device_id):
+    table = bytearray(256)
+    for details, (packet_type, _, details_player_id, details_device_id, _, _) in enumerate(packetize.DETAILS_TABLE):
+        table[details] = (packet_type == TPacketType.PACKET_TYPE_DATA.value and details_player_id == player_id
+                          and details_device_id == device_id)
+    return bytes(table)
+
+
+# everything the relay keeps track of for the version 2 packets of one Beetle, across its connections. IMU packets
+# are never dropped for their sequence numbers, so a packet that isn't a data packet of this Beetle, e.g. a misaligned
+# one the reassembler resynced onto, is turned away before its number is looked at, for the IMU as for the others
+class SequenceChecker:
+
+    def __init__(self, player_id, device_id):
+        self.data_details = dataDetails(player_id, device_id)
+        if device_id == IMU:
+            self.packets = ImuSequenceTracker()
+            self.shots = None
+        else:
+            self.packets = SequenceTracker(SEQ_MODULUS, SEQ_WINDOW)
+            self.shots = ShotTracker()
+
+    # a new connection numbers its packets afresh
+    def reset(self):
+        self.packets.reset()
+        if self.shots is not None:
+            self.shots.reset()
+
+    # returns whether the data packet should be passed on
+    def accept(self, packet, now):
+        details = packet[0]
+        if not self.data_details[details]:
+            self.packets.num_rejected += 1
+            return False
+        if self.shots is None:
+            return self.packets.check(imuSequence(details))
+
+        seq, shot_seq = SHOT_HEADER.unpack_from(packet, 1)
+        is_shot = details & SHOT_MASK
+        # a retransmitted shot comes in out of the sequence of packets, which it isn't counted in
+        if is_shot and self.shots.missing and self.shots.recover(shot_seq):
+            return True
+        return self.packets.check(seq) and self.shots.check(shot_seq, is_shot, now)
+
+    def dueNacks(self, now):
+        if self.shots is None or not self.shots.missing:
+            return ()
+        return self.shots.dueNacks(now)
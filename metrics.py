@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import time
+
+from globals import METRICS_PATH, METRICS_INTERVAL, METRICS_MAX_BYTES
+
+
+# the hot paths only ever bump plain attributes or record into a Histogram, everything else happens when a snapshot
+# is taken by the publisher thread
+
+
+# counts durations into power-of-two buckets of microseconds, bucket i holding durations below 2 ** i us
+class Histogram:
+
+    # enough buckets for any duration, so recording never has to clamp the bucket index
+    NUM_BUCKETS = 64
+
+    def __init__(self):
+        self.counts = [0] * Histogram.NUM_BUCKETS
+        self.total = 0.0
+
+    def record(self, seconds):
+        self.counts[int(seconds * 1e6).bit_length()] += 1
+        self.total += seconds
+
+    def snapshot(self):
+        counts = list(self.counts)
+        count = sum(counts)
+        if not count:
+            return {'count': 0}
+
+        return {
+            'count': count,
+            'mean_us': self.total / count * 1e6,
+            'p50_us': bucketPercentile(counts, count, 0.5),
+            'p99_us': bucketPercentile(counts, count, 0.99),
+            'max_us': bucketPercentile(counts, count, 1.0),
+            # trailing empty buckets left out
+            'buckets': counts[:max(bucket for bucket, bucket_count in enumerate(counts) if bucket_count) + 1],
+        }
+
+
+# upper bound in microseconds of the bucket the given fraction of durations falls in
+def bucketPercentile(counts, count, fraction):
+    target = fraction * count
+    cumulative = 0
+    for bucket, bucket_count in enumerate(counts):
+        cumulative += bucket_count
+        if cumulative >= target:
+            return float(1 << bucket)
+    return float(1 << (len(counts) - 1))
+
+
+# every metric of a process by name. gauges are functions read at snapshot time, so counters the code keeps anyway
+# can be published without adding anything to the hot path
+class MetricsRegistry:
+
+    def __init__(self):
+        self.gauges = {}
+        self.histograms = {}
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    # a metric registered again, e.g. by a new connection, replaces the old one
+    def histogram(self, name, histogram=None):
+        if histogram is None:
+            histogram = Histogram()
+        self.histograms[name] = histogram
+        return histogram
+
+    def snapshot(self):
+        snapshot = {}
+        for name, read in list(self.gauges.items()):
+            snapshot[name] = read()
+        for name, histogram in list(self.histograms.items()):
+            snapshot[name] = histogram.snapshot()
+        return snapshot
+
+
+# appends a snapshot of the registry as a JSON line every interval. the file is opened in append mode and each
+# line written with a single call, so every process of the relay can share one file. whichever process finds the
+# file has grown to max_bytes rotates it, and every process reopens the path once it no longer holds the file it has
+# open
+class MetricsPublisher:
+
+    def __init__(self, registry, process_name, path=METRICS_PATH, interval=METRICS_INTERVAL,
+                 max_bytes=METRICS_MAX_BYTES):
+        self.registry = registry
+        self.process_name = process_name
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        fd = self.open()
+        try:
+            while True:
+                time.sleep(self.interval)
+                fd = self.rotateIfFull(fd)
+                self.publish(fd)
+        finally:
+            os.close(fd)
+
+    def open(self):
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def rotateIfFull(self, fd):
+        stat = os.fstat(fd)
+        try:
+            is_current = os.path.samestat(stat, os.stat(self.path))
+        except FileNotFoundError:
+            is_current = False
+
+        if is_current and stat.st_size >= self.max_bytes:
+            os.replace(self.path, self.path + '.1')
+        elif is_current:
+            return fd
+
+        os.close(fd)
+        return self.open()
+
+    def publish(self, fd):
+        line = json.dumps({
+            'time': time.time(),
+            'process': self.process_name,
+            'pid': os.getpid(),
+            'metrics': self.registry.snapshot(),
+        })
+        os.write(fd, (line + '\n').encode())
+
+
+# one registry per process, filled in by the Beetles, queues and uplink living in it
+registry = MetricsRegistry()
+
+
+def startPublisher(process_name):
+    if METRICS_PATH is None:
+        return None
+
+    publisher = MetricsPublisher(registry, process_name)
+    publisher.start()
+    return publisher
@@ -0,0 +1,133 @@
+import numpy as np
+
+# number of IMU samples in a frame processed by the Hardware AI
+WINDOW_SIZE = 50
+# how many of those samples come from before the sample that triggered the window
+PRE_TRIGGER_SAMPLES = 10
+
+# a window is triggered when the magnitude of acceleration rises above MAGNITUDE_THRESHOLD. after a window, the
+# next one can only be triggered once REFRACTORY_SAMPLES have passed and the magnitude has dropped below
+# RELEASE_THRESHOLD, so one long movement doesn't fire a burst of overlapping windows
+MAGNITUDE_THRESHOLD = 1.5
+RELEASE_THRESHOLD = 1.2
+REFRACTORY_SAMPLES = 10
+
+# each sample is a row of accel_data[3] followed by gyro_data[3], the order they are sent to the Ultra96 in
+NUM_CHANNELS = 6
+
+
+# keeps the recent IMU samples of one player and cuts them into windows around each movement
+class MotionWindow:
+
+    CAPACITY = 512
+
+    def __init__(self, window_size=WINDOW_SIZE, pre_trigger_samples=PRE_TRIGGER_SAMPLES,
+                 magnitude_threshold=MAGNITUDE_THRESHOLD, release_threshold=RELEASE_THRESHOLD,
+                 refractory_samples=REFRACTORY_SAMPLES, capacity=CAPACITY):
+        self.window_size = window_size
+        self.pre_trigger_samples = pre_trigger_samples
+        self.trigger_level = magnitude_threshold * magnitude_threshold
+        self.release_level = release_threshold * release_threshold
+        self.refractory_samples = refractory_samples
+
+        self.samples = np.zeros((max(capacity, 2 * window_size), NUM_CHANNELS), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        # samples are numbered from the last reset. the buffer holds samples [first_index, end_index),
+        # with sample first_index stored in row 0
+        self.first_index = 0
+        self.end_index = 0
+
+        self.trigger_index = None
+        self.is_armed = True
+        self.refractory_end = 0
+
+        # [start, end) sample indexes of the windows returned by the last push
+        self.window_ranges = []
+
+    # adds a batch of samples, one per row, and returns every window completed by them
+    def push(self, new_samples):
+        self.window_ranges = []
+        num_new = len(new_samples)
+        if not num_new:
+            return []
+
+        self.append(new_samples)
+        start = self.end_index - num_new
+
+        # squared magnitude of acceleration of every new sample at once
+        accel = self.samples[start - self.first_index:self.end_index - self.first_index, :3]
+        magnitudes = np.einsum('ij,ij->i', accel, accel)
+
+        windows = []
+        pos = 0
+        while pos < num_new:
+            if self.trigger_index is not None:
+                window_start = max(self.trigger_index - self.pre_trigger_samples, self.first_index)
+                window_end = window_start + self.window_size
+                if window_end > self.end_index:
+                    break
+
+                windows.append(self.samples[window_start - self.first_index:window_end - self.first_index].copy())
+                self.window_ranges.append((window_start, window_end))
+                self.trigger_index = None
+                self.is_armed = False
+                self.refractory_end = window_end + self.refractory_samples
+                pos = window_end - start
+                continue
+
+            pos = max(pos, self.refractory_end - start)
+            if pos >= num_new:
+                break
+
+            if not self.is_armed:
+                released = np.flatnonzero(magnitudes[pos:] < self.release_level)
+                if not len(released):
+                    break
+                pos += released[0] + 1
+                self.is_armed = True
+                continue
+
+            triggered = np.flatnonzero(magnitudes[pos:] > self.trigger_level)
+            if not len(triggered):
+                break
+            self.trigger_index = start + pos + triggered[0]
+
+        self.discardOldSamples()
+        return windows
+
+    def append(self, new_samples):
+        num_stored = self.end_index - self.first_index
+        if num_stored + len(new_samples) > len(self.samples):
+            grown = np.zeros((2 * (num_stored + len(new_samples)), NUM_CHANNELS), dtype=np.float32)
+            grown[:num_stored] = self.samples[:num_stored]
+            self.samples = grown
+
+        self.samples[num_stored:num_stored + len(new_samples)] = new_samples
+        self.end_index += len(new_samples)
+
+    # offset of the next sample in the window being cut, -1 if no window is being cut
+    def windowOffset(self):
+        if self.trigger_index is None:
+            return -1
+        return self.end_index - max(self.trigger_index - self.pre_trigger_samples, self.first_index)
+
+    # index of the first sample that may still end up in a window yet to be cut
+    def firstPendingIndex(self):
+        if self.trigger_index is not None:
+            return self.trigger_index - self.pre_trigger_samples
+        return self.end_index - self.pre_trigger_samples
+
+    # only the samples that may still end up in a window are kept, moved to the front of the buffer
+    # when the buffer is at least half full
+    def discardOldSamples(self):
+        keep_from = max(self.firstPendingIndex(), self.first_index)
+
+        if 2 * (self.end_index - self.first_index) < len(self.samples):
+            return
+
+        num_kept = self.end_index - keep_from
+        offset = keep_from - self.first_index
+        self.samples[:num_kept] = self.samples[offset:offset + num_kept]
+        self.first_index = keep_from
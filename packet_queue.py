@@ -0,0 +1,248 @@
+import os
+import selectors
+from multiprocessing import Queue, RawValue
+from queue import Empty
+
+import packetize
+from globals import IMU, EMITTER, RECEIVER, IMU_LANE_CAPACITY
+from shm_ring import SharedPacketRing
+
+QUEUE_BACKEND_PIPE = 'queue'
+QUEUE_BACKEND_SHM = 'shm'
+
+
+# the queues below are interchangeable: Beetles put their own device id, the details of each packet they interpreted
+# (packet type, seqnum, player id, device id, sent shot, received shot, as from packetize.DETAILS_TABLE) and the raw
+# packet, and the Ultra96 client gets back a compact record of (packet, kind, device_id, receive_time, trace),
+# whichever way it travels between the processes. packet is the 20 raw bytes, left for the Ultra96 client to decode
+# once it sends them on. kind is 0 for packets from the Beetle, otherwise the TPacketType value of a
+# connected/disconnected event, whose packet only holds the player and device in its details byte. device_id is that
+# of the Beetle the record came from. trace is the stamps of a traced packet, see tracing.py, or None
+#
+# a record is put in a lane, and routed by the Ultra96 client, by the device id of the Beetle putting it, never by the
+# bits of the packet, which a corrupted packet can have wrong
+#
+# each has two lanes. connected/disconnected events and the emitter's and receiver's packets go through the control
+# lane, which is always served first and never sheds anything. IMU samples go through the IMU lane, which holds at
+# most IMU_LANE_CAPACITY of them: once it is full the oldest are shed, so a slow uplink makes the relay skip ahead
+# to recent motion rather than fall further and further behind
+
+
+# connected/disconnected events don't come from the Beetle, so only the player and device are kept
+def eventPacket(packet_attr):
+    return packetize.serialize(packetize.detailsAsBytes(0, 0, packet_attr[2], packet_attr[3]))
+
+
+# pickles control records through a multiprocessing.Queue, while IMU samples go through a shared memory ring that
+# overwrites its oldest samples when full. the producer does the shedding, so however long the consumer stops
+# reading, e.g. while the uplink comes up, the lane holds the newest samples. the ring has no file descriptor of its
+# own, so its producer signals an eventfd as with SharedMemoryPacketQueue
+class PipePacketQueue:
+
+    def __init__(self, imu_lane_capacity=IMU_LANE_CAPACITY):
+        self.control_lane = Queue()
+        self.imu_lane = SharedPacketRing(imu_lane_capacity, overwrite=True, device_id=IMU)
+        self.wakeup_fd = os.eventfd(0, os.EFD_NONBLOCK)
+        self.is_waiting = RawValue('b', 0)
+
+    def put(self, device_id, packet_attr, packet=None, receive_time=0.0, trace=None):
+        if packet is None:
+            self.control_lane.put((eventPacket(packet_attr), packet_attr[0], device_id, receive_time, None))
+        elif device_id != IMU:
+            self.control_lane.put((bytes(packet), 0, device_id, receive_time, trace))
+        else:
+            self.imu_lane.put(packet, 0, receive_time, trace)
+            if self.is_waiting.value:
+                os.eventfd_write(self.wakeup_fd, 1)
+
+    # qsize only reads a semaphore, where empty polls the pipe. it also counts packets that are still on their way
+    # to the pipe, which get then waits for
+    def empty(self):
+        return not self.control_lane.qsize() and self.imu_lane.empty()
+
+    def get(self):
+        if self.control_lane.qsize():
+            return self.control_lane.get()
+        return self.imu_lane.get()
+
+    # packets waiting to be handled, approximate as with any multiprocessing.Queue
+    def depth(self):
+        return self.control_lane.qsize() + len(self.imu_lane)
+
+    # the control lane never drops, and the IMU lane overwrites rather than drops
+    def numDropped(self):
+        return 0
+
+    # IMU samples overwritten by newer ones
+    def numShed(self):
+        return self.imu_lane.numShed()
+
+    # the control lane's pipe becomes readable as soon as a packet is in flight, so it can be waited on directly
+    def filenos(self):
+        return [self.control_lane._reader.fileno(), self.wakeup_fd]
+
+    def setWaiting(self, is_waiting):
+        self.is_waiting.value = is_waiting
+
+    def acknowledgeWakeup(self):
+        try:
+            os.eventfd_read(self.wakeup_fd)
+        except BlockingIOError:
+            pass
+
+    def clear(self):
+        while True:
+            try:
+                self.control_lane.get_nowait()
+            except Empty:
+                break
+        self.imu_lane.clear()
+
+    def close(self):
+        self.control_lane.close()
+        self.imu_lane.close()
+        os.close(self.wakeup_fd)
+
+    def unlink(self):
+        self.imu_lane.unlink()
+
+
+# passes raw packets through shared memory rings, each with a single producer thread: a control ring per Beetle, and
+# an IMU lane that overwrites its oldest samples when full
+class SharedMemoryPacketQueue:
+
+    def __init__(self, device_ids=(IMU, EMITTER, RECEIVER), capacity=SharedPacketRing.CAPACITY,
+                 imu_lane_capacity=IMU_LANE_CAPACITY):
+        self.rings = {device_id: SharedPacketRing(capacity, device_id=device_id) for device_id in device_ids}
+        self.ring_list = list(self.rings.values())
+        self.next_ring = 0
+        self.imu_lane = SharedPacketRing(imu_lane_capacity, overwrite=True, device_id=IMU)
+
+        # the rings have no file descriptor of their own, so producers signal an eventfd instead, but only while the
+        # consumer has said it is about to block, to keep the syscall off the hot path
+        self.wakeup_fd = os.eventfd(0, os.EFD_NONBLOCK)
+        self.is_waiting = RawValue('b', 0)
+
+    def put(self, device_id, packet_attr, packet=None, receive_time=0.0, trace=None):
+        if packet is None:
+            self.rings[device_id].put(eventPacket(packet_attr), packet_attr[0], receive_time)
+        elif device_id == IMU:
+            self.imu_lane.put(packet, 0, receive_time, trace)
+        else:
+            self.rings[device_id].put(packet, 0, receive_time, trace)
+
+        if self.is_waiting.value:
+            os.eventfd_write(self.wakeup_fd, 1)
+
+    def empty(self):
+        if not self.imu_lane.empty():
+            return False
+        for ring in self.ring_list:
+            if not ring.empty():
+                return False
+        return True
+
+    # serves the control rings in turn so one busy Beetle can't starve the others, then the IMU lane
+    def get(self):
+        num_rings = len(self.ring_list)
+        for i in range(num_rings):
+            ring = self.ring_list[(self.next_ring + i) % num_rings]
+            record = ring.get()
+            if record is not None:
+                self.next_ring = (self.next_ring + i + 1) % num_rings
+                return record
+
+        return self.imu_lane.get()
+
+    def depth(self):
+        return sum(len(ring) for ring in self.ring_list) + len(self.imu_lane)
+
+    # packets lost because a control ring was full
+    def numDropped(self):
+        return sum(ring.numDropped() for ring in self.ring_list)
+
+    # IMU samples overwritten by newer ones
+    def numShed(self):
+        return self.imu_lane.numShed()
+
+    def getBatch(self, device_id, max_records=None):
+        if device_id == IMU:
+            return self.imu_lane.getBatch(max_records)
+        return self.rings[device_id].getBatch(max_records)
+
+    def filenos(self):
+        return [self.wakeup_fd]
+
+    def setWaiting(self, is_waiting):
+        self.is_waiting.value = is_waiting
+
+    def acknowledgeWakeup(self):
+        try:
+            os.eventfd_read(self.wakeup_fd)
+        except BlockingIOError:
+            pass
+
+    def clear(self):
+        for ring in self.ring_list:
+            ring.clear()
+        self.imu_lane.clear()
+
+    def close(self):
+        for ring in self.ring_list:
+            ring.close()
+        self.imu_lane.close()
+        os.close(self.wakeup_fd)
+
+    def unlink(self):
+        for ring in self.ring_list:
+            ring.unlink()
+        self.imu_lane.unlink()
+
+
+# blocks until at least one of several packet queues has data, without polling them in a loop
+class PacketQueueSelector:
+
+    # upper bound on a single wait, in case a producer's wakeup races with the consumer going to sleep
+    MAX_WAIT = 0.05
+
+    def __init__(self, player_queues):
+        self.player_queues = player_queues
+        self.selector = selectors.DefaultSelector()
+        for key, player_queue in player_queues.items():
+            for fd in player_queue.filenos():
+                self.selector.register(fd, selectors.EVENT_READ, key)
+
+    # returns the keys of every queue that has data, in a stable order, blocking for at most timeout seconds
+    def select(self, timeout=None):
+        ready = self.readyKeys()
+        if ready:
+            return ready
+
+        if timeout is None or timeout > PacketQueueSelector.MAX_WAIT:
+            timeout = PacketQueueSelector.MAX_WAIT
+
+        for player_queue in self.player_queues.values():
+            player_queue.setWaiting(True)
+
+        # a packet may have arrived before the producers saw that the consumer is waiting
+        ready = self.readyKeys()
+        if not ready:
+            self.selector.select(timeout)
+            ready = self.readyKeys()
+
+        for player_queue in self.player_queues.values():
+            player_queue.setWaiting(False)
+            player_queue.acknowledgeWakeup()
+        return ready
+
+    def readyKeys(self):
+        return [key for key, player_queue in self.player_queues.items() if not player_queue.empty()]
+
+    def close(self):
+        self.selector.close()
+
+
+def createPacketQueue(backend, imu_lane_capacity=IMU_LANE_CAPACITY):
+    if backend == QUEUE_BACKEND_SHM:
+        return SharedMemoryPacketQueue(imu_lane_capacity=imu_lane_capacity)
+    return PipePacketQueue(imu_lane_capacity)
@@ -1,7 +1,10 @@
 import struct
 
+import numpy as np
+
 from constants import TPacketType
 
+PACKET_SIZE = 20
 CHECKSUM_POS = 19
 
 PACKET_TYPE_SHIFT = 6
@@ -18,8 +21,29 @@ DEVICE_ID_MASK = (3 << DEVICE_ID_SHIFT)
 SEND_SHOT_MASK = (0x01 << SEND_SHOT_SHIFT)
 RECEIVE_SHOT_MASK = (0x01 << RECEIVE_SHOT_SHIFT)
 
+VALID_PACKET_TYPES = frozenset((TPacketType.PACKET_TYPE_ACK.value, TPacketType.PACKET_TYPE_DATA.value))
+
+# layout of a packet sent by the Beetle: details, gyro[3], accel[3], checksum
+PACKET_STRUCT = struct.Struct('<B3h3fc')
+CHECKSUM_STRUCT = struct.Struct('<5I')
+
+# same layout as PACKET_STRUCT, used to view a buffer of many packets at once
+PACKET_DTYPE = np.dtype([('details', 'u1'), ('gyro', '<i2', (3,)), ('accel', '<f4', (3,)), ('checksum', 'u1')])
+
+# columnar result of decodeBatch, one row per packet
+BATCH_DTYPE = np.dtype([('packet_type', 'u1'), ('seqnum', 'u1'), ('player_id', 'u1'), ('device_id', 'u1'),
+                        ('sent_shot', 'u1'), ('received_shot', 'u1'), ('gyro', '<i2', (3,)), ('accel', '<f4', (3,)),
+                        ('valid', '?')])
+
 
 def getChecksum(byte_seq):
+    if len(byte_seq) == PACKET_SIZE:
+        # XOR the packet as five 32-bit words, then fold the word down to a single byte
+        word_0, word_1, word_2, word_3, word_4 = CHECKSUM_STRUCT.unpack(byte_seq)
+        checksum = word_0 ^ word_1 ^ word_2 ^ word_3 ^ word_4
+        checksum ^= checksum >> 16
+        return (checksum ^ (checksum >> 8)) & 0xff
+
     checksum = b'\x00'[0]
     for b in byte_seq:
         checksum ^= b
@@ -45,18 +69,33 @@ def serialize(details):
 
 
 def deserialize(packet):
-    fmt = '<c3h3fc'
-    packet_attr = struct.unpack(fmt, packet)
+    packet_attr = PACKET_STRUCT.unpack(packet)
+
+    # details is the first element of the tuple, the remaining elements are the gyro data, accel data and checksum
+    return DETAILS_TABLE[packet_attr[0]] + packet_attr[1:]
 
-    # packet_attr returns a tuple, details is the first element ([0]) of the tuple (a bytes object)
-    # to get the first (and only) byte of the bytes object, another [0] is added
-    details = packet_attr[0][0]
-    details = interpretDetails(details)
 
-    # remove first element of the tuple
-    packet_attr = packet_attr[1:]
+def decodeBatch(buffer):
+    if len(buffer) % PACKET_SIZE:
+        raise ValueError(f'Buffer of {len(buffer)} bytes does not hold a whole number of packets')
 
-    return details + packet_attr
+    raw = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, PACKET_SIZE)
+    packets = raw.view(PACKET_DTYPE)[:, 0]
+    details = packets['details']
+
+    batch = np.empty(len(packets), dtype=BATCH_DTYPE)
+    batch['packet_type'] = details >> PACKET_TYPE_SHIFT
+    batch['seqnum'] = (details & SEQNUM_MASK) >> SEQNUM_SHIFT
+    batch['player_id'] = (details & PLAYER_ID_MASK) >> PLAYER_ID_SHIFT
+    batch['device_id'] = (details & DEVICE_ID_MASK) >> DEVICE_ID_SHIFT
+    batch['sent_shot'] = (details & SEND_SHOT_MASK) >> SEND_SHOT_SHIFT
+    batch['received_shot'] = (details & RECEIVE_SHOT_MASK) >> RECEIVE_SHOT_SHIFT
+    batch['gyro'] = packets['gyro']
+    batch['accel'] = packets['accel']
+
+    # a packet is valid if its type is known and all of its bytes, checksum included, XOR to zero
+    batch['valid'] = VALID_TYPE_LOOKUP[batch['packet_type']] & (np.bitwise_xor.reduce(raw, axis=1) == 0)
+    return batch
 
 
 def detailsAsBytes(packet_type, ack_seqnum, player_id, device_id):
@@ -76,19 +115,13 @@ def interpretDetails(details):
 
     # new bits introduced for status of player
     sent_shot = (details & SEND_SHOT_MASK) >> SEND_SHOT_SHIFT
-    if sent_shot:
-        print("Fired a shot!\n")
-
     received_shot = (details & RECEIVE_SHOT_MASK) >> RECEIVE_SHOT_SHIFT
-    if received_shot:
-        print("Received a shot!\n")
 
     return packet_type, seqnum, player_id, device_id, sent_shot, received_shot
 
 
 def isInvalidPacket(data):
-    packet_type = data[0] >> PACKET_TYPE_SHIFT
-    if isInvalidPacketType(packet_type):
+    if isInvalidPacketType(data[0] >> PACKET_TYPE_SHIFT):
         return True
 
     if getChecksum(data) != 0:
@@ -98,5 +131,10 @@ def isInvalidPacket(data):
 
 
 def isInvalidPacketType(packet_type):
-    valid_types = [TPacketType.PACKET_TYPE_ACK.value, TPacketType.PACKET_TYPE_DATA.value]
-    return packet_type not in valid_types
+    return packet_type not in VALID_PACKET_TYPES
+
+
+# every possible details byte interpreted up front, so decoding a packet is a single lookup
+DETAILS_TABLE = tuple(interpretDetails(details) for details in range(256))
+
+VALID_TYPE_LOOKUP = np.array([packet_type in VALID_PACKET_TYPES for packet_type in range(256)])
@@ -0,0 +1,125 @@
+import packetize
+
+PACKET_SIZE = packetize.PACKET_SIZE
+
+
+# 1 for every details byte a packet from the Beetle of player_id and device_id can start with, given a valid packet
+# type. a checksum of a single byte lets about 1 in 256 misaligned windows through, and most of those are then turned
+# away for carrying another Beetle's ids. None accepts any player or device
+def acceptedDetails(player_id=None, device_id=None):
+    table = bytearray(256)
+    for details, (packet_type, _, details_player_id, details_device_id, _, _) in enumerate(packetize.DETAILS_TABLE):
+        table[details] = (not packetize.isInvalidPacketType(packet_type)
+                          and player_id in (None, details_player_id) and device_id in (None, details_device_id))
+    return bytes(table)
+
+
+class PacketReassembler:
+
+    # enough room for a long backlog of notifications before the buffer has to be compacted
+    CAPACITY = 4096
+
+    # player_id and device_id are those of the Beetle the notifications come from
+    def __init__(self, capacity=CAPACITY, player_id=None, device_id=None):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.accepted_details = acceptedDetails(player_id, device_id)
+
+        # bytes in [read_pos, write_pos) have been received but not yet handed out as packets
+        self.read_pos = 0
+        self.write_pos = 0
+        # where the packets of the last notification start, if it was made up of whole packets: from boundary up to
+        # write_pos, every PACKET_SIZE bytes. None if it wasn't
+        self.boundary = None
+
+        # counters for corruption handling
+        self.num_bytes_skipped = 0
+        self.num_resyncs = 0
+        self.num_fragments = 0
+        self.is_resyncing = False
+
+    def reset(self):
+        self.read_pos = 0
+        self.write_pos = 0
+        self.boundary = None
+        self.is_resyncing = False
+
+    def pending(self):
+        return self.write_pos - self.read_pos
+
+    # append a notification and return a memoryview of every complete, valid packet it completes
+    # the views point into the internal buffer and are only valid until the next call to feed
+    def feed(self, data):
+        data_len = len(data)
+        if data_len % PACKET_SIZE or self.read_pos != self.write_pos:
+            self.num_fragments += 1
+
+        if self.write_pos + data_len > len(self.buffer):
+            self.makeRoom(data_len)
+
+        self.boundary = None if data_len % PACKET_SIZE else self.write_pos
+        self.view[self.write_pos:self.write_pos + data_len] = data
+        self.write_pos += data_len
+
+        packets = []
+        view = self.view
+        accepted_details = self.accepted_details
+        getChecksum = packetize.getChecksum
+        while self.write_pos - self.read_pos >= PACKET_SIZE:
+            packet = view[self.read_pos:self.read_pos + PACKET_SIZE]
+            if not accepted_details[packet[0]] or getChecksum(packet):
+                if self.isOnBoundary(self.read_pos):
+                    # a whole packet that arrived corrupt, rather than a misalignment
+                    self.read_pos += PACKET_SIZE
+                    self.num_bytes_skipped += PACKET_SIZE
+                    continue
+                if not self.resync():
+                    break
+                continue
+
+            self.is_resyncing = False
+            packets.append(packet)
+            self.read_pos += PACKET_SIZE
+
+        return packets
+
+    def isValid(self, packet):
+        return self.accepted_details[packet[0]] and packetize.getChecksum(packet) == 0
+
+    def isOnBoundary(self, pos):
+        return self.boundary is not None and pos >= self.boundary and (pos - self.boundary) % PACKET_SIZE == 0
+
+    # the packet at read_pos is corrupt or misaligned, so slide forward until a packet with a valid header and
+    # checksum starts, or up to the start of the next notification, where the packets are known to be aligned.
+    # returns False if the remaining bytes are too few to tell and more data is needed
+    def resync(self):
+        if not self.is_resyncing:
+            self.num_resyncs += 1
+            self.is_resyncing = True
+
+        view = self.view
+        pos = self.read_pos + 1
+        last_start = self.write_pos - PACKET_SIZE
+        while pos <= last_start:
+            if self.isOnBoundary(pos) or self.isValid(view[pos:pos + PACKET_SIZE]):
+                break
+            pos += 1
+
+        self.num_bytes_skipped += pos - self.read_pos
+        self.read_pos = pos
+        return pos <= last_start
+
+    def makeRoom(self, data_len):
+        pending = self.write_pos - self.read_pos
+
+        # move the partial packet left over to the front of the buffer, growing it if it still won't fit
+        if pending + data_len > len(self.buffer):
+            new_buffer = bytearray(max(2 * len(self.buffer), pending + data_len))
+            new_buffer[:pending] = self.view[self.read_pos:self.write_pos]
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        else:
+            self.buffer[:pending] = self.buffer[self.read_pos:self.write_pos]
+
+        self.read_pos = 0
+        self.write_pos = pending
@@ -0,0 +1,146 @@
+import atexit
+import collections
+import contextlib
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from globals import LOG_LEVEL, LOG_RATE, LOG_BURST, LOG_RING_SIZE
+
+# every process of the relay logs through here. loggers only put records on a queue, and a listener thread does the
+# formatting and writing, so a slow terminal can't hold up the BLE threads. with a level disabled, a log call costs
+# no more than the level check
+#
+# events are identified by their message template, so log with %-style arguments rather than f-strings:
+#     logger.info('Connected to Beetle - %s', name)
+# and an event logged on every packet can be sampled, keeping one in every n:
+#     logger.debug('Packet received - %s', name, extra={'sample': 100})
+
+FORMAT = '%(asctime)s %(levelname)-7s [{process_name}/%(threadName)s] %(name)s: %(message)s'
+
+
+# lets through LOG_BURST events of each kind at once and LOG_RATE a second after that. how many were held back is
+# added to the next event of the kind to get through
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # (tokens, time of last update, suppressed events, events seen) per event
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            tokens, last_time, num_suppressed, num_seen = self.buckets.get(key, (self.burst, now, 0, 0))
+            num_seen += 1
+
+            sample = getattr(record, 'sample', 1)
+            if num_seen % sample:
+                self.buckets[key] = (tokens, last_time, num_suppressed, num_seen)
+                return False
+
+            tokens = min(self.burst, tokens + (now - last_time) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, num_suppressed + 1, num_seen)
+                return False
+
+            self.buckets[key] = (tokens - 1, now, 0, num_seen)
+
+        if num_suppressed:
+            record.msg = f'{record.msg} ({num_suppressed} similar events suppressed)'
+        return True
+
+
+# keeps the last LOG_RING_SIZE records, rate limited or not, to be dumped if the process crashes
+class RecentEventsHandler(logging.Handler):
+
+    def __init__(self, capacity=LOG_RING_SIZE):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+
+    # deque.append is atomic, so the handler's lock isn't needed
+    def handle(self, record):
+        self.records.append(record)
+        return True
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, stream):
+        for record in list(self.records):
+            stream.write(self.format(record) + '\n')
+        stream.flush()
+
+
+listener = None
+recent_events = None
+
+
+def setupLogging(process_name, level=LOG_LEVEL, stream=None):
+    global listener, recent_events
+
+    formatter = logging.Formatter(FORMAT.format(process_name=process_name))
+    root = logging.getLogger()
+    # a forked process inherits its parent's handlers, whose listener thread didn't survive the fork
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter())
+    root.addHandler(queue_handler)
+
+    recent_events = RecentEventsHandler()
+    recent_events.setFormatter(formatter)
+    root.addHandler(recent_events)
+
+    stream_handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    stream_handler.setFormatter(formatter)
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    installCrashHandlers()
+
+
+def dumpRecentEvents(stream=None):
+    if recent_events is None:
+        return
+
+    stream = stream if stream is not None else sys.stderr
+    stream.write(f'--- last {len(recent_events.records)} log events ---\n')
+    recent_events.dump(stream)
+
+
+# an uncaught exception dumps the recent events, after which the default hook prints the traceback as usual
+def installCrashHandlers():
+    def excepthook(exc_type, exc_value, exc_traceback):
+        dumpRecentEvents()
+        sys.__excepthook__(exc_type, exc_value, exc_traceback)
+
+    def threadExcepthook(args):
+        dumpRecentEvents()
+        threading.__excepthook__(args)
+
+    sys.excepthook = excepthook
+    threading.excepthook = threadExcepthook
+
+
+# for the code run by a process or thread, whose exceptions multiprocessing and ThreadPoolExecutor catch before
+# they reach the hooks above
+@contextlib.contextmanager
+def dumpOnCrash():
+    try:
+        yield
+    except Exception:
+        logging.getLogger(__name__).exception('Crashed')
+        dumpRecentEvents()
+        raise
@@ -1,12 +1,22 @@
 import struct
+
+import numpy as np
+
+import packetize
 from constants import TPacketType
+from motion_window import NUM_CHANNELS
 
 # device IDs
 IMU = 1
 EMITTER = 2
 RECEIVER = 3
 
+# the Beetle sends the raw gyro readings, which are divided down by this before being sent on
+GYRO_SCALE = 131
+
 
+# the layout of the relay packets sent to the Ultra96: a details byte followed by accel_data[3] and gyro_data[3]
+# the packets themselves are packed in batch by the functions below
 class RelayPacket:
 
     PLAYER_ID_SHIFT = 7
@@ -15,58 +25,67 @@ class RelayPacket:
     DISCONNECT_SHIFT = 4
     CONNECT_SHIFT = 3
 
-    def __init__(self):
-        self.details = 0
-        self.gyro_data = (0.0,) * 3
-        self.accel_data = (0.0,) * 3
-
-    # packet attr is in the form
-    # (packet_type, seqnum, player_id, device_id, sent_shot, received_shot, gyro_data[0], gyro_data[1], gyro_data[2],
-    #  accel_data[0], accel_data[1], accel_data[2], checksum)
-    def extractBlePacketData(self, packet_attr):
-        player_id = packet_attr[2]
-        self.details |= (player_id << RelayPacket.PLAYER_ID_SHIFT)
-
-        packet_type = packet_attr[0]
-        if packet_type == TPacketType.PACKET_TYPE_DISCONNECTED.value:
-            self.details |= (1 << RelayPacket.DISCONNECT_SHIFT)
-            return
-        elif packet_type == TPacketType.PACKET_TYPE_CONNECTED.value:
-            self.details |= (1 << RelayPacket.CONNECT_SHIFT)
-            return
-
-        device_id = packet_attr[3]
-        if device_id == IMU:  # data from IMU
-            self.gyro_data = list(packet_attr[6:9])
-            self.processGyroData()  # perform further division of gyro data as required
-            self.accel_data = packet_attr[9:12]
-        elif device_id == EMITTER:  # data from emitter
-            self.details |= (packet_attr[4] << RelayPacket.SEND_SHOT_SHIFT)
-        elif device_id == RECEIVER:  # data from receiver
-            self.details |= (packet_attr[5] << RelayPacket.RECEIVE_SHOT_SHIFT)
-
-    def processGyroData(self):
-        self.gyro_data[:] = map(lambda d: d / 131, self.gyro_data)
-        self.gyro_data = tuple(self.gyro_data)
-
-    def toBytes(self):
-        fmt = '!c6f'
-        packet_bytes = struct.pack(fmt, self.details.to_bytes(1, 'little'), *self.accel_data, *self.gyro_data)
-        return packet_bytes
-
-    def toTuple(self):
-        return (self.details,) + self.gyro_data + self.accel_data
+    # details, accel_data[3], gyro_data[3]
+    FMT = '!c6f'
+
+
+RELAY_PACKET_STRUCT = struct.Struct(RelayPacket.FMT)
+
+
+# the details byte of the relay packet for a record of a player queue: kind is 0 for a packet from the Beetle,
+# otherwise the TPacketType value of a connected/disconnected event, player_id and device_id are those of the queue
+# and Beetle the record came from, and beetle_details is the Beetle packet's details byte, see packet_queue.py. only
+# the shot bits are taken from the packet
+def relayDetails(kind, player_id, device_id, beetle_details):
+    _, _, _, _, sent_shot, received_shot = packetize.DETAILS_TABLE[beetle_details]
+    details = player_id << RelayPacket.PLAYER_ID_SHIFT
+    if kind == TPacketType.PACKET_TYPE_DISCONNECTED.value:
+        return details | (1 << RelayPacket.DISCONNECT_SHIFT)
+    if kind == TPacketType.PACKET_TYPE_CONNECTED.value:
+        return details | (1 << RelayPacket.CONNECT_SHIFT)
+    if device_id == EMITTER:
+        return details | (sent_shot << RelayPacket.SEND_SHOT_SHIFT)
+    if device_id == RECEIVER:
+        return details | (received_shot << RelayPacket.RECEIVE_SHOT_SHIFT)
+    return details
+
+
+# a relay packet with only its details byte set, as sent for shots and connection changes
+def packEvent(details):
+    return RELAY_PACKET_STRUCT.pack(bytes((details,)), 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+
+# the IMU samples of back-to-back Beetle packets, as rows of accel_data[3] followed by gyro_data[3] with the gyro
+# data divided down, all decoded at once
+def decodeImuSamples(buffer):
+    packets = np.frombuffer(buffer, dtype=packetize.PACKET_DTYPE)
+    samples = np.empty((len(packets), NUM_CHANNELS), dtype=np.float32)
+    samples[:, :3] = packets['accel']
+    samples[:, 3:] = packets['gyro'] / GYRO_SCALE
+    return samples
+
+
+# the same layout as RelayPacket.FMT, for packing many IMU samples at once
+RELAY_PACKET_DTYPE = np.dtype([('details', 'u1'), ('accel', '>f4', (3,)), ('gyro', '>f4', (3,))])
+
+
+# packs a window of IMU samples (rows of accel_data[3] followed by gyro_data[3]) as back-to-back relay packets
+def packWindow(player_id, window):
+    packets = np.empty(len(window), dtype=RELAY_PACKET_DTYPE)
+    packets['details'] = player_id << RelayPacket.PLAYER_ID_SHIFT
+    packets['accel'] = window[:, :3]
+    packets['gyro'] = window[:, 3:]
+    return packets.tobytes()
 
 
 if __name__ == "__main__":
-    packet_attr_emitter = (3, 0, 1, 2, 1, 0, 0, 0, 0, 0.0, 0.0, 0.0, b'\x01')
-    packet_attr_imu = (3, 0, 1, 1, 0, 0, 32441, 1245, 14531, 4.3, -13.00, 124.5, b'\x22')
-    rp = RelayPacket()
-    rp.extractBlePacketData(packet_attr_imu)
-    p_bytes = rp.toBytes()
+    imu_details = packetize.detailsAsBytes(3, 0, 1, IMU)[0]
+    imu_packet = packetize.PACKET_STRUCT.pack(imu_details, 32441, 1245, 14531, 4.3, -13.00, 124.5, b'\x22')
+    p_bytes = packWindow(1, decodeImuSamples(imu_packet))
     print(f'{p_bytes}, {len(p_bytes)} bytes sent')
-    print(rp.toTuple())
-
-    data = struct.unpack('!c6f', p_bytes)
-    print(data)
+    print(RELAY_PACKET_STRUCT.unpack(p_bytes))
 
+    emitter_details = packetize.detailsAsBytes(3, 0, 1, EMITTER)[0] | (1 << packetize.SEND_SHOT_SHIFT)
+    p_bytes = packEvent(relayDetails(0, 1, EMITTER, emitter_details))
+    print(f'{p_bytes}, {len(p_bytes)} bytes sent')
+    print(RELAY_PACKET_STRUCT.unpack(p_bytes))
@@ -0,0 +1,186 @@
+import struct
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import packetize
+from tracing import NUM_PRODUCER_STAMPS
+
+PACKET_SIZE = packetize.PACKET_SIZE
+
+# each slot holds a raw Beetle packet, the kind of record it is, its trace and the time it was received
+# kind is 0 for packets from the Beetle, otherwise the TPacketType value of a connected/disconnected event
+# trace is 0 for packets that aren't traced, otherwise 1 + the row of the trace table holding the stamps they came
+# with, see tracing.py
+SLOT_STRUCT = struct.Struct('<20sBB2xd')
+SLOT_SIZE = SLOT_STRUCT.size
+METADATA_STRUCT = struct.Struct('<BB2xd')
+SLOT_DTYPE = np.dtype({'names': ['packet', 'kind', 'trace', 'receive_time'],
+                       'formats': [('u1', PACKET_SIZE), 'u1', 'u1', '<f8'],
+                       'offsets': [0, PACKET_SIZE, PACKET_SIZE + 1, PACKET_SIZE + 4],
+                       'itemsize': SLOT_SIZE})
+
+# the trace table follows the slots, its rows reused in turn. only a sample of the packets is traced, so a row is
+# long read by the time it comes round again
+TRACE_ROWS = 255
+TRACE_TABLE_SIZE = TRACE_ROWS * NUM_PRODUCER_STAMPS * 8
+
+# the write and read counters sit on separate cache lines so the producer and consumer don't contend
+# every counter is only ever written by one side: head, floor and dropped by the producer, tail and shed by the
+# consumer
+HEADER_SIZE = 128
+HEAD_INDEX = 0
+FLOOR_INDEX = 1
+DROPPED_INDEX = 2
+TAIL_INDEX = 8
+SHED_INDEX = 9
+
+
+# single-producer/single-consumer ring of fixed-size packet records in shared memory, all put by the Beetles of
+# device_id
+# head and tail count records forever and are only reduced modulo the capacity when indexing a slot
+# a full ring drops the new record, or with overwrite the oldest one: the producer then moves the floor up past the
+# slot it reuses, and the consumer skips whatever is below the floor, counting it as shed. a record the producer
+# overwrote while the consumer was copying it out is below the floor by the time the copy is checked, so it is
+# thrown away rather than handed out torn
+class SharedPacketRing:
+
+    CAPACITY = 4096
+
+    def __init__(self, capacity=CAPACITY, overwrite=False, device_id=0):
+        if capacity & (capacity - 1):
+            raise ValueError(f'Ring capacity must be a power of two, got {capacity}')
+
+        self.capacity = capacity
+        self.overwrite = overwrite
+        self.device_id = device_id
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + capacity * SLOT_SIZE + TRACE_TABLE_SIZE)
+        self.shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        self.attach()
+
+    def __getstate__(self):
+        return self.shm.name, self.capacity, self.overwrite, self.device_id
+
+    def __setstate__(self, state):
+        name, self.capacity, self.overwrite, self.device_id = state
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.attach()
+
+    def attach(self):
+        self.mask = self.capacity - 1
+        self.buf = self.shm.buf
+        self.counters = self.shm.buf[:HEADER_SIZE].cast('Q')
+        self.slots = np.ndarray((self.capacity,), dtype=SLOT_DTYPE, buffer=self.shm.buf, offset=HEADER_SIZE)
+        self.traces = np.ndarray((TRACE_ROWS, NUM_PRODUCER_STAMPS), dtype='<f8', buffer=self.shm.buf,
+                                 offset=HEADER_SIZE + self.capacity * SLOT_SIZE)
+        # only the producer moves through the trace table
+        self.next_trace_row = 0
+
+    def __len__(self):
+        return self.counters[HEAD_INDEX] - max(self.counters[TAIL_INDEX], self.counters[FLOOR_INDEX])
+
+    def empty(self):
+        return self.counters[HEAD_INDEX] == max(self.counters[TAIL_INDEX], self.counters[FLOOR_INDEX])
+
+    # new records lost because the ring was full
+    def numDropped(self):
+        return self.counters[DROPPED_INDEX]
+
+    # old records overwritten before the consumer got to them
+    def numShed(self):
+        return self.counters[SHED_INDEX] + max(0, self.counters[FLOOR_INDEX] - self.counters[TAIL_INDEX])
+
+    # producer side. never blocks: a full ring drops the new record and counts it, or overwrites the oldest one
+    # packet can be any 20-byte bytes-like object, e.g. a memoryview handed out by the reassembler
+    # trace is the stamps the packet has picked up so far, or None if it isn't traced
+    def put(self, packet, kind=0, receive_time=0.0, trace=None):
+        head = self.counters[HEAD_INDEX]
+        if self.overwrite:
+            if head >= self.capacity:
+                self.counters[FLOOR_INDEX] = head - self.capacity + 1
+        elif head - self.counters[TAIL_INDEX] >= self.capacity:
+            self.counters[DROPPED_INDEX] += 1
+            return False
+
+        trace_row = 0
+        if trace is not None:
+            self.traces[self.next_trace_row] = trace
+            trace_row = self.next_trace_row + 1
+            self.next_trace_row = trace_row % TRACE_ROWS
+
+        offset = HEADER_SIZE + (head & self.mask) * SLOT_SIZE
+        self.buf[offset:offset + PACKET_SIZE] = packet
+        METADATA_STRUCT.pack_into(self.buf, offset + PACKET_SIZE, kind, trace_row, receive_time)
+        # publish the record only after it has been written
+        self.counters[HEAD_INDEX] = head + 1
+        return True
+
+    # consumer side. moves the tail up to the floor, returning the new tail
+    def skipShed(self):
+        tail = self.counters[TAIL_INDEX]
+        floor = self.counters[FLOOR_INDEX]
+        if floor > tail:
+            self.counters[SHED_INDEX] += floor - tail
+            self.counters[TAIL_INDEX] = tail = floor
+        return tail
+
+    # consumer side. copies out up to max_records records as a structured array
+    def getBatch(self, max_records=None):
+        tail = self.skipShed() if self.overwrite else self.counters[TAIL_INDEX]
+        num_records = self.counters[HEAD_INDEX] - tail
+        if max_records is not None:
+            num_records = min(num_records, max_records)
+
+        start = tail & self.mask
+        end = start + num_records
+        if end <= self.capacity:
+            batch = self.slots[start:end].copy()
+        else:
+            batch = np.concatenate((self.slots[start:], self.slots[:end - self.capacity]))
+
+        self.counters[TAIL_INDEX] = tail + num_records
+        if self.overwrite:
+            # records the producer overwrote while they were being copied
+            num_overwritten = min(num_records, self.counters[FLOOR_INDEX] - tail)
+            if num_overwritten > 0:
+                self.counters[SHED_INDEX] += num_overwritten
+                batch = batch[num_overwritten:]
+        return batch
+
+    # consumer side. returns (packet, kind, device_id, receive_time, trace) of the oldest record, or None if the ring
+    # is empty.
+    # trace is the list of stamps the packet came with, or None if it isn't traced
+    def get(self):
+        while True:
+            tail = self.skipShed() if self.overwrite else self.counters[TAIL_INDEX]
+            if self.counters[HEAD_INDEX] == tail:
+                return None
+
+            offset = HEADER_SIZE + (tail & self.mask) * SLOT_SIZE
+            packet, kind, trace_row, receive_time = SLOT_STRUCT.unpack_from(self.buf, offset)
+            if self.overwrite and self.counters[FLOOR_INDEX] > tail:
+                continue
+            trace = self.traces[trace_row - 1].tolist() if trace_row else None
+            self.counters[TAIL_INDEX] = tail + 1
+            return packet, kind, self.device_id, receive_time, trace
+
+    # consumer side. discards everything currently in the ring
+    def clear(self):
+        self.counters[TAIL_INDEX] = self.counters[HEAD_INDEX]
+
+    def close(self):
+        if self.buf is None:
+            return
+
+        # the views have to be released before the shared memory can be closed
+        self.slots = None
+        self.traces = None
+        self.counters.release()
+        self.buf = None
+        self.shm.close()
+
+    def __del__(self):
+        self.close()
+
+    def unlink(self):
+        self.shm.unlink()
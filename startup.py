@@ -0,0 +1,47 @@
+import logging
+import time
+from multiprocessing import Array
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# milestones on the way from starting the relay to the first frame of Beetle data reaching the data_server, in the
+# order they are reported. the Beetles start alongside the tunnel, so their phases can come before the uplink's
+PHASES = ('tunnel_up', 'uplink_connected', 'first_beetle_connected', 'all_beetles_connected', 'first_data',
+          'first_frame')
+PHASE_INDEXES = {phase: i + 1 for i, phase in enumerate(PHASES)}
+
+# when the relay started and when each phase was first reached, 0 until then. perf_counter reads CLOCK_MONOTONIC on
+# Linux, so the times of every process can be compared. made before the processes are forked, so they all share it
+phase_times = Array('d', len(PHASES) + 1, lock=False)
+
+
+def markStart():
+    phase_times[:] = [0.0] * len(phase_times)
+    phase_times[0] = time.perf_counter()
+
+
+# only the first time a phase is reached counts
+def markPhase(phase):
+    i = PHASE_INDEXES[phase]
+    if not phase_times[i]:
+        phase_times[i] = time.perf_counter()
+
+
+# seconds from the start to a phase, or None if it hasn't been reached
+def timeToPhase(phase):
+    phase_time = phase_times[PHASE_INDEXES[phase]]
+    if not phase_time or not phase_times[0]:
+        return None
+    return phase_time - phase_times[0]
+
+
+def registerMetrics():
+    for phase in PHASES:
+        metrics.registry.gauge(f'startup.{phase}_s', lambda phase=phase: timeToPhase(phase))
+
+
+def reportStartup():
+    times = [(phase, timeToPhase(phase)) for phase in PHASES]
+    logger.info('Startup: %s', ', '.join(f'{phase} {seconds:.2f} s' for phase, seconds in times if seconds is not None))
@@ -0,0 +1,133 @@
+import heapq
+from collections import deque
+
+# the records of a player's Beetles reach the Ultra96 client through the player queue in whatever order their
+# threads and the queue's lanes happen to deliver them, but each Beetle's own records come in the order it received
+# them. a StreamMerger puts them back in order of the time they were received, with a k-way merge of the Beetles'
+# streams
+#
+# a record is only released once it is certain no record received before it is still on its way: when every other
+# Beetle has pushed a record received no earlier than it, since none of theirs still to come can be older, or once
+# it is older than reorder_delay. the delay bounds how long a record can wait for the Beetles that have nothing to
+# say, an emitter without shots most of the time, so it trades latency for how late a record can be and still be put
+# in its place. a record that comes in after a later one was released is late, and is released straight away with
+# the time of the record before it, which keeps the stream in order
+
+
+class StreamMerger:
+
+    # sources are the keys the records are merged from, each of whose records have to be pushed in order
+    def __init__(self, sources, reorder_delay):
+        self.reorder_delay = reorder_delay
+        # records of each source waiting to be released, as (receive time, item)
+        self.sources = {source: deque() for source in sources}
+        # (receive time of the first record waiting, source) of every source with records waiting
+        self.heap = []
+        # receive time of the last record pushed from each source, and of the last one released
+        self.last_pushed = dict.fromkeys(sources, float('-inf'))
+        self.last_time = float('-inf')
+
+        # for telemetry
+        self.num_late = 0
+        self.num_unknown = 0
+
+    # a record of a source the merger wasn't made for is dropped and counted rather than taken in
+    def push(self, source, receive_time, item):
+        records = self.sources.get(source)
+        if records is None:
+            self.num_unknown += 1
+            return
+
+        if receive_time < self.last_time:
+            self.num_late += 1
+            receive_time = self.last_time
+
+        if not records:
+            heapq.heappush(self.heap, (receive_time, source))
+        records.append((receive_time, item))
+        self.last_pushed[source] = receive_time
+
+    # every record of source received up to this time can be released as far as the other sources are concerned
+    def horizon(self, source):
+        return min(pushed_time for other, pushed_time in self.last_pushed.items() if other != source)
+
+    # yields (source, receive time, item) of every record due by now, in order of receive time. records of a
+    # source that come before the next source's first one are released in a run, without going through the heap
+    def release(self, now):
+        heap = self.heap
+        watermark = now - self.reorder_delay
+        while heap:
+            head_time, source = heap[0]
+            horizon = max(watermark, self.horizon(source))
+            if head_time > horizon:
+                break
+            heapq.heappop(heap)
+
+            # up to the first record of any other source, and up to the horizon
+            limit = heap[0][0] if heap and heap[0][0] < horizon else horizon
+
+            records = self.sources[source]
+            receive_time, item = records.popleft()
+            while True:
+                self.last_time = receive_time
+                yield source, receive_time, item
+                if not records or records[0][0] > limit:
+                    break
+                receive_time, item = records.popleft()
+
+            if records:
+                heapq.heappush(heap, (records[0][0], source))
+
+    # seconds until the next record is due, None if none is waiting
+    def timeUntilDue(self, now):
+        if not self.heap:
+            return None
+        head_time, source = self.heap[0]
+        if head_time <= self.horizon(source):
+            return 0.0
+        return max(0.0, head_time + self.reorder_delay - now)
+
+    def pending(self):
+        return sum(len(records) for records in self.sources.values())
+
+    # forgets every record waiting, e.g. once the stream is thrown away as stale
+    def clear(self):
+        for records in self.sources.values():
+            records.clear()
+        self.heap.clear()
+        self.last_pushed = dict.fromkeys(self.last_pushed, float('-inf'))
+        self.last_time = float('-inf')
+
+
+if __name__ == "__main__":
+    import random
+
+    # three sources whose records each take up to a second to arrive, in order for each source
+    rng = random.Random(4002)
+    arrivals = []
+    for source in 'abc':
+        arrival_time = 0.0
+        for receive_time in sorted(rng.uniform(0, 10) for _ in range(200)):
+            arrival_time = max(arrival_time, receive_time + rng.uniform(0, 1.0))
+            arrivals.append((arrival_time, source, receive_time))
+    arrivals.sort()
+
+    for reorder_delay in (1.0, 0.1):
+        merger = StreamMerger('abc', reorder_delay)
+        released = []
+        for arrival_time, source, receive_time in arrivals:
+            merger.push(source, receive_time, None)
+            released += [receive_time for _, receive_time, _ in merger.release(arrival_time)]
+        released += [receive_time for _, receive_time, _ in merger.release(float('inf'))]
+        assert len(released) == len(arrivals) and merger.pending() == 0
+        assert released == sorted(released), 'out of order'
+        print(f'reorder delay {reorder_delay} s: {len(released)} records released in order, {merger.num_late} late')
+        assert reorder_delay < 1.0 or not merger.num_late
+
+    # a record older than one already released is late, and keeps the stream in order
+    merger = StreamMerger('ab', reorder_delay=0.0)
+    merger.push('a', 5.0, 'first')
+    assert [item for _, _, item in merger.release(5.0)] == ['first']
+    merger.push('b', 4.0, 'late')
+    assert list(merger.release(5.0)) == [('b', 5.0, 'late')] and merger.num_late == 1
+    print('late records are released in order')
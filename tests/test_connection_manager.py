@@ -0,0 +1,36 @@
+import os
+import time
+
+import pytest
+
+from connection_manager import AdapterSlots
+
+
+def acquireAndExit(slots):
+    pid = os.fork()
+    if pid == 0:
+        slots.acquire(0, 0)
+        os._exit(0)
+    # wait for the child to have exited holding the slot, without reaping it
+    os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+    assert slots.holders[0] == pid
+    return pid
+
+
+# a process that died mid-attempt never releases its slot, whether or not its parent has waited for it yet
+@pytest.mark.parametrize('reaped', [False, True], ids=['zombie', 'reaped'])
+def test_slot_of_dead_process_is_reclaimed(reaped):
+    slots = AdapterSlots(num_adapters=1, max_attempts=1)
+    pid = acquireAndExit(slots)
+    if reaped:
+        os.waitpid(pid, 0)
+
+    start = time.perf_counter()
+    slots.acquire(0, 0)
+    assert time.perf_counter() - start < AdapterSlots.WAIT_TIMEOUT
+    assert slots.holders[0] == os.getpid()
+
+    slots.release(0)
+    assert slots.holders[0] == 0
+    if not reaped:
+        os.waitpid(pid, 0)
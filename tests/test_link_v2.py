@@ -0,0 +1,107 @@
+import pytest
+
+import packetize
+from constants import TPacketType
+from globals import IMU, EMITTER, RECEIVER, PLAYER_ONE, PLAYER_TWO
+from link_v2 import (IMU_SEQ_MODULUS, MAX_NACKS, NACK_INTERVAL, SEQ_MODULUS, SEQ_WINDOW, SHOT_HEADER,
+                     SequenceChecker, SequenceTracker, imuSequence, imuSequenceBits)
+
+
+def imuPacket(seq):
+    details = packetize.detailsAsBytes(TPacketType.PACKET_TYPE_DATA.value, 0, PLAYER_ONE, IMU)[0]
+    return bytes((details | imuSequenceBits(seq % IMU_SEQ_MODULUS),)) + bytes(19)
+
+
+def emitterPacket(seq, shot_seq, is_shot):
+    details = packetize.detailsAsBytes(TPacketType.PACKET_TYPE_DATA.value, seq & 1, PLAYER_ONE, EMITTER)[0]
+    if is_shot:
+        details |= packetize.SEND_SHOT_MASK
+    return bytes((details,)) + SHOT_HEADER.pack(seq, shot_seq) + bytes(15)
+
+
+def test_imu_sequence_bits_round_trip():
+    for seq in range(IMU_SEQ_MODULUS):
+        assert imuSequence(imuSequenceBits(seq)) == seq
+
+
+@pytest.mark.parametrize('missing', [set(), {10, 11}, {10, 11, 20, 21, 22}, set(range(5, 12)), {3, 30, 31}],
+                         ids=['none', 'pair', 'two bursts', 'burst of 7', 'mixed'])
+def test_imu_burst_losses(missing):
+    checker = SequenceChecker(PLAYER_ONE, IMU)
+    sent = [seq for seq in range(40) if seq not in missing]
+    accepted = [seq for seq in sent if checker.accept(imuPacket(seq), 0.0)]
+    # every sample that arrives is passed on, and every gap counted in full
+    assert accepted == sent
+    assert checker.packets.num_lost == len(missing)
+    assert checker.packets.num_duplicates == 0 and checker.packets.num_out_of_window == 0
+
+
+def test_imu_sequence_starts_afresh_on_reset():
+    checker = SequenceChecker(PLAYER_ONE, IMU)
+    checker.accept(imuPacket(0), 0.0)
+    checker.reset()
+    checker.accept(imuPacket(5), 0.0)
+    assert checker.packets.num_lost == 0
+
+
+# IMU packets are never dropped for their numbers, but one that isn't this IMU's data packet is, without counting as
+# a loss
+def test_imu_rejects_other_beetles_packets():
+    checker = SequenceChecker(PLAYER_ONE, IMU)
+    assert checker.accept(imuPacket(0), 0.0)
+
+    receiver_shot = packetize.detailsAsBytes(TPacketType.PACKET_TYPE_DATA.value, 0, PLAYER_TWO, RECEIVER)[0]
+    receiver_shot |= packetize.RECEIVE_SHOT_MASK
+    other_player = packetize.detailsAsBytes(TPacketType.PACKET_TYPE_DATA.value, 0, PLAYER_TWO, IMU)[0]
+    ack = packetize.detailsAsBytes(TPacketType.PACKET_TYPE_ACK.value, 0, PLAYER_ONE, IMU)[0]
+    for details in (receiver_shot, other_player, ack):
+        assert not checker.accept(bytes((details,)) + bytes(19), 0.0)
+
+    assert checker.accept(imuPacket(1), 0.0)
+    assert checker.packets.num_rejected == 3 and checker.packets.num_lost == 0
+
+
+def test_losses_and_duplicates():
+    tracker = SequenceTracker(SEQ_MODULUS, SEQ_WINDOW)
+    assert [tracker.check(seq) for seq in (0, 1, 4, 4, 2, 5)] == [True, True, True, False, False, True]
+    assert tracker.num_lost == 2 and tracker.num_duplicates == 2
+
+
+def test_sequence_wraps():
+    tracker = SequenceTracker(SEQ_MODULUS, SEQ_WINDOW)
+    assert all(tracker.check(seq % SEQ_MODULUS) for seq in range(SEQ_MODULUS - 2, SEQ_MODULUS + 3))
+    assert tracker.num_lost == 0
+
+
+def test_out_of_window_dropped_unless_followed():
+    tracker = SequenceTracker(SEQ_MODULUS, SEQ_WINDOW)
+    tracker.check(0)
+    # a misaligned packet with a nonsense number, after which the stream carries on
+    assert not tracker.check(20000)
+    assert tracker.check(1)
+    # a jump the next packet carries on from is taken as the new sequence
+    assert not tracker.check(30000)
+    assert tracker.check(30001)
+    assert tracker.num_out_of_window == 2 and tracker.num_lost == 0
+
+
+def test_missed_shot_asked_for_again_and_recovered():
+    checker = SequenceChecker(PLAYER_ONE, EMITTER)
+    assert checker.accept(emitterPacket(0, 0, False), 0.0)
+    # shots 1 and 2 were lost along with their packets
+    assert checker.accept(emitterPacket(3, 3, True), 0.0)
+    assert checker.packets.num_lost == 2 and checker.shots.num_missed == 2
+    assert sorted(checker.dueNacks(0.0)) == [1, 2]
+    assert checker.dueNacks(0.0) == []
+
+    # the retransmission comes in out of the packet sequence, and only once
+    assert checker.accept(emitterPacket(1, 1, True), 0.01)
+    assert not checker.accept(emitterPacket(1, 1, True), 0.01)
+    assert checker.shots.num_recovered == 1 and checker.packets.num_duplicates == 1
+
+    # shot 2 is given up on after MAX_NACKS
+    now = 0.0
+    for _ in range(MAX_NACKS):
+        now += NACK_INTERVAL
+        checker.dueNacks(now)
+    assert checker.shots.num_given_up == 1 and not checker.shots.missing
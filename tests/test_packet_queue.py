@@ -0,0 +1,52 @@
+import struct
+
+import pytest
+
+from globals import IMU, EMITTER
+from packet_queue import createPacketQueue, QUEUE_BACKEND_PIPE, QUEUE_BACKEND_SHM
+
+CAPACITY = 64
+NUM_PUT = 1000
+
+
+def imuPacket(n):
+    return struct.pack('<I16x', n)
+
+
+@pytest.fixture(params=[QUEUE_BACKEND_PIPE, QUEUE_BACKEND_SHM])
+def player_queue(request):
+    player_queue = createPacketQueue(request.param, imu_lane_capacity=CAPACITY)
+    yield player_queue
+    player_queue.close()
+    player_queue.unlink()
+
+
+def test_imu_lane_keeps_newest_samples_after_consumer_stall(player_queue):
+    # the consumer reads nothing while the Beetles keep sending, as when the uplink blocks
+    for n in range(NUM_PUT):
+        player_queue.put(IMU, (0, 0, 0, IMU), imuPacket(n), float(n))
+    player_queue.put(EMITTER, (0, 0, 0, EMITTER), struct.pack('<I16x', 0xFFFFFFFF), float(NUM_PUT))
+
+    # control records are served first and never shed
+    packet, kind, device_id, receive_time, _ = player_queue.get()
+    assert kind == 0 and device_id == EMITTER and receive_time == NUM_PUT
+
+    packet, kind, device_id, receive_time, _ = player_queue.get()
+    assert device_id == IMU and struct.unpack_from('<I', packet)[0] >= NUM_PUT - CAPACITY
+    assert player_queue.numShed() >= NUM_PUT - CAPACITY
+    assert player_queue.numDropped() == 0
+
+    received = [struct.unpack_from('<I', packet)[0]]
+    while not player_queue.empty():
+        received.append(struct.unpack_from('<I', player_queue.get()[0])[0])
+    assert received == list(range(NUM_PUT - len(received), NUM_PUT))
+
+
+# the lane comes from the Beetle putting the record, whatever device bits a corrupted packet has
+def test_put_routes_by_beetle_not_packet(player_queue):
+    player_queue.put(IMU, (0, 0, 0, 0), imuPacket(1), 1.0)
+    player_queue.put(EMITTER, (0, 0, 0, 0), imuPacket(2), 2.0)
+
+    assert player_queue.numShed() == 0 and player_queue.depth() == 2
+    assert player_queue.get()[2:4] == (EMITTER, 2.0)
+    assert player_queue.get()[2:4] == (IMU, 1.0)
@@ -0,0 +1,67 @@
+import random
+
+from benchmarks.bench_packetize import makePacket
+from globals import IMU, EMITTER, PLAYER_ONE, PLAYER_TWO
+from reassembler import PacketReassembler
+import packetize
+
+NUM_PACKETS = 20000
+
+
+def withIds(packet, player_id, device_id):
+    packet = bytearray(packet)
+    packet[0] = (packet[0] & ~(packetize.PLAYER_ID_MASK | packetize.DEVICE_ID_MASK)
+                 | player_id << packetize.PLAYER_ID_SHIFT | device_id << packetize.DEVICE_ID_SHIFT)
+    packet[packetize.CHECKSUM_POS] = 0
+    packet[packetize.CHECKSUM_POS] = packetize.getChecksum(packet)
+    return bytes(packet)
+
+
+def corrupt(packet, rng):
+    packet = bytearray(packet)
+    pos = rng.randrange(len(packet))
+    packet[pos] ^= rng.randrange(1, 256)
+    return bytes(packet)
+
+
+# a corrupted packet that arrives as a notification of its own is dropped whole, rather than slid into, so the
+# windows straddling it and the next packet never pass for a packet
+def test_corrupt_notifications_give_no_false_positives():
+    rng = random.Random(4002)
+    reassembler = PacketReassembler(player_id=PLAYER_ONE, device_id=IMU)
+    sent = []
+    received = []
+    for _ in range(NUM_PACKETS):
+        packet = makePacket(IMU, rng)
+        if rng.random() < 0.1:
+            packet = corrupt(packet, rng)
+        else:
+            sent.append(packet)
+        received += [bytes(received_packet) for received_packet in reassembler.feed(packet)]
+
+    assert received == sent
+
+
+def test_other_beetles_packets_are_rejected():
+    rng = random.Random(4002)
+    reassembler = PacketReassembler(player_id=PLAYER_ONE, device_id=IMU)
+    own = withIds(makePacket(IMU, rng), PLAYER_ONE, IMU)
+    other_player = withIds(makePacket(IMU, rng), PLAYER_TWO, IMU)
+    other_device = withIds(makePacket(EMITTER, rng), PLAYER_ONE, EMITTER)
+
+    assert [bytes(packet) for packet in reassembler.feed(other_player + own + other_device)] == [own]
+    assert not reassembler.feed(other_device)
+    assert not reassembler.feed(other_player)
+
+
+# bytes lost mid-stream leave the packets misaligned within a notification, which resync still recovers from
+def test_resync_recovers_alignment():
+    rng = random.Random(4002)
+    reassembler = PacketReassembler(player_id=PLAYER_ONE, device_id=IMU)
+    packets = [makePacket(IMU, rng) for _ in range(3)]
+
+    received = reassembler.feed(packets[0][7:] + packets[1] + packets[2][:5])
+    received += reassembler.feed(packets[2][5:])
+
+    assert [bytes(packet) for packet in received] == packets[1:]
+    assert reassembler.num_resyncs == 1
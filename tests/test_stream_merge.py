@@ -0,0 +1,25 @@
+from globals import IMU, EMITTER, RECEIVER, PLAYER_ONE
+from packet_queue import createPacketQueue, QUEUE_BACKEND_PIPE
+from stream_merge import StreamMerger
+from ultra96_client import Ultra96Client
+
+
+def test_unknown_source_is_dropped_and_counted():
+    merger = StreamMerger((IMU, EMITTER, RECEIVER), reorder_delay=0.0)
+    merger.push(0, 1.0, 'garbled')
+    merger.push(IMU, 2.0, 'sample')
+
+    assert merger.num_unknown == 1 and merger.pending() == 1
+    assert [item for _, _, item in merger.release(2.0)] == ['sample']
+
+
+def test_client_drops_record_of_unknown_device():
+    player_queue = createPacketQueue(QUEUE_BACKEND_PIPE)
+    player_queue.unlink()
+    client = Ultra96Client([player_queue], ('localhost', 0), reorder_delay=0.01)
+
+    client.handleRecord(None, PLAYER_ONE, (bytes(20), 0, 0, 1.0, None))
+
+    merger = client.mergers[PLAYER_ONE]
+    assert merger.num_unknown == 1 and merger.pending() == 0
+    player_queue.close()
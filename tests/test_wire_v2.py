@@ -0,0 +1,150 @@
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from features import computeFeatures, packFeatures
+from motion_window import NUM_CHANNELS
+from relay_packet import RelayPacket
+from wire_v2 import (FLAG_DELTA, HELLO, RELAY_ACK_MAGIC, WINDOW_HEADER, EventRecord, FeaturesRecord, ShotRecord,
+                     WindowRecord, decodeRecords, encodeEvent, encodeFeatures, encodeShot, encodeWindow,
+                     negotiateVersion, offerVersion)
+
+rng = np.random.default_rng(4002)
+t = np.linspace(0, 2 * np.pi, 50, dtype=np.float32)[:, None]
+SMOOTH = (np.sin(t * np.arange(1, NUM_CHANNELS + 1)) * np.array([2, 2, 2, 250, 250, 250])).astype(np.float32)
+NOISY = rng.normal(scale=100, size=(50, NUM_CHANNELS)).astype(np.float32)
+STILL = np.zeros((50, NUM_CHANNELS), dtype=np.float32)
+SHORT = SMOOTH[:1]
+
+
+def roundTrip(window, delta):
+    record = encodeWindow(1, 70000, 1234.5, window, delta)
+    records, consumed = decodeRecords(record)
+    assert consumed == len(record) and len(records) == 1
+    decoded = records[0]
+    assert decoded.player_id == 1 and decoded.seq == 70000 & 0xFFFF and decoded.timestamp == 1234.5
+    # every sample is within half a step of its channel's scale, plus float32 rounding
+    error = np.abs(decoded.samples - window)
+    assert np.all(error <= decoded.scales * 0.5 + np.abs(window) * 1e-6 + 1e-12), error.max()
+    return record
+
+
+@pytest.mark.parametrize('delta', [True, False])
+@pytest.mark.parametrize('window', [SMOOTH, NOISY, STILL, SHORT], ids=['smooth', 'noisy', 'still', 'short'])
+def test_window_round_trip(window, delta):
+    roundTrip(window, delta)
+
+
+# smooth motion is delta encoded, noise and single samples aren't
+@pytest.mark.parametrize('window, flags', [(SMOOTH, FLAG_DELTA), (NOISY, 0), (SHORT, 0)])
+def test_delta_only_for_smooth_windows(window, flags):
+    assert WINDOW_HEADER.unpack_from(roundTrip(window, True))[5] == flags
+
+
+def test_stream_decoded_in_pieces():
+    stream = (encodeEvent(1 << RelayPacket.CONNECT_SHIFT) + encodeWindow(0, 1, 0.0, SMOOTH)
+              + encodeFeatures(packFeatures(1, computeFeatures(NOISY))) + encodeEvent(1 << RelayPacket.SEND_SHOT_SHIFT)
+              + encodeShot(1 << RelayPacket.RECEIVE_SHOT_SHIFT, 65537, 12) + encodeShot(0, 2, -1))
+    decoded = []
+    buffer = b''
+    for i in range(0, len(stream), 7):
+        buffer += stream[i:i + 7]
+        records, consumed = decodeRecords(buffer)
+        decoded += records
+        buffer = buffer[consumed:]
+
+    assert not buffer
+    assert [type(record) for record in decoded] == [EventRecord, WindowRecord, FeaturesRecord, EventRecord,
+                                                    ShotRecord, ShotRecord]
+    assert decoded[4] == (1 << RelayPacket.RECEIVE_SHOT_SHIFT, 1, 12) and decoded[5] == (0, 2, -1)
+
+
+def test_partial_record_left_in_buffer():
+    record = encodeWindow(0, 1, 0.0, NOISY)
+    assert decodeRecords(record[:-1]) == ([], 0)
+
+
+def test_unknown_record_type():
+    with pytest.raises(ValueError):
+        decodeRecords(b'\xff')
+
+
+# runs serve(conn) on the data_server's side of a new connection, and returns the relay's side
+def connect(serve):
+    server = socket.create_server(('localhost', 0))
+    result = {}
+
+    def accept():
+        conn, _ = server.accept()
+        server.close()
+        with conn:
+            result['server'] = serve(conn)
+
+    thread = threading.Thread(target=accept)
+    thread.start()
+    relay = socket.create_connection(server.getsockname())
+    return relay, thread, result
+
+
+@pytest.mark.parametrize('server_version, expected', [(3, 3), (2, 2), (1, 1)])
+def test_negotiation(server_version, expected):
+    def serve(conn):
+        version = offerVersion(conn, server_version)
+        # until the relay hangs up, which it only does after the hello
+        conn.recv(1)
+        return version
+
+    relay, thread, result = connect(serve)
+    with relay:
+        version = negotiateVersion(relay, timeout=1.0 if server_version > 1 else 0.1)
+    thread.join()
+    assert version == expected and result['server'] == expected
+
+
+def test_relay_caps_version():
+    relay, thread, result = connect(lambda conn: offerVersion(conn, 3))
+    with relay:
+        version = negotiateVersion(relay, max_version=2, timeout=1.0)
+    thread.join()
+    assert version == 2 and result['server'] == 2
+
+
+# a hello that reaches the relay after it gave up on one: the relay sends version 1, and the data_server, which waits
+# for the relay's first bytes however long they take, reads them as version 1 rather than as an answer
+def test_late_hello():
+    first_bytes = bytes(8)
+
+    def serve(conn):
+        time.sleep(0.3)
+        version = offerVersion(conn, 3)
+        return version, conn.recv(len(first_bytes), socket.MSG_WAITALL)
+
+    relay, thread, result = connect(serve)
+    with relay:
+        version = negotiateVersion(relay, timeout=0.1)
+        relay.sendall(first_bytes)
+        thread.join()
+    assert version == 1
+    assert result['server'] == (1, first_bytes)
+
+
+def test_answer_in_pieces():
+    relay, thread, result = connect(lambda conn: offerVersion(conn, 3))
+    with relay:
+        assert relay.recv(HELLO.size, socket.MSG_WAITALL)
+        answer = HELLO.pack(RELAY_ACK_MAGIC, 2)
+        relay.sendall(answer[:3])
+        time.sleep(0.05)
+        relay.sendall(answer[3:])
+        thread.join()
+    assert result['server'] == 2
+
+
+def test_relay_closes_before_answering():
+    relay, thread, result = connect(lambda conn: offerVersion(conn, 3))
+    relay.close()
+    thread.join()
+    assert result['server'] == 1
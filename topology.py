@@ -0,0 +1,77 @@
+from collections import namedtuple
+
+from globals import BEETLE_TOPOLOGY, NUM_ADAPTERS, IMU, EMITTER, RECEIVER, device_dict
+
+# a Beetle as placed by the topology, adapter being the n of its hcin
+BeetleSpec = namedtuple('BeetleSpec', ['player_id', 'device_id', 'mac_address', 'adapter'])
+
+# relative load of each kind of Beetle, on both its adapter's radio and its worker's CPU. the IMU streams samples
+# continuously, the emitter and receiver mostly send when a shot is fired
+DEVICE_LOADS = {IMU: 4, EMITTER: 1, RECEIVER: 1}
+
+# the player id is a single bit in the Beetles' packets and in the relay packets sent to the Ultra96
+MAX_PLAYERS = 2
+
+
+class TopologyError(Exception):
+    pass
+
+
+# every Beetle of the topology, with an adapter picked for those that don't have one: the least loaded adapter at
+# the time, going through the heaviest Beetles first
+def beetleSpecs(topology=BEETLE_TOPOLOGY, num_adapters=NUM_ADAPTERS):
+    if len(topology) > MAX_PLAYERS:
+        raise TopologyError(f'{len(topology)} players configured, the packet formats only have room for '
+                            f'{MAX_PLAYERS}')
+
+    specs = []
+    adapter_loads = [0] * num_adapters
+    unplaced = []
+    for player_id, beetles in enumerate(topology):
+        if len(beetles) > len(device_dict):
+            raise TopologyError(f'Player {player_id + 1} has {len(beetles)} Beetles, at most {len(device_dict)} '
+                                f'are supported')
+        for i, (mac_address, adapter) in enumerate(beetles):
+            spec = BeetleSpec(player_id, i + 1, mac_address, adapter)
+            if adapter is None:
+                unplaced.append(spec)
+            elif not 0 <= adapter < num_adapters:
+                raise TopologyError(f'{mac_address} is on hci{adapter}, only {num_adapters} adapters are configured')
+            else:
+                adapter_loads[adapter] += DEVICE_LOADS[spec.device_id]
+            specs.append(spec)
+
+    placed = {}
+    for spec in sorted(unplaced, key=lambda spec: -DEVICE_LOADS[spec.device_id]):
+        adapter = min(range(num_adapters), key=lambda adapter: adapter_loads[adapter])
+        adapter_loads[adapter] += DEVICE_LOADS[spec.device_id]
+        placed[spec.mac_address] = spec._replace(adapter=adapter)
+
+    return [placed.get(spec.mac_address, spec) for spec in specs]
+
+
+# splits the Beetles over num_workers processes, heaviest first onto the least loaded worker. between workers with
+# the same load, the one with the fewest Beetles on the same adapter is picked, so each worker's connection attempts
+# are spread over the adapters
+def shardBeetles(specs, num_workers):
+    shards = [[] for _ in range(num_workers)]
+    worker_loads = [0] * num_workers
+
+    def adapterCount(worker, adapter):
+        return sum(1 for spec in shards[worker] if spec.adapter == adapter)
+
+    for spec in sorted(specs, key=lambda spec: -DEVICE_LOADS[spec.device_id]):
+        worker = min(range(num_workers), key=lambda worker: (worker_loads[worker], adapterCount(worker, spec.adapter)))
+        shards[worker].append(spec)
+        worker_loads[worker] += DEVICE_LOADS[spec.device_id]
+
+    # within a worker, the Beetles are started in topology order
+    return [sorted(shard, key=lambda spec: (spec.player_id, spec.device_id)) for shard in shards if shard]
+
+
+# the Beetles of each player on their own, as the thread per Beetle engine has always run them
+def shardByPlayer(specs):
+    shards = {}
+    for spec in specs:
+        shards.setdefault(spec.player_id, []).append(spec)
+    return list(shards.values())
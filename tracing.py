@@ -0,0 +1,154 @@
+import argparse
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+from globals import IMU
+
+logger = logging.getLogger(__name__)
+
+# a sampled packet is stamped with the perf_counter time it reached each stage on its way from the Beetle to the
+# Ultra96. perf_counter reads CLOCK_MONOTONIC on Linux, so the stamps of the Beetle processes and of the Ultra96
+# client can be compared
+#   notification   BeetleDelegate.handleNotification was called with the notification it came in
+#   check_buffer   Beetle.checkBuffer got it out of the reassembler
+#   deserialize    Beetle.handleData interpreted its details byte
+#   enqueue        Beetle.enqueueData put it in its player queue
+#   dequeue        the Ultra96 client got it out of the player queue
+#   window         the Ultra96 client decided what to send for it: at once for an event, and for an IMU sample once
+#                  the window it is in was cut, or once it can no longer end up in a window
+#   send           the batch it was sent in left through the socket, 0 for an IMU sample that was in no window
+STAGES = ('notification', 'check_buffer', 'deserialize', 'enqueue', 'dequeue', 'window', 'send')
+NOTIFICATION, CHECK_BUFFER, DESERIALIZE, ENQUEUE, DEQUEUE, WINDOW, SEND = range(len(STAGES))
+# the stamps taken in the Beetle's process, which travel through the player queue along with the packet
+NUM_PRODUCER_STAMPS = DEQUEUE
+
+# a trace file is the magic followed by back-to-back records of finished traces, each written with a single call so
+# the file of a relay that was killed still reads back
+MAGIC = b'BLETRC\x00\x01'
+# player id, device id, the time of every stage
+TRACE_RECORD = struct.Struct(f'<BB{len(STAGES)}d')
+TRACE_DTYPE = np.dtype([('player_id', 'u1'), ('device_id', 'u1'), ('stamps', '<f8', len(STAGES))])
+
+
+# Beetle side: a trace starting with the notification being handled, received at now
+def startTrace(now=None):
+    stamps = [0.0] * NUM_PRODUCER_STAMPS
+    stamps[NOTIFICATION] = time.perf_counter() if now is None else now
+    return stamps
+
+
+# Ultra96 client side: the trace of a packet just taken out of a player queue, with the stamps it came with
+class Trace:
+
+    __slots__ = ('player_id', 'device_id', 'stamps')
+
+    def __init__(self, player_id, device_id, producer_stamps):
+        self.player_id = player_id
+        self.device_id = device_id
+        self.stamps = list(producer_stamps) + [0.0] * (len(STAGES) - NUM_PRODUCER_STAMPS)
+
+    def stamp(self, stage, now=None):
+        self.stamps[stage] = time.perf_counter() if now is None else now
+
+
+class TraceWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, MAGIC)
+        self.num_traces = 0
+
+    def write(self, trace):
+        os.write(self.fd, TRACE_RECORD.pack(trace.player_id, trace.device_id, *trace.stamps))
+        self.num_traces += 1
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# every run of the relay, i.e. every game, is traced to a file of its own
+def openTraceFile(trace_dir):
+    if trace_dir is None:
+        return None
+    os.makedirs(trace_dir, exist_ok=True)
+    path = os.path.join(trace_dir, f'trace-{time.strftime("%Y%m%d-%H%M%S")}.bletrc')
+    logger.info('Tracing packets to %s', path)
+    return TraceWriter(path)
+
+
+def readTraces(path):
+    with open(path, 'rb') as trace_file:
+        data = trace_file.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not a trace file')
+    # a record cut short by a crash is left out
+    num_traces = (len(data) - len(MAGIC)) // TRACE_RECORD.size
+    return np.frombuffer(data, dtype=TRACE_DTYPE, count=num_traces, offset=len(MAGIC))
+
+
+def formatLatencies(latencies):
+    if not len(latencies):
+        return f'{"-":>10} {"-":>10} {"-":>10}'
+    p50, p99, worst = np.percentile(latencies, [50, 99, 100]) * 1e3
+    return f'{p50:10.3f} {p99:10.3f} {worst:10.3f}'
+
+
+# time spent in each stage, i.e. since the stage before it, and end to end, in ms
+def reportStages(traces):
+    stamps = traces['stamps']
+    print(f'  {"stage":<14} {"p50 ms":>10} {"p99 ms":>10} {"max ms":>10}')
+    for stage in range(1, len(STAGES)):
+        reached = stamps[:, stage] > 0
+        print(f'  {STAGES[stage]:<14} {formatLatencies(stamps[reached, stage] - stamps[reached, stage - 1])}')
+    sent = stamps[:, SEND] > 0
+    print(f'  {"total":<14} {formatLatencies(stamps[sent, SEND] - stamps[sent, NOTIFICATION])}')
+    if not np.all(sent):
+        print(f'  {np.count_nonzero(~sent)} IMU samples were in no window, so never sent')
+
+
+# end-to-end latency over the course of the game, every interval seconds
+def reportTimeline(traces, interval):
+    stamps = traces['stamps']
+    sent = stamps[:, SEND] > 0
+    start = stamps[:, NOTIFICATION].min()
+    buckets = ((stamps[:, NOTIFICATION] - start) // interval).astype(int)
+    print(f'  {"from s":>8} {"traces":>7} {"p50 ms":>10} {"p99 ms":>10} {"max ms":>10}')
+    for bucket in range(buckets.max() + 1):
+        in_bucket = (buckets == bucket) & sent
+        latencies = stamps[in_bucket, SEND] - stamps[in_bucket, NOTIFICATION]
+        print(f'  {bucket * interval:8.0f} {np.count_nonzero(buckets == bucket):7d} {formatLatencies(latencies)}')
+
+
+def report(paths, interval):
+    for path in paths:
+        traces = readTraces(path)
+        print(f'{path}: {len(traces)} traces')
+        if not len(traces):
+            continue
+        duration = traces['stamps'][:, NOTIFICATION].max() - traces['stamps'][:, NOTIFICATION].min()
+        print(f'  over {duration:.1f} s')
+
+        # IMU samples wait for their window, so they are reported apart from the events that are sent at once
+        for kind, traces_of_kind in (('events', traces[traces['device_id'] != IMU]),
+                                     ('IMU samples', traces[traces['device_id'] == IMU])):
+            if not len(traces_of_kind):
+                continue
+            print(f' {kind} ({len(traces_of_kind)})')
+            reportStages(traces_of_kind)
+            print(f' {kind} timeline')
+            reportTimeline(traces_of_kind, interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-stage latency of the packets traced through the relay')
+    parser.add_argument('paths', nargs='+', help='trace files, one per game')
+    parser.add_argument('--interval', type=float, default=10.0, help='seconds per row of the timeline')
+    args = parser.parse_args()
+    report(args.paths, args.interval)
@@ -0,0 +1,253 @@
+import os
+import select
+import time
+
+# Client Characteristic Configuration Descriptor, where notifications are switched on
+CCCD_UUID = 0x2902
+
+
+class TransportError(Exception):
+    pass
+
+
+try:
+    from bluepy.btle import Peripheral, BTLEException
+except ImportError:
+    # bluepy only runs on Linux, the simulated transport works without it
+    Peripheral = None
+    BTLEException = TransportError
+
+
+# a Beetle talks to its hardware through a transport with the methods below, so the same protocol logic can run
+# over bluepy or a simulated peripheral, and be driven by a thread per Beetle or a single event loop
+
+
+# bluepy reads its helper's output a line at a time from a buffered text pipe, and polls the pipe's file descriptor
+# to wait for a line. lines already read into the buffer never make the descriptor readable, so they would sit there
+# until the helper sends something else. a HelperPipe stands in for both the pipe and bluepy's poller: it reads the
+# descriptor itself, and knows when a whole line is waiting in its buffer
+class HelperPipe:
+
+    def __init__(self, pipe):
+        # kept so the descriptor stays open for as long as the helper runs
+        self.pipe = pipe
+        self.fd = pipe.fileno()
+        self.buffer = bytearray()
+
+    def fileno(self):
+        return self.fd
+
+    # True if a whole line can be read without blocking, or the helper has closed the pipe
+    def hasLine(self):
+        while b'\n' not in self.buffer:
+            if not select.select([self.fd], [], [], 0)[0]:
+                return False
+            data = os.read(self.fd, 65536)
+            if not data:
+                return True
+            self.buffer += data
+        return True
+
+    def readline(self):
+        while b'\n' not in self.buffer:
+            data = os.read(self.fd, 65536)
+            if not data:
+                break
+            self.buffer += data
+
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line.decode()
+
+    # select.poll's interface, for the one pipe bluepy registers. timeout is in milliseconds, None to wait forever
+    def poll(self, timeout=None):
+        if self.hasLine():
+            return [(self.fd, select.POLLIN)]
+        if not select.select([self.fd], [], [], None if timeout is None else timeout / 1000)[0]:
+            return []
+        return [(self.fd, select.POLLIN)]
+
+    def register(self, fd, eventmask=None):
+        pass
+
+    def unregister(self, fd):
+        pass
+
+
+# BluepyTransport swaps bluepy's helper pipe and poller for a HelperPipe, which relies on Peripheral's private
+# _startHelper, _helper and _poller, as in bluepy 1.3.0 (the version pinned in requirements.txt). they aren't part of
+# bluepy's interface, so they are checked for rather than assumed
+def checkBluepyInternals(peripheral):
+    if not callable(getattr(peripheral, '_startHelper', None)):
+        raise TransportError('bluepy.btle.Peripheral has no _startHelper, this bluepy version is not supported')
+
+
+def checkHelperStarted(peripheral):
+    helper = getattr(peripheral, '_helper', None)
+    if getattr(helper, 'stdout', None) is None or not hasattr(peripheral, '_poller'):
+        # the helper may well have been started, and nothing else would stop it
+        if hasattr(helper, 'kill'):
+            helper.kill()
+        raise TransportError('bluepy.btle.Peripheral has no _helper.stdout or _poller, '
+                             'this bluepy version is not supported')
+
+
+class BluepyTransport:
+
+    # bluepy only polls for a line when given a timeout, and otherwise blocks until the helper sends one. once a whole
+    # line is known to be waiting, it is read with this timeout, which only comes into play if the line isn't a
+    # notification and bluepy goes on to wait for another
+    LINE_TIMEOUT = 0.001
+
+    # adapter is the n of the hcin adapter to connect through
+    def __init__(self, mac_address, adapter=0):
+        self.mac_address = mac_address
+        self.adapter = adapter
+        self.peripheral = None
+        self.pipe = None
+
+    def connect(self):
+        if Peripheral is None:
+            raise TransportError('bluepy is not installed')
+        try:
+            # the helper is started before connecting so its pipe can be swapped before anything is read from it
+            self.peripheral = Peripheral()
+            checkBluepyInternals(self.peripheral)
+            self.peripheral._startHelper(self.adapter)
+            checkHelperStarted(self.peripheral)
+            self.pipe = HelperPipe(self.peripheral._helper.stdout)
+            self.peripheral._helper.stdout = self.pipe
+            self.peripheral._poller = self.pipe
+            self.peripheral.connect(self.mac_address, iface=self.adapter)
+        except BTLEException as e:
+            raise TransportError(str(e)) from e
+
+    # obtain the GATT handles of a characteristic and of its CCCD, or None for the CCCD if it has none
+    def discoverHandles(self, service_uuid, char_uuid):
+        try:
+            service = self.peripheral.getServiceByUUID(service_uuid)
+            characteristic = service.getCharacteristics(char_uuid)[0]
+            descriptors = characteristic.getDescriptors(forUUID=CCCD_UUID)
+            return characteristic.getHandle(), descriptors[0].handle if descriptors else None
+        except BTLEException as e:
+            raise TransportError(str(e)) from e
+
+    def write(self, handle, data, with_response=False):
+        try:
+            self.peripheral.writeCharacteristic(handle, data, with_response)
+        except BTLEException as e:
+            raise TransportError(str(e)) from e
+
+    def setDelegate(self, delegate):
+        self.peripheral.setDelegate(delegate)
+
+    # returns True if a notification was handed to the delegate before the timeout. with no timeout it never blocks
+    def waitForNotifications(self, timeout):
+        try:
+            if not timeout:
+                if not self.pipe.hasLine():
+                    return False
+                timeout = BluepyTransport.LINE_TIMEOUT
+            return self.peripheral.waitForNotifications(timeout)
+        except BTLEException as e:
+            raise TransportError(str(e)) from e
+
+    # bluepy talks to its helper process over a pipe, which becomes readable when a notification comes in. lines
+    # already read from it are only handed over by waitForNotifications, so it has to be called with no timeout until
+    # it returns False before waiting on the pipe again
+    def fileno(self):
+        return self.pipe.fileno()
+
+    # only needed by transports without a file descriptor to wait on
+    def timeUntilNotification(self):
+        return None
+
+    def disconnect(self):
+        if self.peripheral is None:
+            return
+        try:
+            self.peripheral.disconnect()
+        except BTLEException as e:
+            raise TransportError(str(e)) from e
+
+
+# delivers the notifications of a simulated peripheral (see beetle_simulator.py) in the calling thread, at the
+# times the peripheral would have sent them
+class SimulatedTransport:
+
+    CHAR_HANDLE = 0x25
+    CCCD_HANDLE = 0x26
+
+    # BLE round trips taken by service and characteristic discovery
+    DISCOVERY_ROUND_TRIPS = 6
+
+    # round_trip is how long a request waiting for a response from the peripheral takes, e.g. a connection
+    # interval or two, and handles are those the simulated firmware puts its serial characteristic at
+    def __init__(self, peripheral, round_trip=0.0, handles=(CHAR_HANDLE, CCCD_HANDLE)):
+        self.peripheral = peripheral
+        self.round_trip = round_trip
+        self.char_handle, self.cccd_handle = handles
+        self.delegate = None
+        self.is_connected = False
+
+        # when the notification being handled was sent by the peripheral
+        self.notification_time = None
+
+    def connect(self):
+        if not self.peripheral.acceptConnection():
+            raise TransportError('Simulated connection failure')
+        self.is_connected = True
+        self.peripheral.onConnect(time.perf_counter())
+
+    def discoverHandles(self, service_uuid, char_uuid):
+        time.sleep(SimulatedTransport.DISCOVERY_ROUND_TRIPS * self.round_trip)
+        return self.char_handle, self.cccd_handle
+
+    def write(self, handle, data, with_response=False):
+        if not self.is_connected:
+            raise TransportError('Not connected')
+        if with_response:
+            time.sleep(self.round_trip)
+        if handle not in (self.char_handle, self.cccd_handle):
+            raise TransportError(f'Invalid handle 0x{handle:x}')
+        if handle == self.char_handle:
+            self.peripheral.onWrite(bytes(data), time.perf_counter())
+
+    def setDelegate(self, delegate):
+        self.delegate = delegate
+
+    def waitForNotifications(self, timeout):
+        if not self.is_connected:
+            raise TransportError('Not connected')
+
+        deadline = time.perf_counter() + timeout
+        while True:
+            now = time.perf_counter()
+            notifications = self.peripheral.poll(now)
+            if self.peripheral.is_link_lost:
+                self.is_connected = False
+                raise TransportError('Simulated disconnect')
+
+            if notifications:
+                for self.notification_time, notification in notifications:
+                    self.delegate.handleNotification(self.char_handle, notification)
+                return True
+
+            next_time = self.peripheral.nextNotificationTime()
+            if now >= deadline:
+                return False
+            time.sleep(max(0.0, min(deadline, next_time if next_time is not None else deadline) - now))
+
+    def fileno(self):
+        return None
+
+    def timeUntilNotification(self):
+        next_time = self.peripheral.nextNotificationTime()
+        if next_time is None:
+            return None
+        return max(0.0, next_time - time.perf_counter())
+
+    def disconnect(self):
+        self.is_connected = False
+        self.peripheral.onDisconnect()
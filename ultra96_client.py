@@ -1,14 +1,23 @@
-from dotenv import load_dotenv
-import sshtunnel
+import logging
 import os
 import socket
 import time
-from globals import IMU, EMITTER, RECEIVER, PLAYER_ONE, PLAYER_TWO, is_connected_to_u96
-from math import sqrt
-from relay_packet import RelayPacket
-
-MAGNITUDE_THRESHOLD = 1.5
-NUM_PACKETS = 50
+from globals import IMU, EMITTER, RECEIVER, is_connected_to_u96, UPLINK_FRAMED, RELAY_FEATURES, UPLINK_WIRE_VERSION, \
+    UPLINK_DELTA, MERGE_REORDER_DELAY
+import metrics
+import packetize
+import startup
+from constants import TPacketType
+from relay_packet import RelayPacket, packWindow, packEvent, relayDetails, decodeImuSamples
+from features import computeFeatures, packFeatures
+from motion_window import MotionWindow
+from packet_queue import PacketQueueSelector, eventPacket
+from stream_merge import StreamMerger
+from tracing import Trace, DEQUEUE, WINDOW, openTraceFile
+from uplink import UplinkWriter
+from wire_v2 import negotiateVersion, encodeWindow, encodeEvent, encodeFeatures, encodeShot
+
+logger = logging.getLogger(__name__)
 
 
 class Ultra96Client:
@@ -16,7 +25,18 @@ class Ultra96Client:
     TUNNEL_DOMAIN_NAME = 'stu.comp.nus.edu.sg'
     TUNNEL_PORT_NUM = 22
 
-    def __init__(self, player_one_queue, player_two_queue):
+    # most packets handled for each player every time the client wakes up
+    MAX_ROUNDS_PER_WAKEUP = 256
+
+    # player_queues holds a queue per player, indexed by player id
+    # data_client_address overrides DATA_CLIENT/DATA_CLIENT_PORT, e.g. to connect straight to a local data_server
+    # trace_dir is where the traces of the packets the Beetles trace are written to, see tracing.py
+    # reorder_delay is how long a record can be held back to put it in the order it was received, see stream_merge.py,
+    # None to handle the records in the order they come out of the player queues
+    def __init__(self, player_queues, data_client_address=None, trace_dir=None, reorder_delay=MERGE_REORDER_DELAY):
+        # sshtunnel and dotenv are only imported here, in the Ultra96 client's process, since sshtunnel takes paramiko
+        # and its crypto libraries with it
+        from dotenv import load_dotenv
         load_dotenv()
 
         # initialize Sunfire credentials
@@ -25,21 +45,69 @@ class Ultra96Client:
 
         # initialize data server credentials
         self.data_server = os.environ.get('DATA_SERVER')
-        self.data_server_port = int(os.environ.get('DATA_SERVER_PORT'))
+        self.data_server_port = int(os.environ.get('DATA_SERVER_PORT', 0))
 
         # initialize data client credentials
-        self.data_client = os.environ.get('DATA_CLIENT')
-        self.data_client_port = int(os.environ.get('DATA_CLIENT_PORT'))
-
-        # initialize data queues
-        self.p1_queue = player_one_queue
-        self.p2_queue = player_two_queue
-
-        # configure state variables for IMU window
-        self.p1_can_send = False
-        self.p1_counter = 0
-        self.p2_can_send = False
-        self.p2_counter = 0
+        if data_client_address is None:
+            self.data_client = os.environ.get('DATA_CLIENT')
+            self.data_client_port = int(os.environ.get('DATA_CLIENT_PORT'))
+        else:
+            self.data_client, self.data_client_port = data_client_address
+
+        # initialize data queues, waiting on all of them at once instead of polling them
+        self.player_queues = dict(enumerate(player_queues))
+        self.queue_selector = PacketQueueSelector(self.player_queues)
+
+        # configure IMU windows, with the raw packets of each player collected over a wakeup and decoded and windowed
+        # together
+        self.motion_windows = {player_id: MotionWindow() for player_id in self.player_queues}
+        self.imu_packets = {player_id: bytearray() for player_id in self.player_queues}
+
+        # the records of each player's Beetles, put back in the order they were received before they are handled
+        self.mergers = {}
+        if reorder_delay is not None:
+            self.mergers = {player_id: StreamMerger((IMU, EMITTER, RECEIVER), reorder_delay)
+                            for player_id in self.player_queues}
+
+        # for telemetry
+        self.num_packets_relayed = {player_id: 0 for player_id in self.player_queues}
+        self.num_windows_sent = {player_id: 0 for player_id in self.player_queues}
+        self.num_connections = 0
+
+        # the uplink format of the current connection, see wire_v2.py, and the sequence number of each player's next
+        # window from version 2 on
+        self.wire_version = 1
+        self.window_seqs = {player_id: 0 for player_id in self.player_queues}
+        self.has_sent_frame = False
+
+        # traces of the IMU samples waiting to be windowed, along with their index in the player's MotionWindow
+        self.trace_writer = openTraceFile(trace_dir)
+        self.imu_traces = {player_id: [] for player_id in self.player_queues}
+
+        self.registerMetrics()
+        startup.registerMetrics()
+
+    def registerMetrics(self):
+        for player_id, player_queue in self.player_queues.items():
+            prefix = f'p{player_id + 1}.uplink'
+            metrics.registry.gauge(f'{prefix}.queue_depth', player_queue.depth)
+            metrics.registry.gauge(f'{prefix}.queue_dropped', player_queue.numDropped)
+            metrics.registry.gauge(f'{prefix}.imu_shed', player_queue.numShed)
+            metrics.registry.gauge(f'{prefix}.packets_relayed', lambda player_id=player_id: self.num_packets_relayed[player_id])
+            metrics.registry.gauge(f'{prefix}.windows_sent', lambda player_id=player_id: self.num_windows_sent[player_id])
+        for player_id, merger in self.mergers.items():
+            prefix = f'p{player_id + 1}.merge'
+            metrics.registry.gauge(f'{prefix}.pending', merger.pending)
+            metrics.registry.gauge(f'{prefix}.late', lambda merger=merger: merger.num_late)
+            metrics.registry.gauge(f'{prefix}.unknown', lambda merger=merger: merger.num_unknown)
+
+    # the uplink is replaced on every reconnection to the data_server
+    def registerUplinkMetrics(self, uplink):
+        metrics.registry.gauge('uplink.frames_sent', lambda: uplink.num_frames_sent)
+        metrics.registry.gauge('uplink.bytes_sent', lambda: uplink.num_bytes_sent)
+        metrics.registry.gauge('uplink.wire_version', lambda: self.wire_version)
+        metrics.registry.histogram('uplink.send_latency', uplink.send_latency)
+        metrics.registry.histogram('uplink.frame_delay', uplink.frame_delay)
 
     def run(self):
         self.tunnelToUltra96()
@@ -49,8 +117,15 @@ class Ultra96Client:
         while True:
             self.debugQueues()
 
+    # skips the SSH tunnel and connects straight to DATA_CLIENT, e.g. a local stand-in for the data_server
+    def runWithoutTunnel(self):
+        while True:
+            self.streamToDataServer()
+
     def tunnelToUltra96(self):
-        print('Opening SSH tunnel...')
+        import sshtunnel
+
+        logger.info('Opening SSH tunnel...')
         with sshtunnel.open_tunnel(
                 (Ultra96Client.TUNNEL_DOMAIN_NAME, Ultra96Client.TUNNEL_PORT_NUM),
                 ssh_username=self.sunfire_username,
@@ -62,163 +137,242 @@ class Ultra96Client:
                 while True:  # reconnect until data_server is reachable
                     sunfire_tunnel.check_tunnels()                    
                     if not (False in sunfire_tunnel.tunnel_is_up.values()):
+                        startup.markPhase('tunnel_up')
                         break
-                    print(f'data_server is not reachable, retrying...')
+                    logger.warning('data_server is not reachable, retrying...')
                     time.sleep(1)
                     sunfire_tunnel.restart()
 
-                try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        print(f'Connecting to {self.data_client}:{self.data_client_port}')
-                        self.resetAttributes()
-                        s.connect((self.data_client, self.data_client_port))
-                        print(f'Connected to {self.data_server}:{self.data_server_port}')
-                        is_connected_to_u96.value = 1
-                        while True:
-                            self.checkPlayerQueues(s)
-                except BrokenPipeError:
-                    print('data_server closed connection. Trying to reconnect...')
-                    is_connected_to_u96.value = 0
-
-    def checkPlayerQueues(self, sock):
-        if not self.p1_queue.empty():
-            p1_packet, p1_device_id = extractFromQueue(self.p1_queue)
-
-            # check if disconnection packet
-            if (p1_packet.details & (1 << RelayPacket.DISCONNECT_SHIFT)) >> RelayPacket.DISCONNECT_SHIFT:
-                sendPacket(sock, p1_packet)
-                if p1_device_id == IMU:
-                    self.resetAttributes(player_id=PLAYER_ONE)
-                return
-
-            # send reconnection packet
-            if (p1_packet.details & (1 << RelayPacket.CONNECT_SHIFT)) >> RelayPacket.CONNECT_SHIFT:
-                sendPacket(sock, p1_packet)
-                return
-
-            # send any packet involved in shooting
-            if p1_device_id == EMITTER or p1_device_id == RECEIVER:
-                sendPacket(sock, p1_packet)
-                return
-
-            # check IMU data for magnitude of acceleration
-            if not self.p1_can_send and p1_device_id == IMU:
-                accel_x, accel_y, accel_z = p1_packet.accel_data
-                accel_magnitude = calculateAccelMagnitude(accel_x, accel_y, accel_z)
-
-                if accel_magnitude > MAGNITUDE_THRESHOLD:
-                    self.p1_can_send = True
-
-            # send the next NUM_PACKETS packets to be processed as fix-sized frames by Hardware AI
-            if self.p1_can_send and self.p1_counter < NUM_PACKETS:
-                sendPacket(sock, p1_packet)
-                self.p1_counter += 1
-                if self.p1_counter >= NUM_PACKETS:
-                    self.p1_can_send = False
-                    self.p1_counter = 0
-
-        if not self.p2_queue.empty():
-            p2_packet, p2_device_id = extractFromQueue(self.p2_queue)
-
-            # check if disconnection packet
-            if (p2_packet.details & (1 << RelayPacket.DISCONNECT_SHIFT)) >> RelayPacket.DISCONNECT_SHIFT:
-                sendPacket(sock, p2_packet)
-                if p2_device_id == IMU:
-                    self.resetAttributes(player_id=PLAYER_TWO)
-                return
-
-            # send connection packet
-            if (p2_packet.details & (1 << RelayPacket.CONNECT_SHIFT)) >> RelayPacket.CONNECT_SHIFT:
-                sendPacket(sock, p2_packet)
-                return
-
-            # send any packet involved in shooting
-            if p2_device_id == EMITTER or p2_device_id == RECEIVER:
-                sendPacket(sock, p2_packet)
-                return
-
-            # check IMU data for magnitude of acceleration
-            if not self.p2_can_send and p2_device_id == IMU:
-                accel_x, accel_y, accel_z = p2_packet.accel_data
-                accel_magnitude = calculateAccelMagnitude(accel_x, accel_y, accel_z)
-
-                if accel_magnitude > MAGNITUDE_THRESHOLD:
-                    self.p2_can_send = True
-
-            # send the next NUM_PACKETS packets to be processed as fix-sized frames by Hardware AI
-            if self.p2_can_send and self.p2_counter < NUM_PACKETS:
-                sendPacket(sock, p2_packet)
-                self.p2_counter += 1
-                if self.p2_counter >= NUM_PACKETS:
-                    self.p2_can_send = False
-                    self.p2_counter = 0
+                self.streamToDataServer()
+
+    def streamToDataServer(self):
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                logger.info('Connecting to %s:%s', self.data_client, self.data_client_port)
+                # the Beetles may have been connecting while the uplink came up, so what they sent is kept for the
+                # first connection and only thrown away as stale on reconnections
+                if self.num_connections:
+                    self.resetAttributes()
+                s.connect((self.data_client, self.data_client_port))
+                logger.info('Connected to %s:%s', self.data_server, self.data_server_port)
+                self.num_connections += 1
+                self.wire_version = negotiateVersion(s, UPLINK_WIRE_VERSION)
+                self.window_seqs = dict.fromkeys(self.window_seqs, 0)
+                logger.info('Sending uplink format version %d', self.wire_version)
+                startup.markPhase('uplink_connected')
+                is_connected_to_u96.value = 1
+                uplink = UplinkWriter(s, framed=UPLINK_FRAMED)
+                self.registerUplinkMetrics(uplink)
+                while True:
+                    self.checkPlayerQueues(uplink)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning('data_server closed connection. Trying to reconnect...')
+            is_connected_to_u96.value = 0
+        except ConnectionRefusedError:
+            logger.warning('data_server refused connection. Trying to reconnect...')
+            time.sleep(1)
+
+    def checkPlayerQueues(self, uplink):
+        # wake up in time to send out a batch that is due even if no more packets arrive
+        ready_players = self.queue_selector.select(self.timeUntilWakeup(uplink))
+
+        # serve the players with data in turn, one packet each, until every packet that was ready has been handled
+        # the number of rounds is bounded so a constant stream of packets can't keep the loop from returning
+        for _ in range(Ultra96Client.MAX_ROUNDS_PER_WAKEUP):
+            if not ready_players:
+                break
+
+            for player_id in list(ready_players):
+                player_queue = self.player_queues[player_id]
+                if player_queue.empty():
+                    ready_players.remove(player_id)
+                    continue
+
+                self.handleRecord(uplink, player_id, player_queue.get())
+                self.num_packets_relayed[player_id] += 1
+
+        if self.mergers:
+            self.releaseRecords(uplink)
+        self.sendWindows(uplink)
+        uplink.flushIfDue()
+        if uplink.sent_traces:
+            self.writeTraces(uplink.sent_traces)
+
+        # the first frame that can have come from a Beetle's data, rather than just its connection
+        if not self.has_sent_frame and uplink.num_frames_sent and startup.timeToPhase('first_data') is not None:
+            self.has_sent_frame = True
+            startup.markPhase('first_frame')
+            startup.reportStartup()
+
+    # the sooner of a batch being due and a held back record being due
+    def timeUntilWakeup(self, uplink):
+        timeout = uplink.timeUntilDeadline()
+        if self.mergers:
+            now = time.perf_counter()
+            for merger in self.mergers.values():
+                due = merger.timeUntilDue(now)
+                if due is not None and (timeout is None or due < timeout):
+                    timeout = due
+        return timeout
+
+    # record is (packet, kind, device_id, receive_time, trace) as got from a player queue, see packet_queue.py. the
+    # record is routed by the player queue and Beetle it came from, and only the shot bits of the packet are looked
+    # at here, IMU samples are decoded a whole wakeup's worth at a time in sendWindows
+    def handleRecord(self, uplink, player_id, record):
+        packet, kind, device_id, receive_time, stamps = record
+
+        trace = None
+        if stamps is not None:
+            trace = Trace(player_id, device_id, stamps)
+            trace.stamp(DEQUEUE)
+
+        if self.mergers:
+            self.mergers[player_id].push(device_id, receive_time, (packet, kind, trace))
+        else:
+            self.relayRecord(uplink, player_id, device_id, packet, kind, trace)
+
+    # relays the records of every player that are due, in the order they were received
+    def releaseRecords(self, uplink, now=None):
+        now = time.perf_counter() if now is None else now
+        for player_id, merger in self.mergers.items():
+            for device_id, _, (packet, kind, trace) in merger.release(now):
+                self.relayRecord(uplink, player_id, device_id, packet, kind, trace)
+
+    def relayRecord(self, uplink, player_id, device_id, packet, kind, trace):
+        beetle_details = packet[0]
+
+        # check if disconnection packet
+        if kind == TPacketType.PACKET_TYPE_DISCONNECTED.value:
+            self.sendEvent(uplink, relayDetails(kind, player_id, device_id, beetle_details), trace)
+            if device_id == IMU:
+                self.resetAttributes(player_id=player_id)
+            return
+
+        # send connection packet, and any packet involved in shooting
+        if kind or device_id == EMITTER or device_id == RECEIVER:
+            if not kind and self.wire_version >= 3:
+                self.sendShot(uplink, player_id, relayDetails(kind, player_id, device_id, beetle_details), trace)
+            else:
+                self.sendEvent(uplink, relayDetails(kind, player_id, device_id, beetle_details), trace)
+            return
+
+        if device_id == IMU:
+            imu_packets = self.imu_packets[player_id]
+            if trace is not None:
+                sample_index = self.motion_windows[player_id].end_index + len(imu_packets) // packetize.PACKET_SIZE
+                self.imu_traces[player_id].append((sample_index, trace))
+            imu_packets += packet
+
+    # shots and connection changes go out straight away, in version 2 as just their details byte
+    def sendEvent(self, uplink, details, trace=None):
+        if trace is not None:
+            trace.stamp(WINDOW)
+            uplink.addTrace(trace)
+        if self.wire_version >= 2:
+            uplink.write(encodeEvent(details), urgent=True)
+        else:
+            uplink.write(packEvent(details), urgent=True)
+
+    # in version 3 a shot says where it falls in the player's IMU windows, so the samples received before it are
+    # windowed first
+    def sendShot(self, uplink, player_id, details, trace=None):
+        if self.imu_packets[player_id]:
+            self.sendPlayerWindows(uplink, player_id)
+        if trace is not None:
+            trace.stamp(WINDOW)
+            uplink.addTrace(trace)
+        window_offset = self.motion_windows[player_id].windowOffset()
+        uplink.write(encodeShot(details, self.window_seqs[player_id], window_offset), urgent=True)
+
+    def sendWindows(self, uplink):
+        for player_id, imu_packets in self.imu_packets.items():
+            if imu_packets:
+                self.sendPlayerWindows(uplink, player_id)
+
+    # send every window of WINDOW_SIZE samples to be processed as fix-sized frames by Hardware AI, or with
+    # RELAY_FEATURES the features of the window as a single frame, see features.py. in version 2 of the uplink
+    # format a window is a single record of fixed-point samples, see wire_v2.py
+    def sendPlayerWindows(self, uplink, player_id):
+        imu_packets = self.imu_packets[player_id]
+        motion_window = self.motion_windows[player_id]
+        windows = motion_window.push(decodeImuSamples(imu_packets))
+        for window, (window_start, window_end) in zip(windows, motion_window.window_ranges):
+            # the traces of the samples in the window go in the batch it is written to
+            if self.imu_traces[player_id]:
+                self.windowTraces(uplink, player_id, window_start, window_end)
+
+            if RELAY_FEATURES:
+                frame = packFeatures(player_id, computeFeatures(window))
+                uplink.write(encodeFeatures(frame) if self.wire_version >= 2 else frame)
+            elif self.wire_version >= 2:
+                uplink.write(encodeWindow(player_id, self.window_seqs[player_id], time.time(), window,
+                                          UPLINK_DELTA))
+            else:
+                uplink.write(packWindow(player_id, window))
+            # counts feature frames too, so the shots of version 3 can refer to them
+            self.window_seqs[player_id] += 1
+            self.num_windows_sent[player_id] += 1
+        imu_packets.clear()
+
+        if self.imu_traces[player_id]:
+            self.expireTraces(player_id)
+
+    def windowTraces(self, uplink, player_id, window_start, window_end):
+        pending = []
+        for sample_index, trace in self.imu_traces[player_id]:
+            if window_start <= sample_index < window_end:
+                trace.stamp(WINDOW)
+                uplink.addTrace(trace)
+            else:
+                pending.append((sample_index, trace))
+        self.imu_traces[player_id] = pending
+
+    # traced samples that can no longer end up in a window are finished without being sent
+    def expireTraces(self, player_id):
+        first_pending = self.motion_windows[player_id].firstPendingIndex()
+        pending = []
+        for sample_index, trace in self.imu_traces[player_id]:
+            if sample_index < first_pending:
+                trace.stamp(WINDOW)
+                self.writeTraces([trace])
+            else:
+                pending.append((sample_index, trace))
+        self.imu_traces[player_id] = pending
+
+    def writeTraces(self, traces):
+        if self.trace_writer is not None:
+            for trace in traces:
+                self.trace_writer.write(trace)
+        traces.clear()
 
     def debugQueues(self):
-        if not self.p1_queue.empty():
-            print('ULTRA96_CLIENT: Player1 queue has data')
-            p1_packet, p1_device_id = extractFromQueue(self.p1_queue)
-            printPacket(p1_packet)
-
-        if not self.p2_queue.empty():
-            print('ULTRA96_CLIENT: Player2 queue has data')
-            p2_packet, p2_device_id = extractFromQueue(self.p2_queue)
-            printPacket(p2_packet)
+        for player_id in self.queue_selector.select():
+            logger.info('Player%d queue has data', player_id + 1)
+            packet, kind, device_id, receive_time, _ = self.player_queues[player_id].get()
+            logger.info('Record got from queue: kind %d, device %d, received at %.6f, details %s, packet %s', kind,
+                        device_id, receive_time, packetize.DETAILS_TABLE[packet[0]], bytes(packet).hex())
 
     def resetAttributes(self, player_id='both'):
-        if player_id == PLAYER_ONE or player_id == 'both':
-            self.p1_can_send = False
-            self.p1_counter = 0
-            size = self.p1_queue.qsize()
-            for _ in range(size):
-                self.p1_queue.get()
-            
-        if player_id == PLAYER_TWO or player_id == 'both':
-            self.p2_can_send = False
-            self.p2_counter = 0
-            size = self.p2_queue.qsize()
-            for _ in range(size):
-                self.p2_queue.get()
-
-
-def extractFromQueue(player_queue):
-    packet_to_send = RelayPacket()
-    ble_packet_attr = player_queue.get()
-
-    device_id = ble_packet_attr[3]
-    packet_to_send.extractBlePacketData(ble_packet_attr)
-    return packet_to_send, device_id
-
-
-def sendPacket(sock, packet_to_send):
-    packet_bytes = packet_to_send.toBytes()
-    packet_tuple = packet_to_send.toTuple()
-
-    sock.sendall(packet_bytes)
-
-    print(f'ULTRA96_CLIENT: Packet sent to Ultra96: {packet_tuple}\n')
-
-
-def printPacket(packet_to_send):
-    print(f'ULTRA96_CLIENT: Packet sent to Ultra96: {packet_to_send.toTuple()}')
-    print(f'ULTRA96_CLIENT: Bytes sent to Ultra96 : {packet_to_send.toBytes()}\n')
-
-
-def calculateAccelMagnitude(x, y, z):
-    return sqrt((x * x) + (y * y) + (z * z))
+        for queue_player_id, player_queue in self.player_queues.items():
+            if player_id == queue_player_id or player_id == 'both':
+                self.motion_windows[queue_player_id].reset()
+                self.imu_packets[queue_player_id].clear()
+                if self.mergers:
+                    self.mergers[queue_player_id].clear()
+                self.imu_traces[queue_player_id].clear()
+                player_queue.clear()
 
 
 if __name__ == '__main__':
-    test_packet = RelayPacket()
-    test_packet.extractBlePacketData((4, 0, 0, 2, 0, 0, 0, 0, 0, 0.0, 0.0, 0.0, b'\x00'))
-
-    print(test_packet.details)
-
-    tp_bytes = test_packet.toBytes()
-    tp_tuple = test_packet.toTuple()
-
-    if (test_packet.details & (1 << 4)) >> 4:
-        print('Player 1 beetle disconnected')
-    elif (test_packet.details & (1 << 3)) >> 3:
-        print('Player 2 beetle disconnected')
-    print(tp_bytes)
-    print(tp_tuple)
+    # player 1's emitter disconnecting, as its record comes out of a player queue
+    kind = TPacketType.PACKET_TYPE_DISCONNECTED.value
+    test_packet = eventPacket((kind, 0, 0, EMITTER))
+    details = relayDetails(kind, 0, EMITTER, test_packet[0])
+
+    print(details)
+
+    if (details & (1 << RelayPacket.DISCONNECT_SHIFT)) >> RelayPacket.DISCONNECT_SHIFT:
+        print(f'Player {(details >> RelayPacket.PLAYER_ID_SHIFT) + 1} beetle disconnected')
+    elif (details & (1 << RelayPacket.CONNECT_SHIFT)) >> RelayPacket.CONNECT_SHIFT:
+        print(f'Player {(details >> RelayPacket.PLAYER_ID_SHIFT) + 1} beetle connected')
+    print(packEvent(details))
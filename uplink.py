@@ -0,0 +1,219 @@
+import argparse
+import socket
+import struct
+import time
+
+from features import FEATURE_FRAME_SIZE, isFeatureFrame, decodeFeatureFrame
+from metrics import Histogram
+from relay_packet import RelayPacket
+from tracing import SEND
+from wire_v2 import WIRE_VERSION, decodeRecords, offerVersion
+
+# every frame is its payload length followed by the payload, a batch of back-to-back relay packets and feature
+# frames, or of version 2 records, see wire_v2.py
+FRAME_HEADER = struct.Struct('!I')
+RELAY_PACKET_SIZE = struct.calcsize(RelayPacket.FMT)
+
+
+# coalesces relay packets into batches and writes each batch with a single sendmsg call
+class UplinkWriter:
+
+    # a batch is sent once it holds this many bytes, or once its oldest packet has waited MAX_DELAY seconds
+    MAX_BATCH_BYTES = 40 * RELAY_PACKET_SIZE
+    MAX_DELAY = 0.005
+
+    def __init__(self, sock, framed=False, max_batch_bytes=MAX_BATCH_BYTES, max_delay=MAX_DELAY, no_delay=True):
+        self.sock = sock
+        self.framed = framed
+        self.max_batch_bytes = max_batch_bytes
+        self.max_delay = max_delay
+
+        # batching is done here, so Nagle's algorithm would only add latency on top
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(no_delay))
+
+        self.pending = []
+        self.pending_bytes = 0
+        self.deadline = None
+        # traces of the packets in the pending batch, and of those sent since sent_traces was last emptied
+        self.pending_traces = []
+        self.sent_traces = []
+
+        # for measuring the uplink
+        self.num_frames_sent = 0
+        self.num_bytes_sent = 0
+        self.max_frame_delay = 0.0
+        # time spent in sendmsg, and from the oldest packet of a batch being written to the batch going out
+        self.send_latency = Histogram()
+        self.frame_delay = Histogram()
+
+    def write(self, data, urgent=False):
+        if not self.pending:
+            self.deadline = time.perf_counter() + self.max_delay
+
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+
+        if urgent or self.pending_bytes >= self.max_batch_bytes:
+            self.flush()
+
+    # the trace of a packet going out in the pending batch, or with the next write. it is stamped when the batch is
+    # sent, see tracing.py
+    def addTrace(self, trace):
+        self.pending_traces.append(trace)
+
+    # seconds until the pending batch has to go out, or None if nothing is pending
+    def timeUntilDeadline(self):
+        if not self.pending:
+            return None
+        return max(0.0, self.deadline - time.perf_counter())
+
+    def flushIfDue(self):
+        if self.pending and time.perf_counter() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        buffers = self.pending
+        if self.framed:
+            buffers.insert(0, FRAME_HEADER.pack(self.pending_bytes))
+
+        send_start = time.perf_counter()
+        sendAll(self.sock, buffers)
+
+        now = time.perf_counter()
+        frame_delay = now - (self.deadline - self.max_delay)
+        self.max_frame_delay = max(self.max_frame_delay, frame_delay)
+        self.send_latency.record(now - send_start)
+        self.frame_delay.record(frame_delay)
+        self.num_frames_sent += 1
+        self.num_bytes_sent += self.pending_bytes
+        if self.pending_traces:
+            for trace in self.pending_traces:
+                trace.stamp(SEND, now)
+            self.sent_traces += self.pending_traces
+            self.pending_traces = []
+
+        self.pending = []
+        self.pending_bytes = 0
+        self.deadline = None
+
+
+# reads back what an UplinkWriter sends, for a local stand-in of the data_server
+class UplinkReader:
+
+    def __init__(self, sock, framed=False, version=1):
+        self.sock = sock
+        self.framed = framed
+        self.version = version
+        # the start of a version 2 record still to arrive, when not framed
+        self.buffer = b''
+
+    # returns the relay packets, as tuples, and feature frames, as FeatureFrames, of the next frame, or of whatever
+    # arrived next when not framed. in version 2 it returns the records of wire_v2.py instead. an empty list means the
+    # writer closed the connection
+    def readPackets(self):
+        if self.version >= 2:
+            return self.readRecords()
+
+        if self.framed:
+            header = self.readExactly(FRAME_HEADER.size)
+            if not header:
+                return []
+            payload = self.readExactly(FRAME_HEADER.unpack(header)[0])
+        else:
+            payload = self.readExactly(RELAY_PACKET_SIZE)
+            # a feature frame is longer than a relay packet, and only told apart by its details byte
+            if payload and isFeatureFrame(payload[0]):
+                payload += self.readExactly(FEATURE_FRAME_SIZE - RELAY_PACKET_SIZE)
+
+        return decodePayload(payload)
+
+    def readRecords(self):
+        if self.framed:
+            header = self.readExactly(FRAME_HEADER.size)
+            if not header:
+                return []
+            payload = self.readExactly(FRAME_HEADER.unpack(header)[0])
+            records, consumed = decodeRecords(payload)
+            if consumed != len(payload):
+                raise ValueError(f'Frame of {len(payload)} bytes ends part way through a record')
+            return records
+
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                return []
+            self.buffer += data
+            records, consumed = decodeRecords(self.buffer)
+            self.buffer = self.buffer[consumed:]
+            if records:
+                return records
+
+    def readExactly(self, num_bytes):
+        data = bytearray()
+        while len(data) < num_bytes:
+            chunk = self.sock.recv(num_bytes - len(data))
+            if not chunk:
+                return bytes(0)
+            data += chunk
+        return bytes(data)
+
+
+def decodePayload(payload):
+    records = []
+    offset = 0
+    while offset < len(payload):
+        if isFeatureFrame(payload[offset]):
+            records.append(decodeFeatureFrame(payload[offset:offset + FEATURE_FRAME_SIZE]))
+            offset += FEATURE_FRAME_SIZE
+        else:
+            records.append(struct.unpack_from(RelayPacket.FMT, payload, offset))
+            offset += RELAY_PACKET_SIZE
+    return records
+
+
+def sendAll(sock, buffers):
+    # sendmsg may stop part way through the buffers, so keep going from wherever it stopped
+    while buffers:
+        num_sent = sock.sendmsg(buffers)
+        while buffers and num_sent >= len(buffers[0]):
+            num_sent -= len(buffers[0])
+            buffers = buffers[1:]
+        if num_sent:
+            buffers[0] = memoryview(buffers[0])[num_sent:]
+
+
+def serveUplink(host, port, framed, max_version=WIRE_VERSION):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(1)
+        print(f'UPLINK: Listening on {host}:{port}')
+
+        while True:
+            conn, address = server.accept()
+            print(f'UPLINK: Connection from {address[0]}:{address[1]}')
+            with conn:
+                version = offerVersion(conn, max_version)
+                print(f'UPLINK: Receiving format version {version}')
+                reader = UplinkReader(conn, framed, version)
+                while True:
+                    packets = reader.readPackets()
+                    if not packets:
+                        break
+                    for packet in packets:
+                        print(f'UPLINK: Received {packet}')
+            print('UPLINK: Connection closed')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in for the data_server on the Ultra96')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=10000)
+    parser.add_argument('--framed', action='store_true', help='expect length-prefixed batch frames')
+    parser.add_argument('--max-version', type=int, choices=range(1, WIRE_VERSION + 1), default=WIRE_VERSION,
+                        help='highest uplink format to offer the relay, see wire_v2.py')
+    args = parser.parse_args()
+    serveUplink(args.host, args.port, args.framed, args.max_version)
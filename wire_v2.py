@@ -0,0 +1,220 @@
+import select
+import socket
+import struct
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from features import FEATURE_FRAME_SIZE, decodeFeatureFrame
+from motion_window import NUM_CHANNELS
+
+# version 2 of the uplink to the Ultra96. where version 1 sends every IMU sample as a relay packet of float32s, version
+# 2 sends a whole window as one record of int16 fixed-point samples, and shots and connection changes as records of
+# two bytes. every record starts with its type:
+#
+#   window     type, player id, sequence number, timestamp, number of samples, flags, a scale per channel, then the
+#              samples. sample = value * scale of its channel. with FLAG_DELTA, the first row of samples is int16 and
+#              the rest are int8 differences from the row before, otherwise every row is int16
+#   event      type, the details byte of the relay packet it stands for
+#   features   type, then a feature frame, see features.py
+#   shot       type, the details byte, the sequence number of the player's window being cut when the shot was
+#              received and the shot's offset in it in samples, or -1 if no window was being cut. version 3 only, in
+#              which it takes the place of the event record of every shot
+#
+# everything is in network byte order. the timestamp is the relay's time.time() when the window was sent, and the
+# sequence number counts the windows of each player, wrapping at 65536, so the receiver can tell windows were lost.
+# the records of a player come in the order their packets were received by the relay, see stream_merge.py
+#
+# the version is negotiated when the relay connects: a data_server that speaks version 2 or later sends a hello with
+# the highest version it speaks, and the relay answers with the version it will send. a data_server whose hello hasn't
+# reached the relay within HELLO_TIMEOUT is sent version 1 without an answer. only the relay decides, and the
+# data_server follows whatever the relay's first bytes say, however long they take, so a hello that arrives late
+# can't leave the two sides on different versions
+
+WIRE_VERSION = 3
+
+HELLO = struct.Struct('!4sB')
+SERVER_HELLO_MAGIC = b'U96H'
+RELAY_ACK_MAGIC = b'RLYA'
+HELLO_TIMEOUT = 0.2
+# how often the data_server looks again at an answer from the relay that has only partly arrived
+ACK_POLL_INTERVAL = 0.001
+
+RECORD_WINDOW = 0x01
+RECORD_EVENT = 0x02
+RECORD_FEATURES = 0x03
+RECORD_SHOT = 0x04
+
+WINDOW_HEADER = struct.Struct(f'!BBHdBB{NUM_CHANNELS}f')
+EVENT_RECORD = struct.Struct('!BB')
+SHOT_RECORD = struct.Struct('!BBHh')
+
+FLAG_DELTA = 0x01
+
+SAMPLE_DTYPE = np.dtype('>i2')
+DELTA_DTYPE = np.dtype('i1')
+INT16_MAX = 32767
+# one less than the int8 maximum, since rounding each sample can add one to their difference
+DELTA_MAX = 126
+# delta encoding coarsens a channel's scale to fit its largest step between samples into DELTA_MAX. it is only used
+# if that leaves at least 8 of the 16 bits of precision, a step of at most 1/256 of the channel's peak
+MAX_DELTA_COARSENING = 256
+
+WindowRecord = namedtuple('WindowRecord', ['player_id', 'seq', 'timestamp', 'scales', 'samples'])
+EventRecord = namedtuple('EventRecord', ['details'])
+FeaturesRecord = namedtuple('FeaturesRecord', ['frame'])
+ShotRecord = namedtuple('ShotRecord', ['details', 'window_seq', 'window_offset'])
+
+
+# a window of samples, one row per sample, as a window record
+def encodeWindow(player_id, seq, timestamp, window, delta=True):
+    window = np.asarray(window, dtype=np.float32)
+    scales = np.abs(window).max(axis=0) / INT16_MAX
+    # a channel that is all zeroes can have any scale
+    scales[scales == 0] = 1.0
+
+    flags = 0
+    if delta and len(window) > 1:
+        delta_scales = np.maximum(scales, np.abs(np.diff(window, axis=0)).max(axis=0) / DELTA_MAX)
+        if np.all(delta_scales <= scales * MAX_DELTA_COARSENING):
+            flags = FLAG_DELTA
+            scales = delta_scales
+
+    samples = np.rint(window / scales).astype(np.int16)
+    if flags & FLAG_DELTA:
+        payload = samples[0].astype(SAMPLE_DTYPE).tobytes() + np.diff(samples, axis=0).astype(DELTA_DTYPE).tobytes()
+    else:
+        payload = samples.astype(SAMPLE_DTYPE).tobytes()
+
+    header = WINDOW_HEADER.pack(RECORD_WINDOW, player_id, seq & 0xFFFF, timestamp, len(window), flags, *scales)
+    return header + payload
+
+
+def encodeEvent(details):
+    return EVENT_RECORD.pack(RECORD_EVENT, details)
+
+
+def encodeShot(details, window_seq, window_offset):
+    return SHOT_RECORD.pack(RECORD_SHOT, details, window_seq & 0xFFFF, window_offset)
+
+
+def encodeFeatures(feature_frame):
+    return bytes((RECORD_FEATURES,)) + feature_frame
+
+
+def windowPayloadSize(num_samples, flags):
+    if flags & FLAG_DELTA:
+        return NUM_CHANNELS * SAMPLE_DTYPE.itemsize + (num_samples - 1) * NUM_CHANNELS * DELTA_DTYPE.itemsize
+    return num_samples * NUM_CHANNELS * SAMPLE_DTYPE.itemsize
+
+
+# decodes every whole record at the start of buffer, returning the records and the bytes they took up. what is left
+# is the start of a record still to arrive
+def decodeRecords(buffer):
+    records = []
+    offset = 0
+    while offset < len(buffer):
+        record_type = buffer[offset]
+        if record_type == RECORD_EVENT:
+            if offset + EVENT_RECORD.size > len(buffer):
+                break
+            records.append(EventRecord(buffer[offset + 1]))
+            offset += EVENT_RECORD.size
+        elif record_type == RECORD_SHOT:
+            if offset + SHOT_RECORD.size > len(buffer):
+                break
+            records.append(ShotRecord(*SHOT_RECORD.unpack_from(buffer, offset)[1:]))
+            offset += SHOT_RECORD.size
+        elif record_type == RECORD_FEATURES:
+            if offset + 1 + FEATURE_FRAME_SIZE > len(buffer):
+                break
+            records.append(FeaturesRecord(decodeFeatureFrame(buffer[offset + 1:offset + 1 + FEATURE_FRAME_SIZE])))
+            offset += 1 + FEATURE_FRAME_SIZE
+        elif record_type == RECORD_WINDOW:
+            if offset + WINDOW_HEADER.size > len(buffer):
+                break
+            _, player_id, seq, timestamp, num_samples, flags, *scales = WINDOW_HEADER.unpack_from(buffer, offset)
+            payload_start = offset + WINDOW_HEADER.size
+            payload_end = payload_start + windowPayloadSize(num_samples, flags)
+            if payload_end > len(buffer):
+                break
+            scales = np.array(scales, dtype=np.float32)
+            samples = decodeSamples(buffer[payload_start:payload_end], num_samples, flags)
+            records.append(WindowRecord(player_id, seq, timestamp, scales, samples * scales))
+            offset = payload_end
+        else:
+            raise ValueError(f'Unknown uplink record type {record_type} at byte {offset}')
+    return records, offset
+
+
+def decodeSamples(payload, num_samples, flags):
+    if not flags & FLAG_DELTA:
+        return np.frombuffer(payload, dtype=SAMPLE_DTYPE).reshape(num_samples, NUM_CHANNELS).astype(np.float32)
+
+    samples = np.empty((num_samples, NUM_CHANNELS), dtype=np.int32)
+    samples[0] = np.frombuffer(payload, dtype=SAMPLE_DTYPE, count=NUM_CHANNELS)
+    steps = np.frombuffer(payload, dtype=DELTA_DTYPE, offset=NUM_CHANNELS * SAMPLE_DTYPE.itemsize)
+    samples[1:] = steps.reshape(num_samples - 1, NUM_CHANNELS)
+    return np.cumsum(samples, axis=0).astype(np.float32)
+
+
+# relay side, right after connecting: the version to send, version 1 unless the data_server offers a later one
+def negotiateVersion(sock, max_version=WIRE_VERSION, timeout=HELLO_TIMEOUT):
+    if max_version < 2:
+        return 1
+
+    deadline = time.perf_counter() + timeout
+    hello = b''
+    while len(hello) < HELLO.size:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+            return 1
+        data = sock.recv(HELLO.size - len(hello))
+        if not data:
+            raise ConnectionResetError('data_server closed the connection during the hello')
+        hello += data
+
+    magic, server_version = HELLO.unpack(hello)
+    if magic != SERVER_HELLO_MAGIC:
+        raise ConnectionResetError(f'Unexpected hello from data_server: {hello!r}')
+
+    version = min(max_version, server_version)
+    sock.sendall(HELLO.pack(RELAY_ACK_MAGIC, version))
+    return version
+
+
+# data_server side, right after accepting: offers max_version and returns the version the relay will send. it waits
+# for the relay's first bytes, which are only looked at unless they are its answer, so that version 1 data is left
+# for the reader. a relay that closes the connection without sending anything counts as version 1
+def offerVersion(sock, max_version=WIRE_VERSION):
+    # a data_server that only speaks version 1 doesn't send a hello at all
+    if max_version < 2:
+        return 1
+
+    sock.sendall(HELLO.pack(SERVER_HELLO_MAGIC, max_version))
+
+    while True:
+        start = sock.recv(HELLO.size, socket.MSG_PEEK)
+        if not start or not RELAY_ACK_MAGIC.startswith(start[:len(RELAY_ACK_MAGIC)]):
+            return 1
+        if len(start) == HELLO.size:
+            break
+        # the start of an answer, the rest of which is still on its way
+        time.sleep(ACK_POLL_INTERVAL)
+
+    _, version = HELLO.unpack(sock.recv(HELLO.size))
+    if not 1 <= version <= max_version:
+        raise ConnectionResetError(f'Unexpected version from relay: {version}')
+    return version
+
+
+if __name__ == "__main__":
+    from relay_packet import RelayPacket, packWindow
+
+    t = np.linspace(0, 2 * np.pi, 50, dtype=np.float32)[:, None]
+    smooth = (np.sin(t * np.arange(1, NUM_CHANNELS + 1)) * np.array([2, 2, 2, 250, 250, 250])).astype(np.float32)
+    v1_size = len(packWindow(0, smooth)) + 2 * struct.calcsize(RelayPacket.FMT)
+    v2_size = len(encodeWindow(0, 0, 0.0, smooth)) + 2 * EVENT_RECORD.size
+    print(f'Window and two events: {v1_size} bytes in version 1, {v2_size} bytes in version 2 '
+          f'({v1_size / v2_size:.1f}x smaller)')